@@ -5,6 +5,8 @@ import numpy as np
 import pandas as pd
 import requests
 import time # For controlling rate limits to APIs
+from concurrent.futures import as_completed # For loading the dashboard sections concurrently
+from functools import partial
 
 # Import libraries needed for Streamlit, and integrating plotting with Plost
 import datetime as dt
@@ -49,6 +51,30 @@ class NftLendingClient(object):
         except:
             print("Error: Authentication Failed")
 
+def render_sections(sections):
+    '''
+    Loads the data of the sections on the section_executor thread pool of fetch_data and draws each section into its
+    placeholder as soon as its data arrives, in whatever order the loads finish.  sections is a list of (placeholder, load function, draw function)
+    '''
+    futures = {section_executor.submit(load): (placeholder, draw) for placeholder, load, draw in sections}
+    for future in as_completed(futures):
+        placeholder, draw = futures[future]
+        with placeholder.container():
+            try:
+                data = future.result()
+            except Exception as ex:
+                st.error(f"Error: Loading the data failed - {ex}")
+            else:
+                draw(data)
+
+def lazy_section(title, key):
+    '''
+    Renders the header of a section below the fold and returns whether the viewer opened it.  Its data is only loaded once
+    it's opened, and it stays open across reruns
+    '''
+    st.header(title)
+    return st.checkbox('Show', key=key)
+
 def main():
     # Create object of NftLendingClient Class
     api = NftLendingClient()
@@ -94,6 +120,9 @@ def main():
         st.image('images/nft.jpg')
     with a2:
         st.markdown('# NFT Lending Analysis')
+        # Show how current the data is, the dashboard reads the snapshot published by the ETL when there is one
+        as_of = snapshot_as_of()
+        st.caption(f"Data as of {as_of:%B %d, %Y %H:%M} UTC" if as_of is not None else "Live data")
     
     # Insert a spacer
     st.markdown('#')
@@ -102,10 +131,11 @@ def main():
     st.header('NFT Market Growth - January 2021 to Present')
     b1, b2 = st.columns(2)
     
-    # Pull the data for Row B charts
-    data = create_nft_market_vol()
+    # Leave a placeholder for each chart, the data for the charts is pulled concurrently below
+    sections = []
     with b1:
-        plost.line_chart(
+        b1_chart = st.empty()
+        sections.append((b1_chart, partial(load_dataset, 'nft_market_vol'), lambda data: plost.line_chart(
             data = data,
             x = 'Date',
             y = 'Volume in ETH',
@@ -113,13 +143,13 @@ def main():
             color = 'green',
             width = 500,
             height = 300,
-        )        
+        )))
         with st.expander("See analysis"):
             st.write("""This chart shows the total volume (in ETH) of all NFT collections traded from January 2021 to present day. You can see from January 1st, 2021 to January 31st, 2022 the NFT market grew in volume by 128,792%. The total volume of the NFT Market at its peak traded over $820 million on a single day. A line of best fit would clearly demonstrate a growing market as time progresses.""")
 
-    data = create_os_collection_index()
     with b2:
-        plost.line_chart(
+        b2_chart = st.empty()
+        sections.append((b2_chart, partial(load_dataset, 'os_collection_index'), lambda data: plost.line_chart(
             data = data,
             x = 'Date',
             y = 'Volume in ETH',
@@ -127,7 +157,7 @@ def main():
             color = 'blue',
             width = 500,
             height = 300,
-        )
+        )))
         with st.expander("See analysis"):
             st.write("""This chart shows the total volume (in ETH) of Open Sea's Top Ten Collections traded over time. It is clear that the volume traded of the top ten collections continues to increase every time there is an interest spike in the NFT market. Additionally if you compare the top ten collections volume with the overall NFT market volume, on each peak you will find on average that Open Sea's Top Ten Collections make up 72% of the total market volume.""") 
     
@@ -138,10 +168,10 @@ def main():
     st.header('Open Sea Top Ten Collections - All Time')
     c1, c2 = st.columns(2)
    
-    # Pull the data for Row C c1 chart
-    data = create_top_collections_one()
+    # Leave a placeholder for the Row C c1 chart
     with c1:
-        plost.bar_chart(
+        c1_chart = st.empty()
+        sections.append((c1_chart, partial(load_dataset, 'top_collections_one'), lambda data: plost.bar_chart(
             data = data,
             bar = 'Collection Name',
             value = 'Volume in ETH',
@@ -149,32 +179,33 @@ def main():
             color = 'blue',
             width = 500,
             height = 500,
-    )        
+        )))
     with st.expander("See analysis"):
         st.write("""These two charts compare the total volume (in ETH) and the number of trades of Open Sea's top ten NFT collections. It is interesting to note that the all time volume for just ten NFT collections is 4,201,212ETH at today's current prices of Ether that's $7.14 Billion. Aditionally the top four collections by volume make up almost 70% of the total volume across the top ten collections, clearly demonstrating the extreme difference in value of the top 4 collections -vs- the other six. Three of the top four collections also were released by the same creators (Yuga Labs, demonstrating a concentrated and young market).""")
     
-    # Pull the data for Row C c2 chart
-    data = create_top_collections_two()
+    # Leave a placeholder for the Row C c2 chart
     with c2:
-        plost.bar_chart(
-        data = data,
-        bar = 'Collection Name',
-        value = 'Number of Trades',
-        title = 'Number of Trades',
-        color = 'green',
-        width = 500,
-        height = 500,
-    )
+        c2_chart = st.empty()
+        sections.append((c2_chart, partial(load_dataset, 'top_collections_two'), lambda data: plost.bar_chart(
+            data = data,
+            bar = 'Collection Name',
+            value = 'Number of Trades',
+            title = 'Number of Trades',
+            color = 'green',
+            width = 500,
+            height = 500,
+        )))
         
     # Insert a spacer
     st.markdown('#')    
         
     ######################## Row D ##############################
     st.header('Average Prices by Collection')
-    st.altair_chart(
-        get_average_prices(),
+    d_chart = st.empty()
+    sections.append((d_chart, get_average_prices, lambda chart: st.altair_chart(
+        chart,
         use_container_width=True
-    )
+    )))
     with st.expander("See analysis"):
         st.write("""This chart shows the average price (in ETH) of Open Sea's Top Ten Collections traded from January 2021 to present day. You can see that there were many high points as well as several low points in the NFT market.  On September 30, 2021, CryptoPunks reached an all time high. Then on January 31, 2022, the collection Meebits reached an all time high as well.  However, on April 30, 2022 of this year the whole NFT market took a nose dive!  This very young market has definitely been volatile since it's inception!""")
     
@@ -182,147 +213,151 @@ def main():
     st.markdown('#')
     
     ######################## Row E ##############################
-    st.header('Standard Deviation over time for Top 75 Collections')
-    e1, e2 = st.columns(2)
-    
-    with e1:
-        st.markdown('### By Volume')
-        plot_std_index()
-        with st.expander("See analysis.."):
-            st.write("""
-            Need explanation
-            """)    
+    if lazy_section('Standard Deviation over time for Top 75 Collections', 'show_row_e'):
+        e1, e2 = st.columns(2)
+    
+        with e1:
+            st.markdown('### By Volume')
+            sections.append((st.empty(), partial(load_dataset, 'std_devs_top_collections_index'), plot_std_index))
+            with st.expander("See analysis.."):
+                st.write("""
+                Need explanation
+                """)    
         
-    with e2:
-        st.markdown('### By Volume')
-        plot_std()
-        with st.expander("See analysis.."):
-            st.write("""
-            The standard deviation and, therefore, the volatility of some of the top collections (by percent change) are displayed here. 
-            We would evaluate collections with lower standard deviations as being better candidates for collateralization and would be eligible to receive loans at a higher 
-            loan-to-value ratio. This is because we would evaluate a lower risk of liquidation for these NFTs. 
-            For the beta values, we find little use for this analysis because the deviation of the market as a whole is so vast and can be influenced so much 
-            by the top collections it is hard to gauge the volatility of the market. Still, we see some collections that have a very low beta and we would just those as having 
-            a high preference for collateralization relative to the market. 
-            """)
+        with e2:
+            st.markdown('### By Volume')
+            sections.append((st.empty(), partial(load_dataset, 'standard_deviations'), plot_std))
+            with st.expander("See analysis.."):
+                st.write("""
+                The standard deviation and, therefore, the volatility of some of the top collections (by percent change) are displayed here. 
+                We would evaluate collections with lower standard deviations as being better candidates for collateralization and would be eligible to receive loans at a higher 
+                loan-to-value ratio. This is because we would evaluate a lower risk of liquidation for these NFTs. 
+                For the beta values, we find little use for this analysis because the deviation of the market as a whole is so vast and can be influenced so much 
+                by the top collections it is hard to gauge the volatility of the market. Still, we see some collections that have a very low beta and we would just those as having 
+                a high preference for collateralization relative to the market. 
+                """)
 
     # Insert a spacer
     st.markdown('#')
     
     ######################## Row F ##############################
     
-    st.header('Betas for Top 75 Collections')
-    f1, f2 = st.columns(2)
+    if lazy_section('Betas for Top 75 Collections', 'show_row_f'):
+        f1, f2 = st.columns(2)
     
-    with f1:
-        # st.markdown('### by Volume')
-        plot_betas()
-        with st.expander("See analysis.."):
-            st.write("""
-            We see here a wide discrepancy in Beta values. This is a good example of why it is tricky to get a good sense of volatility in such an illiquid market.
-            We see that one collection, Unstoppable Domains, is such an outlier that it effects the entire basket of NFT collections. Its movements are strongly counter to the market.
+        with f1:
+            # st.markdown('### by Volume')
+            sections.append((st.empty(), partial(load_dataset, 'betas'), plot_betas))
+            with st.expander("See analysis.."):
+                st.write("""
+                We see here a wide discrepancy in Beta values. This is a good example of why it is tricky to get a good sense of volatility in such an illiquid market.
+                We see that one collection, Unstoppable Domains, is such an outlier that it effects the entire basket of NFT collections. Its movements are strongly counter to the market.
+
+                """)    
+        with f2:
+            # st.markdown('### Unstoppable Domains Average Price Over Time')
+            sections.append((st.empty(), partial(load_dataset, 'unstoppable_domains'), plot_unstoppable_domains))
+            with st.expander("See analysis.."):
+                st.write("""
+                If we look at the average price of the Unstoppable Domains collection we see why the data in the Betas series behaves the way it does. Unstoppable Domains has massive swings 
+                where its average price fluctuates by a magnitude of thousands. With large swings like that it will affect the covariance of the entire data. 
+                """)
 
-            """)    
-    with f2:
-        # st.markdown('### Unstoppable Domains Average Price Over Time')
-        plot_unstoppable_domains()
-        with st.expander("See analysis.."):
-            st.write("""
-            If we look at the average price of the Unstoppable Domains collection we see why the data in the Betas series behaves the way it does. Unstoppable Domains has massive swings 
-            where its average price fluctuates by a magnitude of thousands. With large swings like that it will affect the covariance of the entire data. 
-            """)    
-    
     # Insert a spacer
     st.markdown('#')
     
     ######################## Row G ##############################
     
-    st.header('Simulations')
-    st.markdown("### Monte Carlo Simulation For 6 Collection Portfolio Over 1 Month")
-    st.markdown("Collections In this Portfolio: Bored Ape Yacht Club, Crypto Punks, Clonex, Neotokyo, Doodles, mfers")
-    cum_returns = plot_mc_sim()
-    plot = cum_returns.hvplot(width=1500, height=400,ylabel="Percent Increase", xlabel="Time (Days)")
-    st.bokeh_chart(hv.render(plot, backend='bokeh', use_container_width=True))
-    with st.expander("See analysis.."):
-        st.write("""
-        A portfolio consisting of these high ranking 6 collections is projected to yield high returns over the course of a month for a holder.
-        You would expect to see a 30% return based on these projections if you were holding into these collections.
-        """
-        )
-    
+    if lazy_section('Simulations', 'show_row_g'):
+        st.markdown("### Monte Carlo Simulation For 6 Collection Portfolio Over 1 Month")
+        st.markdown("Collections In this Portfolio: Bored Ape Yacht Club, Crypto Punks, Clonex, Neotokyo, Doodles, mfers")
+        def draw_mc_sim(cum_returns):
+            plot = cum_returns.hvplot(width=1500, height=400,ylabel="Percent Increase", xlabel="Time (Days)")
+            st.bokeh_chart(hv.render(plot, backend='bokeh', use_container_width=True))
+        sections.append((st.empty(), plot_mc_sim, draw_mc_sim))
+        with st.expander("See analysis.."):
+            st.write("""
+            A portfolio consisting of these high ranking 6 collections is projected to yield high returns over the course of a month for a holder.
+            You would expect to see a 30% return based on these projections if you were holding into these collections.
+            """
+            )
+
     # Insert a spacer
     st.markdown('#')
     
     ######################## Row H ##############################
     
-    st.header('Miscellaneous Analyses')
-    h1, h2 = st.columns(2)
-    
-    with h1:
-        st.markdown("### Correlation for Statistical Measurements")
-        st.image('./images/heatmap_correlation.png')
-        with st.expander("See analysis.."):
-            st.write("""
-                Here we take a look at which statistics correlate highly to other statistics. In doing so we can gain an understanding
-                of which factors we can analyze to predict the volatility of an asset. Mainly, we want to see the correlations for standard deviation and percent change.
-                We see that minimum price and average price have relatively low correlations to those two but max price and volume have relatively higher ones. If we were analyzing a collections volatility,
-                we could predict that maximum price and volume would have higher correlations to volatility than average price and minimum price. 
-            """)    
-            
-    with h2:
-        st.markdown('### Sentiment Analysis')
-        sentiment_df = get_sentiment_data()
-        sentiment_plot = sentiment_df.hvplot(x="tag", kind="bar", title="Twitter Sentiment Analysis for Top 10 NFT Collections by Trade Volume")
-        st.bokeh_chart(hv.render(sentiment_plot, backend='bokeh'))
-        with st.expander("See analysis.."):
-            st.write("""
-                This chart shows the results of an analysis of 100 recent tweets for each of the Top 10 collections. Each tweet was categorized as either Positive, Neutral, or Negative, using the Meaningcloud API.
-            """)    
+    if lazy_section('Miscellaneous Analyses', 'show_row_h'):
+        h1, h2 = st.columns(2)
+    
+        with h1:
+            st.markdown("### Correlation for Statistical Measurements")
+            st.image('./images/heatmap_correlation.png')
+            with st.expander("See analysis.."):
+                st.write("""
+                    Here we take a look at which statistics correlate highly to other statistics. In doing so we can gain an understanding
+                    of which factors we can analyze to predict the volatility of an asset. Mainly, we want to see the correlations for standard deviation and percent change.
+                    We see that minimum price and average price have relatively low correlations to those two but max price and volume have relatively higher ones. If we were analyzing a collections volatility,
+                    we could predict that maximum price and volume would have higher correlations to volatility than average price and minimum price. 
+                """)    
             
+        with h2:
+            st.markdown('### Sentiment Analysis')
+            sentiment_df = get_sentiment_data()
+            sentiment_plot = sentiment_df.hvplot(x="tag", kind="bar", title="Twitter Sentiment Analysis for Top 10 NFT Collections by Trade Volume")
+            st.bokeh_chart(hv.render(sentiment_plot, backend='bokeh'))
+            with st.expander("See analysis.."):
+                st.write("""
+                    This chart shows the results of an analysis of 100 recent tweets for each of the Top 10 collections. Each tweet was categorized as either Positive, Neutral, or Negative, using the Meaningcloud API.
+                """)
+
     # Insert a spacer
     st.markdown('#')
     
-    # Get data and create plots
-    result_df = query_correlation()
-    
-    chart1_df = plot_collection_max_price(result_df)
-    chart2_df = plot_rarity_score(result_df)
-    
     ######################## Row I ##############################
     
-    st.header('Correlations of Max Price and Rarity')
-    i1, i2 = st.columns(2)
+    if lazy_section('Correlations of Max Price and Rarity', 'show_row_i'):
     
-    with i1:
-        st.markdown("### Correlation of Max Price")
-        chart_1 = chart1_df.hvplot.bar(
-            # height=500,
-            # width=1000,
-            ylabel= " ETH ",
-            xlabel="Collection Name",
-            x='collection_name',
-            y='max_price_for_collection',
-            title="Price Paid of most Expensive NFT by Top 10 Collection",
-            rot=90,
-            color='orange'
-        ).opts(yformatter='%.0f')
+        def draw_correlations(result_df):
+            # Create plots
+            chart1_df = plot_collection_max_price(result_df)
+            chart2_df = plot_rarity_score(result_df)
+            i1, i2 = st.columns(2)
         
-        st.bokeh_chart(hv.render(chart_1, backend='bokeh'))
+            with i1:
+                st.markdown("### Correlation of Max Price")
+                chart_1 = chart1_df.hvplot.bar(
+                    # height=500,
+                    # width=1000,
+                    ylabel= " ETH ",
+                    xlabel="Collection Name",
+                    x='collection_name',
+                    y='max_price_for_collection',
+                    title="Price Paid of most Expensive NFT by Top 10 Collection",
+                    rot=90,
+                    color='orange'
+                ).opts(yformatter='%.0f')
         
-    with i2:
-        st.markdown("### Correlation of Rarity")
-        chart_2 = chart2_df.hvplot.bar(
-        # height=500,
-        #     width=1000,
-            ylabel= " Rarity Score ",
-            xlabel="Collection Name",
-            x='collection_name',
-            title="Rarity Score of Rarest NFT by Top 10 Collection",
-            rot=90,
-            color='green',
-        ).opts(yformatter='%.0f')
+                st.bokeh_chart(hv.render(chart_1, backend='bokeh'))
         
-        st.bokeh_chart(hv.render(chart_2, backend='bokeh'))
+            with i2:
+                st.markdown("### Correlation of Rarity")
+                chart_2 = chart2_df.hvplot.bar(
+                # height=500,
+                #     width=1000,
+                    ylabel= " Rarity Score ",
+                    xlabel="Collection Name",
+                    x='collection_name',
+                    title="Rarity Score of Rarest NFT by Top 10 Collection",
+                    rot=90,
+                    color='green',
+                ).opts(yformatter='%.0f')
+        
+                st.bokeh_chart(hv.render(chart_2, backend='bokeh'))
+        sections.append((st.empty(), partial(load_dataset, 'correlation'), draw_correlations))
+
+    # Pull the data for the charts concurrently and draw each chart as soon as its data arrives
+    render_sections(sections)
 
 # Call main function for program            
 if __name__ == "__main__":
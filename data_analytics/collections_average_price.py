@@ -75,10 +75,11 @@ SELECT c.name as collection,
 	   DATE_TRUNC('month', t.timestamp) as year_month_day,
 	   AVG(t.avg_price) as avg_price
 FROM {database_schema}.trade t
-INNER JOIN {database_schema}.collection c ON c.contract_id = t.contract_id
+INNER JOIN {database_schema}.contract_dictionary k ON k.contract_key = t.contract_key
+INNER JOIN {database_schema}.collection c ON c.contract_id = k.contract_id
 INNER JOIN {database_schema}.network n ON n.network_id = c.network_id
+INNER JOIN {database_schema}.watchlist_collection w ON w.contract_id = c.contract_id AND w.watchlist = 'top_ten'
 WHERE n.network_id = 'ethereum' 
-AND c.name IN ('CryptoPunks', 'BoredApeYachtClub', 'MutantApeYachtClub', 'Otherdeed', 'Azuki', 'CloneX', 'Moonbirds', 'Doodles', 'Meebits', 'Cool Cats', 'BoredApeKennelClub')
 AND DATE_TRUNC('month', t.timestamp) > '2020-12-31'
 GROUP BY c.name, DATE_TRUNC('month', t.timestamp)
 HAVING MIN(avg_price) > 0.0
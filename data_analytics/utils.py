@@ -2,6 +2,23 @@ from nbformat import write
 import pandas as pd
 import requests
 import json
+import sys
+from pathlib import Path
+
+# The replica routing is shared with the ETL and the dashboard
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from extract_transform_load import replica
+
+# Optional read-only replica for the analytics queries, used while it's within DATABASE_REPLICA_MAX_LAG seconds of the primary
+replica_router = replica.ReplicaRouter()
+
+def read_engine(engine):
+    """
+    param engine: (type: sqlalchemy.engine.Engine) The primary database engine
+
+    Returns the read replica engine when one is configured and it isn't lagging too far behind, otherwise the engine passed in
+    """
+    return replica_router.read_engine(engine)
 
 def fetch_rarify_data(url, key):
     """
@@ -209,23 +226,21 @@ def fetch_top_50_collections_database(engine, database_schema):
                     'volume': float,
                     }
     sql_query = f"""
-        SELECT t.contract_id,
+        SELECT d.contract_id,
        c.name,
-       DATE_TRUNC('day', t.timestamp) as year_day_month,
-       SUM(t.volume) as total_volume,
-       SUM(t.num_trades) as total_num_trades,
-       SUM(t.unique_buyers) as total_unique_buyers
-        FROM trade t
-        INNER JOIN collection c ON c.contract_id = t.contract_id
+       d.day as year_day_month,
+       d.total_volume,
+       d.total_num_trades,
+       d.total_unique_buyers
+        FROM collection_daily d
+        INNER JOIN collection c ON c.contract_id = d.contract_id
         INNER JOIN network n ON n.network_id = c.network_id
         WHERE n.network_id = 'ethereum' 
-        AND c.name NOT IN ('','New 0x495f947276749Ce646f68AC8c248420045cb7b5eLock', 'pieceofshit', 'Uniswap V3 Positions NFT-V1','More Loot',
-                        'NFTfi Promissory Note','dementorstownwtf','ShitBeast','mcgoblintownwtf','LonelyPop','Pablos','For the Culture','Hype Pass')
-        GROUP BY t.contract_id, c.name, DATE_TRUNC('day', t.timestamp)
-        HAVING MAX(avg_price) > 0
-        ORDER BY DATE_TRUNC('day', t.timestamp)  DESC
+        AND NOT EXISTS (SELECT 1 FROM collection_exclusion e WHERE e.contract_id = c.contract_id)
+        AND d.max_avg_price > 0
+        ORDER BY d.day DESC
     """
-    curr_df = pd.read_sql_query(sql_query, con=engine)
+    curr_df = pd.read_sql_query(sql_query, con=read_engine(engine))
     # curr_df['timestamp'] = pd.to_datetime(curr_df['timestamp'], infer_datetime_format=True)
     # curr_df = curr_df.set_index('timestamp')
     # curr_df = curr_df.astype(convert_dict)
@@ -448,6 +463,34 @@ def find_whale_ratio(contract_ids):
     return whale_ratios
 
 
+def data_analysis_frame(pct_chg_df, contract_ids, std_devs=None, betas=None, whale_ratios=None, basket_col="top_collections_basket_pct_chg"):
+    """
+    param pct_chg_df: (type: pandas.DataFrame) Output of find_pct_change, indexed by time with a {name}_pct_chg column per collection
+    param contract_ids: (type: dict) Houses the contract ids in the keys and the collection names, the same dict passed to find_pct_change
+    param std_devs: (type: pandas.Series) Optional output of find_std_devs, computed from pct_chg_df when not supplied
+    param betas: (type: dict) Optional output of find_beta
+    param whale_ratios: (type: dict) Optional output of find_whale_ratio
+    param basket_col: (type: str) Percent change column of the basket the covariance is measured against
+
+    Reshapes the wide analytics outputs into one long DataFrame with a row per collection and day matching the
+    data_analysis table, so all the collections can be saved as one set with db_utils.save_data_analysis
+    """
+    names = {f"{contract_ids[con]['name']}_pct_chg": con for con in contract_ids.keys()}
+    pct_chg = pct_chg_df[[col for col in names if col in pct_chg_df.columns]].rename(columns=names)
+    stats = pd.DataFrame({'avg_percent_chg': pct_chg.mean(), 'variance': pct_chg.var()})
+    stats['standard_dev'] = pct_chg.std()
+    if std_devs is not None:
+        stats['standard_dev'] = pd.Series({con: std_devs.get(f"{contract_ids[con]['name']}_std_dev") for con in stats.index}, dtype=float)
+    stats['avg_standard_dev'] = stats['standard_dev'].mean()
+    stats['co_variance'] = pct_chg.apply(lambda col: col.cov(pct_chg_df[basket_col])) if basket_col in pct_chg_df.columns else None
+    stats['beta'] = pd.Series({con: betas.get(f"{contract_ids[con]['name']}_beta") for con in stats.index}, dtype=float) if betas else None
+    stats['whale_ratio'] = pd.Series({con: whale_ratios[con]['whale_ratio'] for con in stats.index if con in whale_ratios}, dtype=float) if whale_ratios else None
+
+    long_df = pct_chg.rename_axis('time').stack().dropna().rename('percent_chg').reset_index()
+    long_df = long_df.rename(columns={long_df.columns[1]: 'contract_id'})
+    return long_df.join(stats, on='contract_id')
+
+
 def append_collumn_names(df, contract_ids):
     cols = ["avg_price", "max_price", "min_price", "trades", "unique_buyers", "volume"]
     new_cols = []
@@ -22,6 +22,110 @@ database_schema = os.getenv("DATABASE_SCHEMA")
 # Create database connection
 engine = create_engine(database_connection_string)
 
+# The trade table, partitioned by month on the trade timestamp
+trade_table = """
+        CREATE TABLE Trade(
+            contract_key INT NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            avg_price NUMERIC,
+            max_price NUMERIC,
+            min_price NUMERIC,
+            num_trades INT,
+            unique_buyers INT,
+            volume INT,
+            period VARCHAR,
+            type VARCHAR,
+            api_id VARCHAR
+        ) PARTITION BY RANGE (timestamp)
+"""
+
+# Token attributes with their trait.  token_attribute only stores the keys of the token and of the
+# trait, and the trait type a token has one attribute for, the trait value and rarity statistics are
+# stored once per collection in the trait table
+token_trait_view = """
+        CREATE VIEW Token_Trait AS
+        SELECT ta.token_key, tr.overall_with_trait_value, tr.rarity_percentage, tr.trait_type, tr.value, ta.trait_key
+        FROM Token_Attribute ta
+        INNER JOIN Trait tr ON tr.trait_key = ta.trait_key
+"""
+
+# Migrations applied to a database are recorded in this table, see migrate.py
+schema_version_table = """
+        CREATE TABLE IF NOT EXISTS Schema_Version(
+            version INT PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            duration NUMERIC
+        )
+"""
+
+# Version of the schema create_tables() builds, i.e. the latest migration in migrate.py.  Bump it
+# whenever a migration is added
+schema_version = 13
+
+# Functions maintaining the monthly partitions of the trade table
+partition_functions = [
+    # Creates the missing monthly partitions between two timestamps.  Rows that already landed in the
+    # default partition for a month are moved into the new partition before it's attached.  Months
+    # covered by another partition, i.e. the trade_legacy partition left by migrate.py, are skipped
+    """
+    CREATE OR REPLACE FUNCTION create_trade_partitions(from_ts TIMESTAMP, to_ts TIMESTAMP)
+    RETURNS INT AS $$
+    DECLARE
+        month_start TIMESTAMP := DATE_TRUNC('month', from_ts);
+        month_end TIMESTAMP;
+        partition_name TEXT;
+        created INT := 0;
+    BEGIN
+        WHILE month_start <= to_ts LOOP
+            month_end := month_start + INTERVAL '1 month';
+            partition_name := 'trade_' || TO_CHAR(month_start, 'YYYY_MM');
+            IF TO_REGCLASS(partition_name) IS NULL THEN
+                BEGIN
+                    EXECUTE 'CREATE TABLE ' || QUOTE_IDENT(partition_name) || ' (LIKE trade INCLUDING DEFAULTS)';
+                    EXECUTE 'WITH moved AS (DELETE FROM trade_default WHERE timestamp >= ' || QUOTE_LITERAL(month_start)
+                         || ' AND timestamp < ' || QUOTE_LITERAL(month_end) || ' RETURNING *) '
+                         || 'INSERT INTO ' || QUOTE_IDENT(partition_name) || ' SELECT * FROM moved';
+                    EXECUTE 'ALTER TABLE trade ATTACH PARTITION ' || QUOTE_IDENT(partition_name)
+                         || ' FOR VALUES FROM (' || QUOTE_LITERAL(month_start) || ') TO (' || QUOTE_LITERAL(month_end) || ')';
+                    created := created + 1;
+                EXCEPTION WHEN invalid_object_definition THEN
+                    -- The month is already covered by another partition i.e. trade_legacy
+                    NULL;
+                END;
+            END IF;
+            month_start := month_end;
+        END LOOP;
+        RETURN created;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    # Retention: drops the monthly partitions holding only trades older than before_ts
+    """
+    CREATE OR REPLACE FUNCTION drop_trade_partitions(before_ts TIMESTAMP)
+    RETURNS INT AS $$
+    DECLARE
+        partition_name TEXT;
+        dropped INT := 0;
+    BEGIN
+        FOR partition_name IN
+            SELECT c.relname
+            FROM pg_inherits i
+            INNER JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'trade'::REGCLASS
+            AND c.relname ~ '^trade_[0-9]{4}_[0-9]{2}$'
+            AND TO_DATE(SUBSTRING(c.relname FROM 7), 'YYYY_MM') + INTERVAL '1 month' <= before_ts
+        LOOP
+            EXECUTE 'DROP TABLE ' || QUOTE_IDENT(partition_name);
+            dropped := dropped + 1;
+        END LOOP;
+        RETURN dropped;
+    END;
+    $$ LANGUAGE plpgsql
+    """
+]
+
+
 def drop_tables():
     """ drop tables in the database"""
     drop_tbls = [
@@ -38,9 +142,18 @@ def drop_tables():
         DROP TABLE IF EXISTS Token;
         """,
         """
+        DROP VIEW IF EXISTS Token_Trait;
+        """,
+        """
         DROP TABLE IF EXISTS Token_Attribute;
         """,
         """
+        DROP TABLE IF EXISTS Trait;
+        """,
+        """
+        DROP TABLE IF EXISTS Token_Rarity;
+        """,
+        """
         DROP TABLE IF EXISTS Whale;
         """,
         """
@@ -54,7 +167,28 @@ def drop_tables():
         """,
         """
         DROP TABLE IF EXISTS data_analysis;
-        """        
+        """,
+        """
+        DROP TABLE IF EXISTS Collection_Daily;
+        """,
+        """
+        DROP TABLE IF EXISTS Collection_Exclusion;
+        """,
+        """
+        DROP TABLE IF EXISTS Watchlist_Collection;
+        """,
+        """
+        DROP TABLE IF EXISTS Etl_Run;
+        """,
+        """
+        DROP TABLE IF EXISTS Schema_Version;
+        """,
+        """
+        DROP TABLE IF EXISTS Contract_Dictionary;
+        """,
+        """
+        DROP TABLE IF EXISTS Token_Dictionary;
+        """
     ]
     try:
         with engine.connect() as conn:
@@ -77,6 +211,18 @@ def create_tables():
         )
         """,
         """
+        CREATE TABLE Contract_Dictionary(
+            contract_key SERIAL PRIMARY KEY,
+            contract_id VARCHAR NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE Token_Dictionary(
+            token_key BIGSERIAL PRIMARY KEY,
+            token_id VARCHAR NOT NULL UNIQUE
+        )
+        """,
+        """
         CREATE TABLE Collection(
             contract_id VARCHAR PRIMARY KEY,
             address VARCHAR,               
@@ -100,28 +246,45 @@ def create_tables():
         """,
         """
         CREATE TABLE Token(
-            token_id VARCHAR,
+            token_key BIGINT,
             id_num   VARCHAR,
             name VARCHAR,
             description VARCHAR,
-            contract_id VARCHAR,
+            contract_key INT,
             rarity_score NUMERIC,
             ranking INT
         )
         """,
         """
-        CREATE TABLE Token_Attribute(
-            token_id VARCHAR,
+        CREATE TABLE Trait(
+            trait_key SERIAL PRIMARY KEY,
+            contract_key INT NOT NULL,
+            trait_type VARCHAR,
+            value VARCHAR,
             overall_with_trait_value INT,
-            rarity_percentage NUMERIC,
+            rarity_percentage NUMERIC
+        )
+        """,
+        """
+        CREATE TABLE Token_Attribute(
+            token_key BIGINT,
             trait_type VARCHAR,
-            value VARCHAR
+            trait_key INT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE Token_Rarity(
+            token_id VARCHAR NOT NULL,
+            contract_id VARCHAR NOT NULL,
+            model VARCHAR NOT NULL,
+            score NUMERIC,
+            ranking INT
         )
         """,
         """
         CREATE TABLE Whale(
             wallet_id VARCHAR,
-            contract_id VARCHAR
+            contract_key INT
         )
         """,
         """
@@ -131,20 +294,9 @@ def create_tables():
             endpoint_url VARCHAR
         )
         """,
+        trade_table,
         """
-        CREATE TABLE Trade(
-            contract_id VARCHAR NOT NULL,
-            timestamp TIMESTAMP NOT NULL,
-            avg_price NUMERIC,
-            max_price NUMERIC,
-            min_price NUMERIC,
-            num_trades INT,
-            unique_buyers INT,
-            volume INT,
-            period VARCHAR,
-            type VARCHAR,
-            api_id VARCHAR
-        )
+        CREATE TABLE Trade_Default PARTITION OF Trade DEFAULT
         """,
         """
         CREATE TABLE Social_Media(
@@ -157,8 +309,25 @@ def create_tables():
         )
         """,
         """
-        CREATE TABLE Data_Analysis (
+        CREATE TABLE Collection_Daily(
             contract_id VARCHAR NOT NULL,
+            day TIMESTAMP NOT NULL,
+            total_volume BIGINT,
+            total_num_trades BIGINT,
+            total_unique_buyers BIGINT,
+            num_avg_prices INT,
+            sum_avg_price NUMERIC,
+            min_avg_price NUMERIC,
+            max_avg_price NUMERIC,
+            min_min_price NUMERIC,
+            max_min_price NUMERIC,
+            max_max_price NUMERIC,
+            PRIMARY KEY (contract_id, day)
+        )
+        """,
+        """
+        CREATE TABLE Data_Analysis (
+            contract_key INT NOT NULL,
             timestamp TIMESTAMP NOT NULL,
             percent_chg      NUMERIC,
             avg_percent_chg  NUMERIC,
@@ -169,6 +338,30 @@ def create_tables():
             beta             NUMERIC,
             whale_ratio      NUMERIC
         )
+        """,
+        token_trait_view,
+        """
+        CREATE TABLE Collection_Exclusion(
+            contract_id VARCHAR PRIMARY KEY,
+            reason VARCHAR NOT NULL,
+            manual BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """,
+        """
+        CREATE TABLE Watchlist_Collection(
+            watchlist VARCHAR NOT NULL,
+            contract_id VARCHAR NOT NULL,
+            manual BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (watchlist, contract_id)
+        )
+        """,
+        """
+        CREATE TABLE Etl_Run(
+            run_id SERIAL PRIMARY KEY,
+            started_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP,
+            failed BOOLEAN NOT NULL DEFAULT FALSE
+        )
         """
     ]
 
@@ -191,12 +384,16 @@ def add_constraints():
         """ ,        
         """
         ALTER TABLE Trade
-        ADD CONSTRAINT contract_timestamp UNIQUE (contract_id, timestamp);
+        ADD CONSTRAINT contract_timestamp UNIQUE (contract_key, timestamp);
         """,
         """
         ALTER TABLE Data_Analysis
-        ADD CONSTRAINT contract_timestamp_da UNIQUE (contract_id, timestamp);
-        """        
+        ADD CONSTRAINT contract_timestamp_da UNIQUE (contract_key, timestamp);
+        """,
+        """
+        ALTER TABLE Trait
+        ADD CONSTRAINT contract_trait_value UNIQUE NULLS NOT DISTINCT (contract_key, trait_type, value);
+        """
     ]
     try:
         with engine.connect() as conn:
@@ -213,12 +410,16 @@ def add_unique_indexes():
     unique_indexes = [
         """
         CREATE UNIQUE INDEX idx_token_collection
-        ON token (token_id, contract_id)
+        ON token (token_key, contract_key)
         """,
         """
         CREATE UNIQUE INDEX idx_token_trait
-        ON token_attribute (token_id, trait_type)
-        """    
+        ON token_attribute (token_key, trait_type) NULLS NOT DISTINCT
+        """,
+        """
+        CREATE UNIQUE INDEX idx_token_rarity_model
+        ON token_rarity (token_id, contract_id, model)
+        """
     ]
     try:
         with engine.connect() as conn:
@@ -230,6 +431,90 @@ def add_unique_indexes():
         logger.debug(unique_indexes)
         logger.exception(ex)
 
+def add_indexes():
+    """ add the indexes supporting the dashboard and analytics queries"""
+    indexes = [
+        # Trades are appended in time order, a BRIN index keeps time range scans cheap at a fraction of a btree's size
+        """
+        CREATE INDEX IF NOT EXISTS idx_trade_timestamp_brin
+        ON trade USING BRIN (timestamp)
+        """,
+        # Daily bucketing i.e. GROUP BY contract_key, DATE_TRUNC('day', timestamp)
+        """
+        CREATE INDEX IF NOT EXISTS idx_trade_contract_day
+        ON trade (contract_key, DATE_TRUNC('day', timestamp))
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_collection_network_name
+        ON collection (network_id, name)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_token_contract_ranking
+        ON token (contract_key, ranking)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_token_contract_rarity_score
+        ON token (contract_key, rarity_score)
+        """
+    ]
+    try:
+        with engine.connect() as conn:
+            # add indexes one by one
+            for index in indexes:
+                conn.execute(index)
+                logger.info(index + " Successfully Added!")
+            # Refresh the planner statistics so the new indexes are used right away
+            conn.execute("ANALYZE trade, collection, token")
+    except Exception as ex:
+        logger.debug(indexes)
+        logger.exception(ex)
+
+
+def create_partition_functions():
+    """ create the functions maintaining the monthly partitions of the trade table"""
+    try:
+        with engine.connect() as conn:
+            # create functions one by one
+            for func in partition_functions:
+                conn.execute(func)
+                logger.info(func + " Successfully Created!")
+    except Exception as ex:
+        logger.debug(partition_functions)
+        logger.exception(ex)
+
+
+def stamp_schema_version():
+    """ record every migration up to schema_version as applied, the tables were created at that version"""
+    stamp = """
+    INSERT INTO schema_version (version, description)
+    SELECT version, 'created by ddl.py' FROM generate_series(1, %(version)s) AS version
+    ON CONFLICT (version) DO NOTHING
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(schema_version_table)
+            conn.execute(stamp, {'version': schema_version})
+            logger.info(f"Schema version {schema_version} Successfully Recorded!")
+    except Exception as ex:
+        logger.debug(stamp)
+        logger.exception(ex)
+
+
+def add_trade_partitions(months_ahead=3):
+    """ create the trade partitions from the oldest trade up to months_ahead months from now"""
+    add_partitions = f"""
+    SELECT create_trade_partitions(
+        LEAST(COALESCE((SELECT MIN(timestamp) FROM trade), NOW()::TIMESTAMP), NOW()::TIMESTAMP),
+        NOW()::TIMESTAMP + INTERVAL '{int(months_ahead)} months')
+    """
+    try:
+        with engine.begin() as conn:
+            created = conn.execute(add_partitions).scalar()
+            logger.info(f"{created} trade partitions Successfully Created!")
+    except Exception as ex:
+        logger.debug(add_partitions)
+        logger.exception(ex)
+
 
 if __name__ == '__main__':
     try:
@@ -249,7 +534,17 @@ if __name__ == '__main__':
 
         # Add unique indexes to tables
         add_unique_indexes()
-        
+
+        # Add indexes supporting the query patterns
+        add_indexes()
+
+        # Create the trade partitions
+        create_partition_functions()
+        add_trade_partitions()
+
+        # The tables are at the latest schema version, record it for migrate.py
+        stamp_schema_version()
+
         # Display all table names in the database
         inspector = inspect(engine)
         database_tables = inspector.get_table_names(database_schema)
@@ -0,0 +1,996 @@
+# Import Libraries
+import os
+import time
+from datetime import timedelta
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+import logging
+
+
+# Get Logger
+logging.basicConfig(filename='migrate.log', filemode='a', level=logging.INFO, format='%(levelname)s: %(asctime)s - %(message)s')
+logger = logging.getLogger()
+
+# ddl holds the table and function definitions the migrations build on
+import ddl
+
+# Load .env environment variables
+load_dotenv()
+
+# Read in database settings
+database_connection_string = os.getenv("DATABASE_URI")
+
+# Create database connection
+engine = create_engine(database_connection_string)
+
+# Key of the advisory lock that keeps two runners from migrating the same database at once
+migration_lock_key = 4242001
+
+# Statements of an online migration step give up after waiting this long for a lock
+# instead of queueing the application's reads and writes behind them
+lock_timeout = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+
+
+"""
+
+    Migration steps
+
+    Every step is idempotent so a migration interrupted half way can simply be run again
+
+"""
+class Sql(object):
+    """ statements run in one transaction """
+
+    def __init__(self, *statements):
+        self.statements = statements
+
+    def run(self):
+        with engine.begin() as conn:
+            conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            for statement in self.statements:
+                conn.execute(statement)
+                logger.info(statement + " Successfully Applied!")
+
+
+class Concurrently(object):
+    """
+    A CREATE INDEX CONCURRENTLY statement.  It runs outside a transaction and doesn't block writes
+    while the index is built.  A failed build leaves an invalid index behind, which is dropped
+    before the build is retried
+    """
+
+    def __init__(self, index, statement):
+        self.index = index
+        self.statement = statement
+
+    def run(self):
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            create_index_concurrently(conn, self.index, self.statement)
+
+
+class Backfill(object):
+    """
+    A backfill run in batches, each batch in its own transaction so locks are held briefly and
+    progress survives an interruption.  key_query returns the keys to backfill, statement is run
+    with a batch of them as the keys parameter
+    """
+
+    def __init__(self, key_query, statement, batch_size=100, pause=0):
+        self.key_query = key_query
+        self.statement = statement
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def run(self):
+        with engine.connect() as conn:
+            keys = [row[0] for row in conn.execute(self.key_query)]
+        rows = 0
+        for i in range(0, len(keys), self.batch_size):
+            with engine.begin() as conn:
+                result = conn.execute(self.statement, {'keys': keys[i:i + self.batch_size]})
+                rows += max(result.rowcount, 0)
+            logger.info(f"backfilled {min(i + self.batch_size, len(keys))} of {len(keys)} keys, {rows} rows")
+            if self.pause:
+                time.sleep(self.pause)
+
+
+class PartitionedIndex(object):
+    """
+    An index built without blocking writes on a table that may be partitioned.  Postgres can't
+    build an index concurrently on a partitioned table, so the index is created on the parent only
+    (invalid until complete), built concurrently on every partition and attached partition by partition
+    """
+
+    def __init__(self, index, table, definition, unique=False):
+        self.index = index
+        self.table = table
+        self.definition = definition
+        self.unique = "UNIQUE " if unique else ""
+
+    def run(self):
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            relkind = conn.execute("SELECT relkind FROM pg_class WHERE oid = TO_REGCLASS(%(table)s)", {'table': self.table}).scalar()
+            if relkind != 'p':
+                create_index_concurrently(conn, self.index, f"CREATE {self.unique}INDEX CONCURRENTLY IF NOT EXISTS {self.index} ON {self.table} {self.definition}")
+                return
+            if index_state(conn, self.index) is not None:
+                logger.info(f"{self.index} already exists")
+                return
+            conn.execute(f"CREATE {self.unique}INDEX IF NOT EXISTS {self.index}_parent ON ONLY {self.table} {self.definition}")
+            partitions = [row[0] for row in conn.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            INNER JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = TO_REGCLASS(%(table)s)
+            ORDER BY c.relname
+            """, {'table': self.table})]
+            # The partition indexes are named after the partition, i.e. idx_trade_contract_day on trade_2022_01 is trade_2022_01_contract_day
+            suffix = self.index[len(f"idx_{self.table}_"):] if self.index.startswith(f"idx_{self.table}_") else self.index
+            for partition in partitions:
+                partition_index = f"{partition}_{suffix}"[:63]
+                create_index_concurrently(conn, partition_index, f"CREATE {self.unique}INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition} {self.definition}")
+                conn.execute(f"ALTER INDEX {self.index}_parent ATTACH PARTITION {partition_index}")
+            # The parent index only becomes valid once every partition is attached
+            conn.execute(f"ALTER INDEX {self.index}_parent RENAME TO {self.index}")
+            logger.info(f"{self.index} Successfully Added on {len(partitions)} partitions!")
+
+
+class Python(object):
+    """ a function called with the engine, for steps that need to look at the database first """
+
+    def __init__(self, func):
+        self.func = func
+
+    def run(self):
+        self.func(engine)
+
+
+def index_state(conn, index):
+    """
+    This function returns whether an index is valid
+
+    Args: conn - database connection
+          index - name of the index
+    Returns: True when valid, False when invalid, None when the index doesn't exist
+    """
+    return conn.execute("""
+    SELECT i.indisvalid
+    FROM pg_index i
+    WHERE i.indexrelid = TO_REGCLASS(%(index)s)
+    """, {'index': index}).scalar()
+
+
+def create_index_concurrently(conn, index, statement):
+    """
+    This function builds an index concurrently, dropping the invalid leftover of an earlier failed build first
+
+    Args: conn - autocommit database connection
+          index - name of the index
+          statement - CREATE INDEX CONCURRENTLY IF NOT EXISTS statement
+    """
+    if index_state(conn, index) is False:
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+        logger.info(f"Dropped invalid index {index}")
+    conn.execute(statement)
+    logger.info(statement + " Successfully Applied!")
+
+
+"""
+
+    Online steps
+
+"""
+def create_baseline(engine):
+    """ create the complete schema with ddl.py on an empty database """
+    with engine.connect() as conn:
+        if conn.execute("SELECT TO_REGCLASS('trade') IS NOT NULL").scalar():
+            logger.info("Existing database, baseline schema already in place")
+            return
+    ddl.create_tables()
+    ddl.add_constraints()
+    ddl.add_unique_indexes()
+    ddl.add_indexes()
+    ddl.create_partition_functions()
+    ddl.add_trade_partitions()
+    # ddl.py creates the latest schema, so every migration is recorded as applied
+    ddl.stamp_schema_version()
+
+
+# The trade table as migration 3 partitions it, before migration 6 replaced contract_id by contract_key
+trade_table_v3 = """
+        CREATE TABLE Trade(
+            contract_id VARCHAR NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            avg_price NUMERIC,
+            max_price NUMERIC,
+            min_price NUMERIC,
+            num_trades INT,
+            unique_buyers INT,
+            volume INT,
+            period VARCHAR,
+            type VARCHAR,
+            api_id VARCHAR
+        ) PARTITION BY RANGE (timestamp)
+"""
+
+
+def attach_trade_partitions(engine):
+    """
+    This function turns an existing, unpartitioned trade table into the partitioned trade table
+    without copying it.  The old table is kept as one partition holding all trades up to the next
+    monthly partition boundary and new monthly partitions are created from there on, split_trade_legacy()
+    then copies its trades into monthly partitions in batches and swaps them in.  A validated
+    CHECK constraint lets the old table be attached without a scan, so the only exclusive lock is
+    held for the renames and the attach, which take milliseconds
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        relkind = conn.execute("SELECT relkind FROM pg_class WHERE oid = TO_REGCLASS('trade')").scalar()
+        if relkind != 'r':
+            logger.info("trade is already partitioned")
+            return
+        # A constraint validated by an interrupted run is kept, an unvalidated one is replaced
+        validated = conn.execute("SELECT convalidated FROM pg_constraint WHERE conname = 'trade_legacy_range'").scalar()
+        if validated:
+            boundary = conn.execute("""
+            SELECT (REGEXP_MATCH(PG_GET_CONSTRAINTDEF(oid), '''(.*)'''))[1]::TIMESTAMP
+            FROM pg_constraint WHERE conname = 'trade_legacy_range'
+            """).scalar()
+        else:
+            # Every trade so far, and trades arriving while the migration runs, fall below the boundary
+            boundary = conn.execute("""
+            SELECT GREATEST(DATE_TRUNC('month', NOW()::TIMESTAMP) + INTERVAL '2 months',
+                            DATE_TRUNC('month', MAX(timestamp)) + INTERVAL '1 month')
+            FROM trade
+            """).scalar()
+            conn.execute(f"SET lock_timeout = '{lock_timeout}'")
+            conn.execute("ALTER TABLE trade DROP CONSTRAINT IF EXISTS trade_legacy_range")
+            conn.execute("ALTER TABLE trade ADD CONSTRAINT trade_legacy_range CHECK (timestamp < %(boundary)s) NOT VALID", {'boundary': boundary})
+        # Validation scans the table but only takes a lock that doesn't block reads and writes
+        conn.execute("ALTER TABLE trade VALIDATE CONSTRAINT trade_legacy_range")
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        conn.execute("ALTER TABLE trade RENAME TO trade_legacy")
+        # Keep the index names of the old table for its partition of the partitioned indexes
+        conn.execute("ALTER INDEX IF EXISTS idx_trade_timestamp_brin RENAME TO trade_legacy_timestamp_brin")
+        conn.execute("ALTER INDEX IF EXISTS idx_trade_contract_day RENAME TO trade_legacy_contract_day")
+        conn.execute(trade_table_v3)
+        conn.execute("ALTER TABLE trade ADD CONSTRAINT trade_contract_timestamp UNIQUE (contract_id, timestamp)")
+        conn.execute("ALTER TABLE trade ATTACH PARTITION trade_legacy FOR VALUES FROM (MINVALUE) TO (%(boundary)s)", {'boundary': boundary})
+        conn.execute("CREATE TABLE trade_default PARTITION OF trade DEFAULT")
+        conn.execute("SELECT create_trade_partitions(%(boundary)s, GREATEST(%(boundary)s, NOW()::TIMESTAMP + INTERVAL '3 months'))", {'boundary': boundary})
+    logger.info(f"trade Successfully Partitioned, trades before {boundary} stay in trade_legacy")
+
+
+def split_trade_legacy(engine, batch_size=10000):
+    """
+    This function splits the trade_legacy partition left by attach_trade_partitions() into monthly
+    partitions, so new trades land in the monthly partitions, retention can drop old months and scans
+    only read the months they need, without blocking the application while the trades are moved:
+
+    - the monthly partitions from the oldest legacy month up to its upper bound are created as the
+      partitions of a trade_split staging table, each with a NOT VALID CHECK on its month
+    - a trigger on trade_legacy mirrors the trades written while the split runs into trade_split
+    - the legacy trades are copied in batches, each in its own transaction, while trade_legacy stays
+      attached and serves reads and writes
+    - the CHECK constraints are validated, which doesn't block reads or writes
+    - one short transaction swaps the monthly partitions for trade_legacy.  The validated CHECKs let
+      them be attached without a scan and their indexes are adopted, so the exclusive lock is only
+      held for catalog changes
+
+    trade_legacy can't be detached CONCURRENTLY, Postgres doesn't allow it while trade has a default
+    partition.  Until the swap the legacy trades are stored twice.  An interrupted split carries on
+    where it stopped, the copy skips the trades already copied
+    """
+    with engine.connect() as conn:
+        boundary = conn.execute("""
+        SELECT (REGEXP_MATCH(PG_GET_EXPR(c.relpartbound, c.oid), 'TO \\(''(.*)''\\)'))[1]::TIMESTAMP
+        FROM pg_class c
+        WHERE c.oid = TO_REGCLASS('trade_legacy') AND c.relispartition
+        """).scalar()
+        if boundary is None:
+            logger.info("trade has no trade_legacy partition to split")
+            return
+        first_month = conn.execute("SELECT DATE_TRUNC('month', MIN(timestamp)) FROM trade_legacy").scalar()
+        columns = [row[0] for row in conn.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = TO_REGCLASS('trade') AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+        """)]
+        # An empty trade_legacy is dropped, the monthly partitions then start at the current month
+        if first_month is None:
+            first_month = min(conn.execute("SELECT DATE_TRUNC('month', NOW()::TIMESTAMP)").scalar(), boundary)
+    months = []
+    month = first_month
+    while month < boundary:
+        months.append(month)
+        month = (month + timedelta(days=32)).replace(day=1)
+    column_list = ", ".join(columns)
+
+    # The monthly partitions, staged as partitions of trade_split so the copied trades are routed to their month
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(f"SET lock_timeout = '{lock_timeout}'")
+        conn.execute("CREATE TABLE IF NOT EXISTS trade_split (LIKE trade INCLUDING DEFAULTS INCLUDING INDEXES) PARTITION BY RANGE (timestamp)")
+        for month, next_month in zip(months, months[1:] + [boundary]):
+            partition = f"trade_{month:%Y_%m}"
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF trade_split FOR VALUES FROM (%(month)s) TO (%(next_month)s)",
+                         {'month': month, 'next_month': next_month})
+            conn.execute(f"ALTER TABLE {partition} DROP CONSTRAINT IF EXISTS {partition}_range")
+            conn.execute(f"ALTER TABLE {partition} ADD CONSTRAINT {partition}_range CHECK (timestamp >= %(month)s AND timestamp < %(next_month)s) NOT VALID",
+                         {'month': month, 'next_month': next_month})
+        conn.execute(f"""
+        CREATE OR REPLACE FUNCTION trade_split_mirror() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM trade_split WHERE contract_key = OLD.contract_key AND timestamp = OLD.timestamp;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO trade_split ({column_list}) VALUES ({", ".join(f"NEW.{column}" for column in columns)})
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """)
+        conn.execute("DROP TRIGGER IF EXISTS trade_split_mirror ON trade_legacy")
+        conn.execute("""
+        CREATE TRIGGER trade_split_mirror AFTER INSERT OR UPDATE OR DELETE ON trade_legacy
+        FOR EACH ROW EXECUTE FUNCTION trade_split_mirror()
+        """)
+
+    # Copy the legacy trades in key order.  The copied trades are locked until their batch commits, so a trade
+    # deleted meanwhile is removed from trade_split by the trigger after it was copied
+    copy_batch = f"""
+    WITH batch AS (
+        SELECT {column_list} FROM trade_legacy
+        WHERE (contract_key, timestamp) > (%(contract_key)s, %(timestamp)s)
+        ORDER BY contract_key, timestamp
+        LIMIT %(batch_size)s
+        FOR SHARE
+    ), copied AS (
+        INSERT INTO trade_split ({column_list}) SELECT {column_list} FROM batch ON CONFLICT DO NOTHING
+    )
+    SELECT contract_key, timestamp, COUNT(*) OVER () FROM batch ORDER BY contract_key DESC, timestamp DESC LIMIT 1
+    """
+    last_key = {'contract_key': -2147483648, 'timestamp': '-infinity', 'batch_size': batch_size}
+    copied = 0
+    while True:
+        with engine.begin() as conn:
+            row = conn.execute(copy_batch, last_key).fetchone()
+        if row is None:
+            break
+        last_key.update(contract_key=row[0], timestamp=row[1])
+        copied += row[2]
+        logger.info(f"copied {copied} trades out of trade_legacy")
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for month in months:
+            conn.execute(f"ALTER TABLE trade_{month:%Y_%m} VALIDATE CONSTRAINT trade_{month:%Y_%m}_range")
+
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        conn.execute("ALTER TABLE trade DETACH PARTITION trade_legacy")
+        for month, next_month in zip(months, months[1:] + [boundary]):
+            conn.execute(f"ALTER TABLE trade_split DETACH PARTITION trade_{month:%Y_%m}")
+            conn.execute(f"ALTER TABLE trade ATTACH PARTITION trade_{month:%Y_%m} FOR VALUES FROM (%(month)s) TO (%(next_month)s)",
+                         {'month': month, 'next_month': next_month})
+        conn.execute("DROP TABLE trade_legacy")
+        conn.execute("DROP TABLE trade_split")
+        conn.execute("DROP FUNCTION trade_split_mirror()")
+    logger.info(f"trade_legacy Successfully Split into {len(months)} monthly partitions!")
+
+
+"""
+
+    Integer surrogate keys (migration 6)
+
+    The contract and token ids of the hot tables are replaced by integer keys from the dictionary
+    tables.  The key columns are added next to the id columns and kept filled by triggers while
+    the existing rows are backfilled in batches, the new indexes are built concurrently and the id
+    columns are only dropped at the end, in one short transaction
+
+"""
+# Id columns replaced by an integer key: table -> [(id column, key column, key type, dictionary table)]
+key_columns_v6 = {
+    'trade':           [('contract_id', 'contract_key', 'INT', 'contract_dictionary')],
+    'token':           [('token_id', 'token_key', 'BIGINT', 'token_dictionary'), ('contract_id', 'contract_key', 'INT', 'contract_dictionary')],
+    'token_attribute': [('token_id', 'token_key', 'BIGINT', 'token_dictionary')],
+    'data_analysis':   [('contract_id', 'contract_key', 'INT', 'contract_dictionary')],
+    'whale':           [('contract_id', 'contract_key', 'INT', 'contract_dictionary')],
+}
+
+# Tables whose key column is NOT NULL like the id column it replaces
+not_null_v6 = ['trade', 'data_analysis']
+
+# Final names of the indexes built on the key columns, each replaces the index of the same name on the id columns
+key_indexes_v6 = ['contract_timestamp', 'idx_trade_contract_day', 'idx_token_collection', 'idx_token_contract_ranking',
+                  'idx_token_contract_rarity_score', 'idx_token_trait', 'contract_timestamp_da']
+
+# Triggers filling the key columns from the id columns written while the migration runs
+key_trigger_functions_v6 = [
+    """
+    CREATE OR REPLACE FUNCTION fill_contract_key() RETURNS TRIGGER AS $$
+    BEGIN
+        IF NEW.contract_id IS NOT NULL THEN
+            INSERT INTO contract_dictionary (contract_id) VALUES (NEW.contract_id) ON CONFLICT (contract_id) DO NOTHING;
+            SELECT contract_key INTO NEW.contract_key FROM contract_dictionary WHERE contract_id = NEW.contract_id;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION fill_token_key() RETURNS TRIGGER AS $$
+    BEGIN
+        IF NEW.token_id IS NOT NULL THEN
+            INSERT INTO token_dictionary (token_id) VALUES (NEW.token_id) ON CONFLICT (token_id) DO NOTHING;
+            SELECT token_key INTO NEW.token_key FROM token_dictionary WHERE token_id = NEW.token_id;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """
+]
+
+
+def column_exists(conn, table, column):
+    """
+    This function returns whether a table has a column
+
+    Args: conn - database connection
+          table - name of the table
+          column - name of the column
+    Returns: Boolean
+    """
+    return conn.execute("""
+    SELECT COUNT(*) FROM pg_attribute
+    WHERE attrelid = TO_REGCLASS(%(table)s) AND attname = %(column)s AND NOT attisdropped
+    """, {'table': table, 'column': column}).scalar() > 0
+
+
+def add_key_columns(engine):
+    """ add the key columns and the triggers keeping them filled, adding a column without a default doesn't rewrite the table """
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        for table, columns in key_columns_v6.items():
+            for id_column, key_column, key_type, dictionary in columns:
+                if not column_exists(conn, table, id_column):
+                    continue
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {key_column} {key_type}")
+                conn.execute(f"DROP TRIGGER IF EXISTS fill_{key_column} ON {table}")
+                conn.execute(f"""
+                CREATE TRIGGER fill_{key_column} BEFORE INSERT OR UPDATE OF {id_column} ON {table}
+                FOR EACH ROW EXECUTE FUNCTION fill_{key_column}()
+                """)
+                logger.info(f"{table}.{key_column} Successfully Added!")
+
+
+def backfill_key_columns(engine):
+    """ add every id to its dictionary and fill the key columns of the existing rows in batches """
+    for table, columns in key_columns_v6.items():
+        for id_column, key_column, key_type, dictionary in columns:
+            with engine.begin() as conn:
+                if not column_exists(conn, table, id_column):
+                    continue
+                conn.execute(f"""
+                INSERT INTO {dictionary} ({id_column})
+                SELECT DISTINCT {id_column} FROM {table} WHERE {id_column} IS NOT NULL
+                ORDER BY {id_column}
+                ON CONFLICT ({id_column}) DO NOTHING
+                """)
+            logger.info(f"Backfilling {table}.{key_column}")
+            Backfill(f"SELECT DISTINCT {id_column} FROM {table} WHERE {key_column} IS NULL AND {id_column} IS NOT NULL", f"""
+            UPDATE {table} t
+            SET {key_column} = d.{key_column}
+            FROM {dictionary} d
+            WHERE d.{id_column} = ANY(%(keys)s)
+            AND t.{id_column} = d.{id_column}
+            AND t.{key_column} IS NULL
+            """, batch_size=10000 if key_column == 'token_key' else 100).run()
+
+
+def validate_key_columns(engine):
+    """
+    This function checks the key columns that become NOT NULL with a validated CHECK constraint, so
+    SET NOT NULL doesn't need to scan the tables while holding an exclusive lock
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(f"SET lock_timeout = '{lock_timeout}'")
+        for table in not_null_v6:
+            id_column, key_column, key_type, dictionary = key_columns_v6[table][0]
+            if not column_exists(conn, table, id_column):
+                continue
+            conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{key_column}_not_null")
+            conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_{key_column}_not_null CHECK ({key_column} IS NOT NULL) NOT VALID")
+            # Validation scans the table but only takes a lock that doesn't block reads and writes
+            conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{key_column}_not_null")
+
+
+def swap_key_columns(engine):
+    """
+    This function drops the id columns, which drops the indexes and constraints on them too, and
+    gives the indexes on the key columns their final names.  Dropping a column only updates the
+    catalog so the exclusive locks are held for milliseconds
+    """
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        for table, columns in key_columns_v6.items():
+            for id_column, key_column, key_type, dictionary in columns:
+                conn.execute(f"DROP TRIGGER IF EXISTS fill_{key_column} ON {table}")
+                conn.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {id_column}")
+        for table in not_null_v6:
+            key_column = key_columns_v6[table][0][1]
+            conn.execute(f"ALTER TABLE {table} ALTER COLUMN {key_column} SET NOT NULL")
+            conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{key_column}_not_null")
+        for index in key_indexes_v6:
+            if index_state(conn, index) is None:
+                conn.execute(f"ALTER INDEX IF EXISTS {index}_new RENAME TO {index}")
+            else:
+                conn.execute(f"DROP INDEX IF EXISTS {index}_new")
+        conn.execute("DROP FUNCTION IF EXISTS fill_contract_key(), fill_token_key()")
+    logger.info("contract and token ids Successfully Replaced by integer keys!")
+
+
+"""
+
+    Trait dictionary (migration 7)
+
+    The trait type, value and rarity statistics repeated on every token_attribute row are moved to
+    the trait table, one row per trait of a collection, and token_attribute keeps the trait_key.
+    Like migration 6 the key column is kept filled by a trigger while the existing rows are
+    backfilled in batches, and the old columns are dropped at the end in one short transaction
+
+"""
+# Columns of token_attribute moved to the trait table
+trait_columns_v7 = ['trait_type', 'value', 'overall_with_trait_value', 'rarity_percentage']
+
+# Trigger filling trait_key from the trait columns written while the migration runs
+trait_trigger_function_v7 = """
+    CREATE OR REPLACE FUNCTION fill_trait_key() RETURNS TRIGGER AS $$
+    DECLARE
+        token_contract_key INT;
+    BEGIN
+        SELECT contract_key INTO token_contract_key FROM token WHERE token_key = NEW.token_key LIMIT 1;
+        IF token_contract_key IS NOT NULL THEN
+            INSERT INTO trait (contract_key, trait_type, value, overall_with_trait_value, rarity_percentage)
+            VALUES (token_contract_key, NEW.trait_type, NEW.value, NEW.overall_with_trait_value, NEW.rarity_percentage)
+            ON CONFLICT (contract_key, trait_type, value) DO UPDATE
+            SET overall_with_trait_value = EXCLUDED.overall_with_trait_value,
+                rarity_percentage = EXCLUDED.rarity_percentage
+            RETURNING trait_key INTO NEW.trait_key;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def add_trait_key(engine):
+    """ add token_attribute.trait_key and the trigger keeping it filled """
+    with engine.begin() as conn:
+        if not column_exists(conn, 'token_attribute', 'trait_type'):
+            return
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        conn.execute("ALTER TABLE token_attribute ADD COLUMN IF NOT EXISTS trait_key INT")
+        conn.execute("DROP TRIGGER IF EXISTS fill_trait_key ON token_attribute")
+        conn.execute(f"""
+        CREATE TRIGGER fill_trait_key BEFORE INSERT OR UPDATE OF token_key, {", ".join(trait_columns_v7)} ON token_attribute
+        FOR EACH ROW EXECUTE FUNCTION fill_trait_key()
+        """)
+        logger.info("token_attribute.trait_key Successfully Added!")
+
+
+def backfill_trait_keys(engine):
+    """ fill the trait table collection by collection, then the trait_key of the existing token attributes in batches """
+    with engine.connect() as conn:
+        if not column_exists(conn, 'token_attribute', 'trait_type'):
+            return
+    logger.info("Backfilling trait")
+    Backfill("SELECT DISTINCT contract_key FROM token WHERE contract_key IS NOT NULL ORDER BY contract_key", """
+    INSERT INTO trait (contract_key, trait_type, value, overall_with_trait_value, rarity_percentage)
+    SELECT DISTINCT ON (t.contract_key, ta.trait_type, ta.value)
+           t.contract_key, ta.trait_type, ta.value, ta.overall_with_trait_value, ta.rarity_percentage
+    FROM token_attribute ta
+    INNER JOIN token t ON t.token_key = ta.token_key
+    WHERE t.contract_key = ANY(%(keys)s)
+    ORDER BY t.contract_key, ta.trait_type, ta.value
+    ON CONFLICT (contract_key, trait_type, value) DO NOTHING
+    """).run()
+    logger.info("Backfilling token_attribute.trait_key")
+    Backfill("SELECT DISTINCT token_key FROM token_attribute WHERE trait_key IS NULL", """
+    UPDATE token_attribute ta
+    SET trait_key = tr.trait_key
+    FROM token t, trait tr
+    WHERE ta.token_key = ANY(%(keys)s)
+    AND ta.trait_key IS NULL
+    AND t.token_key = ta.token_key
+    AND tr.contract_key = t.contract_key
+    AND tr.trait_type IS NOT DISTINCT FROM ta.trait_type
+    AND tr.value IS NOT DISTINCT FROM ta.value
+    """, batch_size=10000).run()
+
+
+def validate_trait_key(engine):
+    """
+    This function removes the attributes of tokens missing from the token table, whose collection and
+    so trait is unknown, and checks trait_key with a validated CHECK constraint so SET NOT NULL doesn't
+    need to scan token_attribute while holding an exclusive lock
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not column_exists(conn, 'token_attribute', 'trait_type'):
+            return
+        result = conn.execute("DELETE FROM token_attribute WHERE trait_key IS NULL")
+        logger.info(f"Deleted {result.rowcount} attributes of unknown tokens")
+        conn.execute(f"SET lock_timeout = '{lock_timeout}'")
+        conn.execute("ALTER TABLE token_attribute DROP CONSTRAINT IF EXISTS token_attribute_trait_key_not_null")
+        conn.execute("ALTER TABLE token_attribute ADD CONSTRAINT token_attribute_trait_key_not_null CHECK (trait_key IS NOT NULL) NOT VALID")
+        conn.execute("ALTER TABLE token_attribute VALIDATE CONSTRAINT token_attribute_trait_key_not_null")
+
+
+def swap_trait_columns(engine):
+    """
+    This function drops the trait columns of token_attribute, which drops the old idx_token_trait too,
+    gives the index on trait_key its final name and creates the token_trait view reading the attributes
+    with their trait
+    """
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        conn.execute("DROP TRIGGER IF EXISTS fill_trait_key ON token_attribute")
+        for column in trait_columns_v7:
+            conn.execute(f"ALTER TABLE token_attribute DROP COLUMN IF EXISTS {column}")
+        conn.execute("ALTER TABLE token_attribute ALTER COLUMN trait_key SET NOT NULL")
+        conn.execute("ALTER TABLE token_attribute DROP CONSTRAINT IF EXISTS token_attribute_trait_key_not_null")
+        if index_state(conn, 'idx_token_trait') is None:
+            conn.execute("ALTER INDEX IF EXISTS idx_token_trait_new RENAME TO idx_token_trait")
+        else:
+            conn.execute("DROP INDEX IF EXISTS idx_token_trait_new")
+        conn.execute("DROP VIEW IF EXISTS token_trait")
+        conn.execute(ddl.token_trait_view)
+        conn.execute("DROP FUNCTION IF EXISTS fill_trait_key()")
+    logger.info("token attributes Successfully Moved to the trait table!")
+
+
+"""
+
+    One attribute per trait type (migration 13)
+
+    token_attribute was keyed on (token_key, trait_key), so a token whose trait changed value got a
+    second row for the same trait type.  token_attribute gets the trait_type of its trait, kept filled
+    by a trigger while the existing rows are backfilled, the older duplicates are removed and the
+    unique index moves to (token_key, trait_type)
+
+"""
+# Trigger filling trait_type from the trait of the rows written while the migration runs
+trait_type_trigger_function_v13 = """
+    CREATE OR REPLACE FUNCTION fill_attribute_trait_type() RETURNS TRIGGER AS $$
+    BEGIN
+        SELECT trait_type INTO NEW.trait_type FROM trait WHERE trait_key = NEW.trait_key;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def add_attribute_trait_type(engine):
+    """ add token_attribute.trait_type and the trigger keeping it filled """
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        conn.execute("ALTER TABLE token_attribute ADD COLUMN IF NOT EXISTS trait_type VARCHAR")
+        conn.execute(trait_type_trigger_function_v13)
+        conn.execute("DROP TRIGGER IF EXISTS fill_attribute_trait_type ON token_attribute")
+        conn.execute("""
+        CREATE TRIGGER fill_attribute_trait_type BEFORE INSERT OR UPDATE OF trait_key ON token_attribute
+        FOR EACH ROW EXECUTE FUNCTION fill_attribute_trait_type()
+        """)
+        logger.info("token_attribute.trait_type Successfully Added!")
+
+
+def swap_attribute_trait_index(engine):
+    """
+    This function replaces idx_token_trait on (token_key, trait_key) by the one on (token_key, trait_type)
+    and drops the trigger, the ETL writes trait_type itself from now on
+    """
+    with engine.begin() as conn:
+        conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        conn.execute("DROP TRIGGER IF EXISTS fill_attribute_trait_type ON token_attribute")
+        conn.execute("DROP FUNCTION IF EXISTS fill_attribute_trait_type()")
+        if index_state(conn, 'idx_token_trait_new') is not None:
+            conn.execute("DROP INDEX IF EXISTS idx_token_trait")
+            conn.execute("ALTER INDEX idx_token_trait_new RENAME TO idx_token_trait")
+    logger.info("token_attribute Successfully Keyed on (token_key, trait_type)!")
+
+
+"""
+
+    Migrations, in the order they are applied.  Append new migrations at the end, never edit one
+    that has been released
+
+"""
+migrations = [
+    (1, "baseline schema", [
+        Python(create_baseline)
+    ]),
+    (2, "token_rarity table", [
+        Sql("""
+        CREATE TABLE IF NOT EXISTS Token_Rarity(
+            token_id VARCHAR NOT NULL,
+            contract_id VARCHAR NOT NULL,
+            model VARCHAR NOT NULL,
+            score NUMERIC,
+            ranking INT
+        )
+        """),
+        Concurrently('idx_token_rarity_model', """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_token_rarity_model
+        ON token_rarity (token_id, contract_id, model)
+        """)
+    ]),
+    (3, "trade partitioned by month", [
+        Sql(*ddl.partition_functions),
+        Python(attach_trade_partitions)
+    ]),
+    (4, "dashboard and analytics indexes", [
+        PartitionedIndex('idx_trade_timestamp_brin', 'trade', "USING BRIN (timestamp)"),
+        PartitionedIndex('idx_trade_contract_day', 'trade', "(contract_id, DATE_TRUNC('day', timestamp))"),
+        Concurrently('idx_collection_network_name', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_collection_network_name
+        ON collection (network_id, name)
+        """),
+        Concurrently('idx_token_contract_ranking', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_token_contract_ranking
+        ON token (contract_id, ranking)
+        """),
+        Concurrently('idx_token_contract_rarity_score', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_token_contract_rarity_score
+        ON token (contract_id, rarity_score)
+        """),
+        Sql("ANALYZE trade, collection, token")
+    ]),
+    (5, "collection_daily rollup", [
+        Sql("""
+        CREATE TABLE IF NOT EXISTS Collection_Daily(
+            contract_id VARCHAR NOT NULL,
+            day TIMESTAMP NOT NULL,
+            total_volume BIGINT,
+            total_num_trades BIGINT,
+            total_unique_buyers BIGINT,
+            num_avg_prices INT,
+            sum_avg_price NUMERIC,
+            min_avg_price NUMERIC,
+            max_avg_price NUMERIC,
+            min_min_price NUMERIC,
+            max_min_price NUMERIC,
+            max_max_price NUMERIC,
+            PRIMARY KEY (contract_id, day)
+        )
+        """),
+        Backfill("SELECT contract_id FROM collection ORDER BY contract_id", """
+        INSERT INTO collection_daily
+        SELECT t.contract_id, DATE_TRUNC('day', t.timestamp) AS day,
+               SUM(t.volume), SUM(t.num_trades), SUM(t.unique_buyers),
+               COUNT(t.avg_price), SUM(t.avg_price), MIN(t.avg_price), MAX(t.avg_price),
+               MIN(t.min_price), MAX(t.min_price), MAX(t.max_price)
+        FROM trade t
+        WHERE t.contract_id = ANY(%(keys)s)
+        GROUP BY t.contract_id, DATE_TRUNC('day', t.timestamp)
+        ON CONFLICT (contract_id, day) DO NOTHING
+        """)
+    ]),
+    (6, "integer surrogate keys for contract and token ids", [
+        Sql("""
+        CREATE TABLE IF NOT EXISTS Contract_Dictionary(
+            contract_key SERIAL PRIMARY KEY,
+            contract_id VARCHAR NOT NULL UNIQUE
+        )
+        """, """
+        CREATE TABLE IF NOT EXISTS Token_Dictionary(
+            token_key BIGSERIAL PRIMARY KEY,
+            token_id VARCHAR NOT NULL UNIQUE
+        )
+        """, *key_trigger_functions_v6),
+        Python(add_key_columns),
+        Python(backfill_key_columns),
+        PartitionedIndex('contract_timestamp_new', 'trade', "(contract_key, timestamp)", unique=True),
+        PartitionedIndex('idx_trade_contract_day_new', 'trade', "(contract_key, DATE_TRUNC('day', timestamp))"),
+        Concurrently('idx_token_collection_new', """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_token_collection_new
+        ON token (token_key, contract_key)
+        """),
+        Concurrently('idx_token_contract_ranking_new', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_token_contract_ranking_new
+        ON token (contract_key, ranking)
+        """),
+        Concurrently('idx_token_contract_rarity_score_new', """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_token_contract_rarity_score_new
+        ON token (contract_key, rarity_score)
+        """),
+        Concurrently('idx_token_trait_new', """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_token_trait_new
+        ON token_attribute (token_key, trait_type)
+        """),
+        Concurrently('contract_timestamp_da_new', """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS contract_timestamp_da_new
+        ON data_analysis (contract_key, timestamp)
+        """),
+        Python(validate_key_columns),
+        Python(swap_key_columns),
+        Sql("ANALYZE trade, token, token_attribute, data_analysis, whale")
+    ]),
+    (7, "trait dictionary for token attributes", [
+        Sql("""
+        CREATE TABLE IF NOT EXISTS Trait(
+            trait_key SERIAL PRIMARY KEY,
+            contract_key INT NOT NULL,
+            trait_type VARCHAR,
+            value VARCHAR,
+            overall_with_trait_value INT,
+            rarity_percentage NUMERIC,
+            CONSTRAINT contract_trait_value UNIQUE NULLS NOT DISTINCT (contract_key, trait_type, value)
+        )
+        """, trait_trigger_function_v7),
+        Python(add_trait_key),
+        Python(backfill_trait_keys),
+        Concurrently('idx_token_trait_new', """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_token_trait_new
+        ON token_attribute (token_key, trait_key)
+        """),
+        Python(validate_trait_key),
+        Python(swap_trait_columns),
+        Sql("ANALYZE trait, token_attribute")
+    ]),
+    # The ETL fills both tables from the rules in db_utils, see refresh_collection_lists()
+    (8, "collection exclusions and watchlists", [
+        Sql("""
+        CREATE TABLE IF NOT EXISTS Collection_Exclusion(
+            contract_id VARCHAR PRIMARY KEY,
+            reason VARCHAR NOT NULL,
+            manual BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """, """
+        CREATE TABLE IF NOT EXISTS Watchlist_Collection(
+            watchlist VARCHAR NOT NULL,
+            contract_id VARCHAR NOT NULL,
+            manual BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (watchlist, contract_id)
+        )
+        """)
+    ]),
+    (9, "ETL run table", [
+        Sql("""
+        CREATE TABLE IF NOT EXISTS Etl_Run(
+            run_id SERIAL PRIMARY KEY,
+            started_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP
+        )
+        """)
+    ]),
+    (10, "ETL run failure flag", [
+        Sql("ALTER TABLE etl_run ADD COLUMN IF NOT EXISTS failed BOOLEAN NOT NULL DEFAULT FALSE")
+    ]),
+    (11, "drop the token trades from the collection_daily rollup", [
+        Sql("""
+        DELETE FROM collection_daily d
+        USING (SELECT DISTINCT k.contract_id
+               FROM trade t
+               INNER JOIN contract_dictionary k ON k.contract_key = t.contract_key
+               WHERE t.type = 'token') AS tokens
+        WHERE d.contract_id = tokens.contract_id
+        """)
+    ]),
+    (12, "split trade_legacy into monthly partitions", [
+        Python(split_trade_legacy)
+    ]),
+    (13, "one token attribute per trait type", [
+        Python(add_attribute_trait_type),
+        Backfill("SELECT DISTINCT token_key FROM token_attribute WHERE trait_type IS NULL", """
+        UPDATE token_attribute ta
+        SET trait_type = tr.trait_type
+        FROM trait tr
+        WHERE ta.token_key = ANY(%(keys)s)
+        AND ta.trait_type IS NULL
+        AND tr.trait_key = ta.trait_key
+        """, batch_size=10000),
+        # The trait added last, with the highest key, is the current value of the trait type
+        Backfill("""
+        SELECT token_key FROM token_attribute
+        GROUP BY token_key
+        HAVING COUNT(*) > COUNT(DISTINCT COALESCE(trait_type, ''))
+        """, """
+        DELETE FROM token_attribute ta
+        USING token_attribute newer
+        WHERE ta.token_key = ANY(%(keys)s)
+        AND newer.token_key = ta.token_key
+        AND newer.trait_type IS NOT DISTINCT FROM ta.trait_type
+        AND newer.trait_key > ta.trait_key
+        """, batch_size=10000),
+        Concurrently('idx_token_trait_new', """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_token_trait_new
+        ON token_attribute (token_key, trait_type) NULLS NOT DISTINCT
+        """),
+        Python(swap_attribute_trait_index),
+        Sql("ANALYZE token_attribute")
+    ])
+]
+
+
+"""
+
+    Runner
+
+"""
+def create_version_table():
+    """ create the table recording the applied migrations"""
+    with engine.begin() as conn:
+        conn.execute(ddl.schema_version_table)
+
+
+def get_schema_version():
+    """
+    This function returns the latest applied migration version
+
+    Returns: version, 0 for a database without applied migrations
+    """
+    create_version_table()
+    with engine.connect() as conn:
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").scalar()
+
+
+def get_applied_versions():
+    """
+    This function returns the versions of the applied migrations
+
+    Returns: set
+    """
+    create_version_table()
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute("SELECT version FROM schema_version")}
+
+
+def get_pending_migrations():
+    """
+    This function returns the migrations not applied yet, in order
+
+    Returns: list of (version, description, steps) tuples
+    """
+    applied = get_applied_versions()
+    return [migration for migration in migrations if migration[0] not in applied]
+
+
+def migrate(target=None):
+    """
+    This function applies the pending migrations in version order and records each one in the
+    schema_version table.  An advisory lock keeps a second runner from migrating at the same time.
+    A failed migration stops the run and is raised; it isn't recorded so it's retried by the next run
+
+    Args: target - apply migrations up to this version, default all
+    Returns: latest applied version
+    """
+    lock_conn = engine.connect()
+    try:
+        lock_conn.execute("SELECT pg_advisory_lock(%(key)s)", {'key': migration_lock_key})
+        for version, description, steps in get_pending_migrations():
+            if target is not None and version > target:
+                break
+            # The baseline records the versions already built into the schema it creates
+            if version in get_applied_versions():
+                continue
+            logger.info(f"Applying migration {version}: {description}")
+            start_time = time.perf_counter()
+            for step in steps:
+                step.run()
+            duration = round(time.perf_counter() - start_time, 3)
+            with engine.begin() as conn:
+                conn.execute("INSERT INTO schema_version (version, description, duration) VALUES (%(version)s, %(description)s, %(duration)s) ON CONFLICT (version) DO NOTHING",
+                             {'version': version, 'description': description, 'duration': duration})
+            logger.info(f"Migration {version} Successfully Applied in {duration}s!")
+    except Exception as ex:
+        logger.exception(ex)
+        raise
+    finally:
+        lock_conn.execute("SELECT pg_advisory_unlock(%(key)s)", {'key': migration_lock_key})
+        lock_conn.close()
+    return get_schema_version()
+
+
+if __name__ == '__main__':
+    version = migrate()
+    logger.info(f"Database schema at version {version}")
@@ -0,0 +1,207 @@
+# Import Libraries
+import os
+import asyncio
+from decimal import Decimal
+from functools import partial
+from dotenv import load_dotenv
+import logging
+import db_utils as db
+
+# asyncpg is only needed when the async backend is used
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+# Get Logger
+logger = logging.getLogger()
+
+# Load .env environment variables
+load_dotenv()
+
+# Retrieve the database settings from .env file.  asyncpg expects a plain postgresql:// url
+# so any SQLAlchemy driver suffix i.e. postgresql+psycopg2:// is removed
+database_connection_string = os.getenv("DATABASE_URL")
+async_database_connection_string = database_connection_string.replace("+psycopg2", "") if database_connection_string else None
+
+# Retrieve the database schema from .env file
+database_schema = os.getenv("DATABASE_SCHEMA")
+
+# Batches of at least this many rows are written with binary COPY, smaller ones with a pipelined executemany
+copy_threshold = int(os.getenv("ASYNC_DB_COPY_THRESHOLD", 500))
+
+# Connection pool shared by all coroutines in the event loop
+pool = None
+
+
+async def get_pool():
+    """
+    This function returns the asyncpg connection pool, creating it on first use
+
+    Returns: asyncpg.Pool
+    """
+    global pool
+    if asyncpg is None:
+        raise ImportError("The async database backend requires asyncpg.  Install it with 'pip install asyncpg'")
+    if pool is None:
+        pool = await asyncpg.create_pool(async_database_connection_string, min_size=1, max_size=int(os.getenv("ASYNC_DB_POOL_SIZE", 10)))
+    return pool
+
+
+async def close_pool():
+    """
+    This function closes the asyncpg connection pool
+    """
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    This coroutine runs one of the synchronous db_utils functions that query the database in the
+    default executor, so its SQLAlchemy calls don't block the event loop
+
+    Args: func - the db_utils function
+          args, kwargs - its arguments
+    Returns: the function's result
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def coerce_value(value, type_name):
+    """
+    This function converts a DataFrame value into the python type asyncpg expects for the column
+
+    Args: value - the value to convert
+          type_name - postgres type name of the target column
+    Returns: converted value
+    """
+    if value is None:
+        return None
+    if type_name == 'numeric':
+        return Decimal(str(value))
+    if type_name in ('int2', 'int4', 'int8'):
+        return int(round(value))
+    if type_name in ('varchar', 'text'):
+        return str(value)
+    if type_name == 'timestamp' and hasattr(value, 'to_pydatetime'):
+        return value.to_pydatetime()
+    return value
+
+
+async def write_frame(table, df, conflict_clause):
+    """
+    This function writes a prepared DataFrame into a table in one transaction.  Small batches
+    are sent as one pipelined executemany, larger ones are streamed with binary COPY into a
+    temporary table and merged into the target table with a single INSERT ... SELECT.  Like
+    db_utils.write_many it raises on failure, so the save coroutines don't mark anything dirty
+
+    Args: table - name of the target table
+          df - prepared DataFrame whose columns match the table columns
+          conflict_clause - ON CONFLICT clause applied to the insert
+    """
+    if df.empty:
+        return
+    columns = list(df.columns)
+    column_list = ", ".join(columns)
+    placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+    insert_query = f"""
+    INSERT INTO {database_schema}.{table} ({column_list})
+    VALUES ({placeholders})
+    {conflict_clause}
+    """
+    records = df.astype(object).where(df.notna(), None).values.tolist()
+    try:
+        db_pool = await get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                statement = await conn.prepare(insert_query)
+                types = [param.name for param in statement.get_parameters()]
+                records = [tuple(coerce_value(value, type_name) for value, type_name in zip(record, types)) for record in records]
+                if len(records) < copy_threshold:
+                    await conn.executemany(insert_query, records)
+                else:
+                    temp_table = f"tmp_{table}"
+                    await conn.execute(f"CREATE TEMP TABLE {temp_table} (LIKE {database_schema}.{table} INCLUDING DEFAULTS) ON COMMIT DROP")
+                    await conn.copy_records_to_table(temp_table, records=records, columns=columns)
+                    await conn.execute(f"""
+                    INSERT INTO {database_schema}.{table} ({column_list})
+                    SELECT {column_list} FROM {temp_table}
+                    {conflict_clause}
+                    """)
+        logger.info(f"write_frame() wrote {len(records)} rows into {table}")
+    except Exception as ex:
+        logger.debug(insert_query)
+        logger.error(ex)
+        raise
+
+
+async def write_keyed_frame(table, df):
+    """
+    This function writes a prepared DataFrame into one of the tables that store integer keys in place
+    of the contract and token ids, see db_utils.KeyDictionary
+
+    Args: table - name of the target table
+          df - prepared DataFrame with the id columns
+    """
+    # A batch may carry the same key more than once; the last row wins, as an INSERT ... ON CONFLICT DO UPDATE
+    # can't affect a row twice
+    df = df.drop_duplicates(db.table_specs[table]['key'], keep='last')
+    # Ids without a key yet are added to the dictionary tables
+    stored_df = await run_sync(db.encode_frame, table, df)
+    await write_frame(table, stored_df, db.conflict_clause(table, list(stored_df.columns)))
+
+
+"""
+
+    Async versions of the db_utils save operations
+
+"""
+async def save_trade(df):
+    """
+    This coroutine saves the trades data.  Existing trades are skipped like db_utils.save_trade
+
+    Args: df - data collection of trades
+    """
+    trade_df = db.prepare_trade_frame(df)
+    await run_sync(db.ensure_trade_partitions, trade_df['timestamp'])
+    await write_keyed_frame('trade', trade_df)
+    db.mark_trade_days_dirty(trade_df)
+
+
+async def save_collection(contract_df):
+    """
+    This coroutine saves the collection data.  Existing collections are updated like db_utils.save_collection
+
+    Args: contract_df - data collection of collections
+    """
+    collection_df = db.prepare_collection_frame(contract_df).drop_duplicates('contract_id', keep='last')
+    await write_frame('collection', collection_df, db.conflict_clause('collection', db.collection_columns))
+    for contract_id in contract_df['contract_id']:
+        db.reference_cache.invalidate('collection', contract_id)
+    await run_sync(db.refresh_collection_lists, collection_df['contract_id'].tolist())
+
+
+async def save_token(token_df):
+    """
+    This coroutine saves the token data.  Existing tokens are skipped like db_utils.save_token
+
+    Args: token_df - data collection of tokens thats part of a specific contract i.e. Collection
+    """
+    await write_keyed_frame('token', db.prepare_token_frame(token_df))
+    db.mark_token_scores_dirty(contract_ids=token_df['contract_id'])
+
+
+async def save_token_attributes(token_attributes_df):
+    """
+    This coroutine saves the token attributes data.  Existing attributes are skipped like db_utils.save_token_attributes
+
+    Args: token_attributes_df - data collection of token attributes
+    """
+    token_attribute_df = db.prepare_token_attribute_frame(token_attributes_df)
+    await write_keyed_frame('token_attribute', token_attribute_df)
+    db.mark_token_scores_dirty(contract_ids=token_attribute_df['contract_id'] if 'contract_id' in token_attribute_df.columns else (),
+                               token_ids=token_attribute_df['token_id'])
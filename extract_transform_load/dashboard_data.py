@@ -0,0 +1,300 @@
+# Import Libraries
+import os
+import time
+import threading
+import inspect
+from functools import wraps, partial
+from pathlib import Path
+import pandas as pd
+import sqlalchemy
+from dotenv import load_dotenv
+
+# The dashboard's datasets, computed without any of its charting libraries so the ETL can publish them.  The dashboard
+# imports this module from the extract_transform_load package, the ETL from this directory like its other modules
+try:
+    from . import query_stats
+    from . import replica
+    from . import snapshot
+except ImportError:
+    import query_stats
+    import replica
+    import snapshot
+
+
+# Load .env environment variables
+load_dotenv()
+
+# Setup the database connection (use your own .env to setup the connection)
+database_connection_string = os.getenv("DATABASE_URL")
+database_schema = os.getenv("DATABASE_SCHEMA")
+
+# create the database engine
+engine = sqlalchemy.create_engine(database_connection_string)
+
+# Optional read-only replica for the dashboard queries, used while it's within DATABASE_REPLICA_MAX_LAG seconds of the primary
+replica_router = replica.ReplicaRouter(engine)
+
+# Enabled while publish_snapshot() runs, the replica may not have the data of the ETL run being published yet
+read_from_primary = {'enabled': False}
+
+# Time every dashboard statement and keep a slow-query log
+query_stats.instrument(engine)
+query_stats.instrument(replica_router.replica)
+
+def read_engine():
+    """
+    Returns the read replica engine when one is configured and it isn't lagging too far behind, otherwise the primary engine
+    """
+    return engine if read_from_primary['enabled'] else replica_router.read_engine()
+
+# The dashboard data is cached for DASHBOARD_REFRESH_INTERVAL seconds, or until a newer ETL run has finished.  The latest
+# finished run is checked at most once every DASHBOARD_VERSION_CHECK_INTERVAL seconds
+data_cache_ttl = float(os.getenv("DASHBOARD_REFRESH_INTERVAL", 300))
+data_version_check_interval = float(os.getenv("DASHBOARD_VERSION_CHECK_INTERVAL", 10))
+data_version_status = [0.0, None]
+data_version_lock = threading.Lock()
+data_cache = {}
+data_cache_lock = threading.Lock()
+
+def data_version():
+    """
+    Returns the id of the latest finished ETL run, the version of the data in the dashboard cache.  The last known version is
+    kept while the etl_run table can't be read
+    """
+    with data_version_lock:
+        if time.monotonic() - data_version_status[0] > data_version_check_interval:
+            version_query = "SELECT MAX(run_id) FROM etl_run WHERE finished_at IS NOT NULL"
+            try:
+                with read_engine().connect() as conn:
+                    data_version_status[1] = conn.execute(version_query).scalar()
+            except Exception:
+                pass
+            data_version_status[0] = time.monotonic()
+        return data_version_status[1]
+
+def cached_data(func):
+    """
+    Caches the result of a dashboard data function per arguments until it's DASHBOARD_REFRESH_INTERVAL seconds old or the data
+    version changes.  The cache is shared by every session, concurrent callers of a stale entry wait for a single reload, and
+    the cached DataFrames are shared too, don't modify them
+    """
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Keyed by the bound arguments, so defaults and keywords share the entry.  Lists (e.g. of columns) are keyed as tuples
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        key = (func.__name__,) + tuple(tuple(arg) if isinstance(arg, list) else arg for arg in arguments.arguments.values())
+        version = data_version()
+        with data_cache_lock:
+            # entry: [lock, loaded at, data version, result]
+            entry = data_cache.setdefault(key, [threading.Lock(), None, None, None])
+        with entry[0]:
+            if entry[1] is None or time.monotonic() - entry[1] > data_cache_ttl or entry[2] != version:
+                entry[3] = func(*args, **kwargs)
+                entry[1] = time.monotonic()
+                entry[2] = version
+            return entry[3]
+    return wrapper
+
+def clear_data_cache():
+    """
+    Drops every cached dashboard result, the next call of each data function queries the database again
+    """
+    with data_cache_lock:
+        data_cache.clear()
+
+# The collection_daily aggregates the market panel can select, with their SQL expression and chart column name
+market_aggregates = {
+    'total_volume': ("SUM(d.total_volume)::BIGINT", 'Volume in ETH'),
+    'total_num_trades': ("SUM(d.total_num_trades)::BIGINT", 'Number of Trades'),
+    'total_unique_buyers': ("SUM(d.total_unique_buyers)::BIGINT", 'Unique Buyers'),
+    'highest_avg_price': ("MAX(d.max_avg_price)::FLOAT", 'Highest Average Price'),
+    'highest_min_price': ("MAX(d.max_min_price)::FLOAT", 'Highest Minimum Price'),
+    'highest_max_price': ("MAX(d.max_max_price)::FLOAT", 'Highest Max Price')
+}
+
+# How the market panel can be grouped: the selected column, the GROUP BY list, the days it covers, the groups it keeps
+# and its order
+market_panel_groupings = {
+    # Market activity prior to January 2021 was insignificant when compared to data from early 2021 to present
+    'day': ('d.day as "Date"', "d.day", "AND d.max_avg_price > 0 AND d.day > '2020-12-31'", "", "d.day ASC"),
+    # Every collection that has ever traded, by collection name
+    'collection': ('c.name as "Collection Name"', "c.contract_id, c.name", "", "HAVING MAX(d.max_avg_price) > 0", 'c.name COLLATE "C"'),
+    # The days with trades, by collection name
+    'name': ('c.name as "Collection Name"', "c.name", "AND d.max_avg_price > 0", "", 'c.name COLLATE "C"')
+}
+
+def watchlist_join(watchlist):
+    """
+    Returns the join that keeps only the collections of the watchlist, or nothing when watchlist is None
+    """
+    if watchlist is None:
+        return ""
+    return "INNER JOIN watchlist_collection w ON w.contract_id = c.contract_id AND w.watchlist = %(watchlist)s"
+
+@cached_data
+def load_market_panel(watchlist=None, columns=('total_volume',), group_by='day'):
+    """
+    Returns the market panel the market charts are read from: the columns of the collection_daily rollup of the ethereum
+    collections of the watchlist (default every collection) that aren't excluded, aggregated in the database per day,
+    collection or collection name.  It's cached per arguments, the DataFrame is shared, don't modify it.  Raises ValueError
+    for an unknown column or grouping
+    """
+    unknown = [column for column in columns if column not in market_aggregates]
+    if unknown:
+        raise ValueError(f"Unknown market columns {unknown}, expected some of {list(market_aggregates)}")
+    if group_by not in market_panel_groupings:
+        raise ValueError(f"Unknown market panel grouping {group_by}, expected one of {list(market_panel_groupings)}")
+    group_column, group_list, day_filter, having, order_by = market_panel_groupings[group_by]
+    aggregate_list = ",\n        ".join(f'{market_aggregates[column][0]} as "{market_aggregates[column][1]}"' for column in columns)
+    market_panel_query = f"""
+    SELECT {group_column},
+        {aggregate_list}
+    FROM collection_daily d
+    INNER JOIN collection c ON c.contract_id = d.contract_id
+    INNER JOIN network n ON n.network_id = c.network_id
+    {watchlist_join(watchlist)}
+    WHERE n.network_id = 'ethereum'
+    AND NOT EXISTS (SELECT 1 FROM collection_exclusion e WHERE e.contract_id = c.contract_id)
+    {day_filter}
+    GROUP BY {group_list}
+    {having}
+    ORDER BY {order_by}
+    """
+    return pd.read_sql_query(market_panel_query, con=read_engine(), params={'watchlist': watchlist})
+
+def create_nft_market_vol(watchlist=None, columns=('total_volume',)):
+    # Sum the columns over the collections of the watchlist (default all) per day
+    return load_market_panel(watchlist, columns, 'day')
+
+@cached_data
+def query_correlation():
+    sql_query = """
+    SELECT d.contract_id,
+           c.name as collection_name,
+           c.address,
+           td.token_id,
+           tok.id_num,
+           tok.name as token_name,
+           tok.rarity_score,
+           tok.ranking,
+           ct.average_token_rarity_score_for_collection,
+           MIN(d.min_avg_price) as avg_price_for_collection,
+           MIN(d.min_min_price) as min_price_for_collection,
+           MAX(d.max_max_price) as max_price_for_collection,
+           SUM(d.total_volume) as total_volume_for_collection,
+           SUM(d.total_num_trades) as total_num_trades_for_collection,
+           SUM(d.total_unique_buyers) as total_unique_buyers_for_collection
+    FROM network n
+    INNER JOIN collection c ON c.network_id = n.network_id
+    INNER JOIN contract_dictionary k ON k.contract_id = c.contract_id
+    INNER JOIN (SELECT contract_key, ROUND(AVG(rarity_score), 2) AS average_token_rarity_score_for_collection FROM token GROUP BY contract_key) ct ON ct.contract_key = k.contract_key
+    INNER JOIN token tok ON tok.contract_key = ct.contract_key
+    INNER JOIN token_dictionary td ON td.token_key = tok.token_key
+    INNER JOIN collection_daily d ON d.contract_id = c.contract_id
+    INNER JOIN watchlist_collection w ON w.contract_id = c.contract_id AND w.watchlist = 'top_ten'
+    WHERE n.network_id = 'ethereum' 
+    AND tok.ranking = 1
+    GROUP BY d.contract_id, c.name, c.address, td.token_id, tok.id_num, tok.name, tok.rarity_score, tok.ranking, ct.average_token_rarity_score_for_collection
+    HAVING MIN(d.min_avg_price) > 0.0
+    ORDER BY SUM(d.total_volume)  DESC
+    """
+    df = pd.read_sql_query(sql_query, con = read_engine())
+    return df
+
+def create_os_collection_index(watchlist='opensea_top_ten', columns=('total_volume',)):
+    # Sum the columns of only the top ten collections listed on OpenSea per day
+    return create_nft_market_vol(watchlist, columns)
+
+def create_top_collections_one(watchlist='opensea_top_ten', columns=('total_volume',)):
+    # Sum the columns per collection of the watchlist that has ever traded, sorted by Collection Name
+    return load_market_panel(watchlist, columns, 'collection')
+
+def create_top_collections_two(watchlist='opensea_top_ten', columns=('total_num_trades',)):
+    # Sum the columns of the days with trades per collection name of the watchlist, sorted in alphabetical order to match the other chart
+    return load_market_panel(watchlist, columns, 'name')
+
+@cached_data
+def query_average_prices(watchlist='top_ten'):
+    # Average the prices of the collections of the watchlist by month
+    sql_query = f"""
+    SELECT c.name as collection,
+    DATE_TRUNC('month', d.day) as year_month_day,
+    (SUM(d.sum_avg_price) / SUM(d.num_avg_prices))::FLOAT as avg_price
+    FROM collection_daily d
+    INNER JOIN collection c ON c.contract_id = d.contract_id
+    INNER JOIN network n ON n.network_id = c.network_id
+    {watchlist_join(watchlist)}
+    WHERE n.network_id = 'ethereum'
+    AND NOT EXISTS (SELECT 1 FROM collection_exclusion e WHERE e.contract_id = c.contract_id)
+    AND DATE_TRUNC('month', d.day) > '2020-12-31'
+    GROUP BY c.name, DATE_TRUNC('month', d.day)
+    HAVING MIN(d.min_avg_price) > 0.0
+    ORDER BY SUM(d.total_volume) DESC
+    """
+    return pd.read_sql_query(sql_query, con = read_engine(), params={'watchlist': watchlist})
+
+def read_static_data(file_name, **kwargs):
+    """
+    Reads one of the analysis results exported to the static_data directory
+    """
+    return pd.read_csv(Path(__file__).resolve().parent.parent / 'static_data' / file_name, **kwargs)
+
+# The datasets of the dashboard snapshot and the functions computing them live
+snapshot_datasets = {
+    'nft_market_vol': create_nft_market_vol,
+    'os_collection_index': create_os_collection_index,
+    'top_collections_one': create_top_collections_one,
+    'top_collections_two': create_top_collections_two,
+    'average_prices': query_average_prices,
+    'correlation': query_correlation,
+    'standard_deviations': partial(read_static_data, 'standard_deviations.csv'),
+    'std_devs_top_collections_index': partial(read_static_data, 'std_devs_top_collections_index.csv', index_col='time', parse_dates=True),
+    'unstoppable_domains': partial(read_static_data, 'unstoppable_domains.csv', index_col='time', parse_dates=True),
+    'betas': partial(read_static_data, 'betas.csv'),
+    'mc_cum_return': partial(read_static_data, 'mc_cum_return.csv')
+}
+
+@cached_data
+def snapshot_manifest():
+    """
+    Returns the manifest of the latest dashboard snapshot, or None when there's none
+    """
+    return snapshot.latest_manifest()
+
+def snapshot_as_of():
+    """
+    Returns the time the latest dashboard snapshot was computed, or None when the dashboard queries the database live
+    """
+    manifest = snapshot_manifest()
+    return pd.Timestamp(manifest['as_of']) if manifest else None
+
+@cached_data
+def load_dataset(name):
+    """
+    Returns a dashboard dataset from the latest snapshot, or computes it live when there's no snapshot, it doesn't
+    have the dataset or it can't be read
+    """
+    try:
+        df = snapshot.read_dataset(snapshot_manifest(), name)
+    except Exception:
+        df = None
+    return df if df is not None else snapshot_datasets[name]()
+
+def publish_snapshot(run_id=None):
+    """
+    Computes every dashboard dataset live and publishes them as a new snapshot, which the dashboard reads instead of
+    querying the database.  Called by the ETL's publish stage
+
+    Returns the snapshot version, or None if pyarrow isn't installed
+    """
+    # Drop the cached results and read from the primary, the datasets must be computed from the data of this run
+    clear_data_cache()
+    read_from_primary['enabled'] = True
+    try:
+        datasets = {name: func() for name, func in snapshot_datasets.items()}
+    finally:
+        read_from_primary['enabled'] = False
+    return snapshot.write_snapshot(datasets, run_id)
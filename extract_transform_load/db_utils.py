@@ -2,10 +2,18 @@ import pandas as pd
 import math
 import re
 import os
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 from sqlalchemy import create_engine
 from sqlalchemy import inspect
+from sqlalchemy import text
 import logging
+import query_stats
+import replica
 
 # Get Logger
 logging.basicConfig(filename='db_utils.log', filemode='w', level=logging.DEBUG, format='%(levelname)s: %(asctime)s - %(message)s')
@@ -23,6 +31,31 @@ database_schema = os.getenv("DATABASE_SCHEMA")
 # Create a database connection
 engine = create_engine(database_connection_string, echo = False)
 
+# Reads are sent to the optional read replica while it's close enough to the primary, see replica
+replica_router = replica.ReplicaRouter(engine)
+replica_engine = replica_router.replica
+
+# Time every statement and keep a slow-query log, see query_stats
+query_stats.instrument(engine)
+query_stats.instrument(replica_engine)
+
+# Retrieve the reference table cache settings from .env file
+cache_max_size = int(os.getenv("DB_CACHE_MAX_SIZE", 1024))
+cache_ttl = float(os.getenv("DB_CACHE_TTL", 300))
+
+# Retrieve the optional number of months of trades to keep from .env file
+trade_retention_months = os.getenv("TRADE_RETENTION_MONTHS")
+
+
+def read_engine():
+    """
+    This function returns the engine read queries should use: the read replica when one is
+    configured and it's within DATABASE_REPLICA_MAX_LAG seconds of the primary, otherwise the primary
+
+    Returns: Engine
+    """
+    return replica_router.read_engine()
+
 
 def get_all_table_names():
     """
@@ -77,6 +110,1372 @@ def scrub_int(num):
 
 
 
+def scrub_str_column(series):
+    """
+    This function is the column level version of scrub_str.  It replaces missing values
+    and cleans up the characters for a whole DataFrame column in one vectorized pass
+
+    Args: series - column of string objects to analyze
+    Returns: Series
+    """
+    series = series.where(series.notna(), '').astype(str)
+    series = series.str.replace(r"[\([{'})\]]", "", regex=True)
+    series = series.str.replace("%", " pct.", regex=False)
+    return series
+
+
+
+def scrub_int_column(series):
+    """
+    This function is the column level version of scrub_int.  Missing and non numeric
+    values are replaced by zero for a whole DataFrame column in one vectorized pass
+
+    Args: series - column of numeric objects to analyze
+    Returns: Series
+    """
+    return pd.to_numeric(series, errors='coerce').fillna(0)
+
+
+
+def scrub_frame(df, str_columns=(), int_columns=()):
+    """
+    This function cleans up the given columns of a DataFrame before a batch write
+
+    Args: df - DataFrame to clean up
+          str_columns - columns cleaned up with scrub_str_column
+          int_columns - columns cleaned up with scrub_int_column
+    Returns: DataFrame
+    """
+    df = df.copy()
+    for column in str_columns:
+        df[column] = scrub_str_column(df[column])
+    for column in int_columns:
+        df[column] = scrub_int_column(df[column])
+    return df
+
+
+
+"""
+
+    Prepare DataFrames from the ETL for batch writes
+
+"""
+trade_columns = ['contract_id', 'timestamp', 'avg_price', 'max_price', 'min_price', 'num_trades', 'unique_buyers', 'volume', 'period', 'type', 'api_id']
+collection_columns = ['contract_id', 'address', 'name', 'description', 'external_url', 'network_id', 'primary_interface', 'royalties_fee_basic_points', 'royalties_receiver', 'num_tokens', 'unique_owners', 'smart_floor_price']
+token_columns = ['token_id', 'id_num', 'name', 'description', 'contract_id']
+# contract_id is optional for the token attributes, it names the collection of the traits without looking up the token
+token_attribute_columns = ['token_id', 'contract_id', 'overall_with_trait_value', 'rarity_percentage', 'trait_type', 'value']
+data_analysis_columns = ['contract_id', 'timestamp', 'percent_chg', 'avg_percent_chg', 'standard_dev', 'avg_standard_dev', 'variance', 'co_variance', 'beta', 'whale_ratio']
+
+
+def prepare_trade_frame(df):
+    """
+    This function maps the trades DataFrame built by the ETL onto the trade table columns
+
+    Args: df - data collection of trades
+    Returns: DataFrame
+    """
+    df = df.rename(columns={'time': 'timestamp', 'trades': 'num_trades'})
+    # The trade table stores the wall clock time without a time zone
+    if getattr(df['timestamp'].dt, 'tz', None) is not None:
+        df['timestamp'] = df['timestamp'].dt.tz_localize(None)
+    df[['avg_price', 'max_price', 'min_price', 'volume']] = df[['avg_price', 'max_price', 'min_price', 'volume']].round(2)
+    return df[trade_columns]
+
+
+def prepare_collection_frame(df):
+    """
+    This function maps the contracts DataFrame built by the ETL onto the collection table columns
+
+    Args: df - data collection of collections
+    Returns: DataFrame
+    """
+    df = scrub_frame(df, str_columns=['name', 'description', 'royalties_receiver'], int_columns=['royalties_fee_basic_points'])
+    return df[collection_columns]
+
+
+def prepare_token_frame(df):
+    """
+    This function maps the tokens DataFrame built by the ETL onto the token table columns
+
+    Args: df - data collection of tokens
+    Returns: DataFrame
+    """
+    df = scrub_frame(df, str_columns=['name', 'description'])
+    return df[token_columns]
+
+
+def prepare_token_attribute_frame(df):
+    """
+    This function maps the token attributes DataFrame built by the ETL onto the token_attribute table columns
+
+    Args: df - data collection of token attributes
+    Returns: DataFrame
+    """
+    df = scrub_frame(df, str_columns=['trait_type', 'value'])
+    return df[[column for column in token_attribute_columns if column in df.columns]]
+
+
+def prepare_data_analysis_frame(df):
+    """
+    This function maps the long format analytics DataFrame i.e. utils.data_analysis_frame() onto the
+    data_analysis table columns.  Missing metrics are saved as NULL
+
+    Args: df - data collection of data analysis information
+    Returns: DataFrame
+    """
+    df = df.rename(columns={'time': 'timestamp'}).reindex(columns=data_analysis_columns)
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    if getattr(df['timestamp'].dt, 'tz', None) is not None:
+        df['timestamp'] = df['timestamp'].dt.tz_localize(None)
+    metrics = data_analysis_columns[2:]
+    df[metrics] = df[metrics].astype(float).round(2)
+    return df
+
+
+
+"""
+
+    Read-through cache for the reference tables
+
+"""
+class ReferenceCache(object):
+    '''
+    In-process LRU cache for the small reference tables (collection, network, api,
+    whale and contract_map).  Entries expire after ttl seconds and the least recently
+    used entry is evicted once max_size entries are held.
+    '''
+    def __init__(self, max_size, ttl):
+        '''
+        Class constructor or initialization method
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, table, counter):
+        table_counters = self.counters.setdefault(table, {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0})
+        table_counters[counter] += 1
+
+    def get(self, table, key):
+        """
+        Returns a (hit, value) tuple for the cached lookup
+        """
+        with self.lock:
+            entry = self.entries.get((table, key))
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self.entries[(table, key)]
+                self.count(table, 'misses')
+                return False, None
+            self.entries.move_to_end((table, key))
+            self.count(table, 'hits')
+            return True, entry[1]
+
+    def set(self, table, key, value):
+        with self.lock:
+            self.entries[(table, key)] = (time.monotonic(), value)
+            self.entries.move_to_end((table, key))
+            while len(self.entries) > self.max_size:
+                evicted_table, evicted_key = self.entries.popitem(last=False)[0]
+                self.count(evicted_table, 'evictions')
+
+    def invalidate(self, table, key=None):
+        """
+        Drops a single cached lookup, or every lookup for the table when key is None
+        """
+        with self.lock:
+            if key is None:
+                keys = [k for k in self.entries if k[0] == table]
+            else:
+                # Table wide entries (key None) depend on every row of the table
+                keys = [k for k in [(table, key), (table, None)] if k in self.entries]
+            for k in keys:
+                del self.entries[k]
+            self.count(table, 'invalidations')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {table: dict(table_counters) for table, table_counters in self.counters.items()}
+            for table_counters in stats.values():
+                lookups = table_counters['hits'] + table_counters['misses']
+                table_counters['hit_ratio'] = round(table_counters['hits'] / lookups, 4) if lookups else 0.0
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl, 'tables': stats}
+
+
+reference_cache = ReferenceCache(cache_max_size, cache_ttl)
+reference_tables = ['collection', 'network', 'api', 'whale', 'contract_map']
+
+
+def cached_lookup(table):
+    """
+    This decorator serves a single key reference lookup from the reference cache and
+    only reaches the database on a miss.  Failed lookups (None) are never cached.  The
+    lookups read from the primary, a lagging replica could cache a stale row that the
+    invalidation on write has already dropped.
+
+    Args: table - name of the reference table the lookup reads from
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(key):
+            hit, df = reference_cache.get(table, key)
+            if not hit:
+                df = func(key)
+                if df is None:
+                    return df
+                reference_cache.set(table, key, df)
+            # Hand out a copy so callers can't modify the cached DataFrame
+            return df.copy()
+        return wrapper
+    return decorator
+
+
+def get_cache_stats():
+    """
+    This function returns the hit/miss statistics of the reference cache
+
+    Returns: Dictionary
+    """
+    return reference_cache.stats()
+
+
+def clear_reference_cache():
+    """
+    This function empties the reference cache
+    """
+    reference_cache.clear()
+
+
+
+"""
+
+    Integer surrogate keys for the contract and token ids
+
+"""
+class KeyDictionary(object):
+    '''
+    In-memory two way map between the contract or token ids and the compact integer keys the hot
+    tables (trade, token, token_attribute, data_analysis and whale) store in their place.  A key
+    never changes once assigned, so entries are kept for the life of the process and only the ids
+    and keys not seen yet are looked up, one query per batch.
+    '''
+    def __init__(self, table, id_column, key_column, key_type):
+        '''
+        Class constructor or initialization method
+        '''
+        self.table = table
+        self.id_column = id_column
+        self.key_column = key_column
+        self.key_type = key_type
+        self.keys = {}
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def remember(self, rows):
+        with self.lock:
+            for id_value, key in rows:
+                self.keys[id_value] = key
+                self.ids[key] = id_value
+
+    def load(self, column, values):
+        """
+        Reads the dictionary entries for a list of ids or keys.  The primary is used so keys created a moment ago are found
+        """
+        sql_query = f"""
+        SELECT {self.id_column}, {self.key_column}
+        FROM {database_schema}.{self.table}
+        WHERE {column} = ANY(%(values)s)
+        """
+        with engine.connect() as conn:
+            self.remember(conn.execute(sql_query, {'values': values}).fetchall())
+
+    def to_keys(self, ids, create=False):
+        """
+        Returns the key of every id, None for missing ids, and with create adds the missing ids to the dictionary first
+        """
+        ids = list(ids)
+        with self.lock:
+            missing = sorted({id_value for id_value in ids if id_value not in self.keys and isinstance(id_value, str)})
+        if missing:
+            if create:
+                insert_query = f"""
+                INSERT INTO {database_schema}.{self.table} ({self.id_column})
+                SELECT unnest(%(ids)s::varchar[])
+                ON CONFLICT ({self.id_column}) DO NOTHING
+                """
+                with engine.begin() as conn:
+                    conn.execute(insert_query, {'ids': missing})
+            self.load(self.id_column, missing)
+        with self.lock:
+            return [self.keys.get(id_value) for id_value in ids]
+
+    def to_ids(self, keys):
+        """
+        Returns the id of every key, None for missing keys
+        """
+        keys = [None if pd.isna(key) else int(key) for key in keys]
+        with self.lock:
+            missing = sorted({key for key in keys if key is not None and key not in self.ids})
+        if missing:
+            self.load(self.key_column, missing)
+        with self.lock:
+            return [self.ids.get(key) for key in keys]
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.ids.clear()
+
+
+contract_dictionary = KeyDictionary('contract_dictionary', 'contract_id', 'contract_key', 'int')
+token_dictionary = KeyDictionary('token_dictionary', 'token_id', 'token_key', 'bigint')
+key_dictionaries = {'contract_id': contract_dictionary, 'token_id': token_dictionary}
+
+# Id columns of the tables that store the integer key in their place.  trade.contract_id also
+# holds token ids for the token trades, they get a key from the contract dictionary like any contract id
+keyed_tables = {
+    'trade':           ['contract_id'],
+    'token':           ['token_id', 'contract_id'],
+    'token_attribute': ['token_id'],
+    'data_analysis':   ['contract_id'],
+    'whale':           ['contract_id'],
+}
+
+
+def storage_column(table, column):
+    """
+    This function returns the column a table stores a column in, the key column for the id columns
+    of the keyed tables
+
+    Args: table - name of the table
+          column - column name i.e. contract_id
+    Returns: column name i.e. contract_key
+    """
+    return key_dictionaries[column].key_column if column in keyed_tables.get(table, ()) else column
+
+
+def contract_keys(contract_ids):
+    """
+    This function returns the keys of a list of contract ids, for filtering the keyed tables.  Ids
+    without a key can't match any row and are left out
+
+    Args: contract_ids - list of contract ids
+    Returns: List
+    """
+    return [key for key in contract_dictionary.to_keys(contract_ids) if key is not None]
+
+
+def token_keys(token_ids):
+    """
+    This function returns the keys of a list of token ids, for filtering the keyed tables.  Ids
+    without a key can't match any row and are left out
+
+    Args: token_ids - list of token ids
+    Returns: List
+    """
+    return [key for key in token_dictionary.to_keys(token_ids) if key is not None]
+
+
+def contract_key(contract_id, create=False):
+    """
+    This function returns the key of a contract id as a SQL literal, NULL when the id has no key
+
+    Args: contract_id - a collection's contract id
+          create - add the id to the dictionary when it's missing, for inserts
+    Returns: String
+    """
+    return str(contract_dictionary.to_keys([contract_id], create)[0] or 'NULL')
+
+
+def token_key(token_id, create=False):
+    """
+    This function returns the key of a token id as a SQL literal, NULL when the id has no key
+
+    Args: token_id - a token's id
+          create - add the id to the dictionary when it's missing, for inserts
+    Returns: String
+    """
+    return str(token_dictionary.to_keys([token_id], create)[0] or 'NULL')
+
+
+def token_contract_keys(token_ids):
+    """
+    This function returns the contract key of every token id, None for the tokens missing from the token table
+
+    Args: token_ids - list of token ids
+    Returns: List
+    """
+    token_key_list = token_dictionary.to_keys(token_ids)
+    sql_query = f"""
+    SELECT DISTINCT ON (token_key) token_key, contract_key
+    FROM {database_schema}.token
+    WHERE token_key = ANY(%(token_keys)s)
+    """
+    with engine.connect() as conn:
+        contracts = dict(conn.execute(sql_query, {'token_keys': [key for key in token_key_list if key is not None]}).fetchall())
+    return [contracts.get(key) for key in token_key_list]
+
+
+def encode_traits(df):
+    """
+    This function replaces the trait value and statistics columns of a token attributes DataFrame by
+    the trait_key, the trait_type is kept as the attribute's key.  The traits are added to the trait
+    table of their collection, or have their rarity statistics updated, in one statement, and the
+    collections whose traits changed have their token scores marked dirty.  Attributes of tokens
+    whose collection is unknown are left out
+
+    Args: df - DataFrame with token_id, trait_type and value, the rarity statistics and optionally contract_id
+    Returns: DataFrame
+    """
+    if 'contract_id' in df.columns:
+        contract_key_list = contract_dictionary.to_keys(df['contract_id'], create=True)
+    else:
+        contract_key_list = token_contract_keys(df['token_id'])
+    traits = df.reindex(columns=['trait_type', 'value', 'overall_with_trait_value', 'rarity_percentage'])
+    traits = traits.astype(object).where(traits.notna(), None)
+    traits.insert(0, 'contract_key', contract_key_list)
+    unknown = traits['contract_key'].isna()
+    if unknown.any():
+        logger.warning(f"encode_traits() skipped the attributes of {unknown.sum()} tokens of unknown collections")
+    unique_traits = traits[~unknown].drop_duplicates(['contract_key', 'trait_type', 'value'], keep='last')
+    # Traits whose statistics are unchanged aren't rewritten, so the upsert only returns the new and changed traits.
+    # The others are read from the statement's snapshot, which doesn't see the upsert's own rows
+    upsert_query = f"""
+    WITH input AS (
+        SELECT * FROM unnest(%(contract_keys)s::int[], %(trait_types)s::varchar[], %(values)s::varchar[], %(overall)s::int[], %(rarity)s::numeric[])
+            AS i(contract_key, trait_type, value, overall_with_trait_value, rarity_percentage)
+    ), upserted AS (
+        INSERT INTO {database_schema}.trait (contract_key, trait_type, value, overall_with_trait_value, rarity_percentage)
+        SELECT * FROM input
+        ON CONFLICT (contract_key, trait_type, value) DO UPDATE
+        SET overall_with_trait_value = COALESCE(EXCLUDED.overall_with_trait_value, trait.overall_with_trait_value),
+            rarity_percentage = COALESCE(EXCLUDED.rarity_percentage, trait.rarity_percentage)
+        WHERE (trait.overall_with_trait_value, trait.rarity_percentage) IS DISTINCT FROM
+              (COALESCE(EXCLUDED.overall_with_trait_value, trait.overall_with_trait_value),
+               COALESCE(EXCLUDED.rarity_percentage, trait.rarity_percentage))
+        RETURNING contract_key, trait_type, value, trait_key
+    )
+    SELECT contract_key, trait_type, value, trait_key, TRUE AS changed FROM upserted
+    UNION ALL
+    SELECT tr.contract_key, tr.trait_type, tr.value, tr.trait_key, FALSE AS changed
+    FROM {database_schema}.trait tr
+    INNER JOIN input i ON i.contract_key = tr.contract_key AND i.trait_type IS NOT DISTINCT FROM tr.trait_type AND i.value IS NOT DISTINCT FROM tr.value
+    WHERE NOT EXISTS (SELECT 1 FROM upserted u WHERE u.trait_key = tr.trait_key)
+    """
+    params = {'contract_keys': [int(key) for key in unique_traits['contract_key']],
+              'trait_types': unique_traits['trait_type'].tolist(),
+              'values': unique_traits['value'].tolist(),
+              'overall': [None if value is None else int(value) for value in unique_traits['overall_with_trait_value']],
+              'rarity': unique_traits['rarity_percentage'].tolist()}
+    with engine.begin() as conn:
+        traits_written = conn.execute(upsert_query, params).fetchall()
+    trait_keys = {(contract_key, trait_type, value): trait_key for contract_key, trait_type, value, trait_key, changed in traits_written}
+    # The rarity statistics of a trait are shared by every token of the collection having it
+    mark_token_scores_dirty(contract_ids=contract_dictionary.to_ids(list({row[0] for row in traits_written if row[4]})))
+    df = df[~unknown.to_numpy()].drop(columns=[column for column in ['contract_id'] + list(traits.columns) if column in df.columns and column != 'trait_type'])
+    df['trait_key'] = pd.array([trait_keys.get(tuple(row)) for row in traits[~unknown][['contract_key', 'trait_type', 'value']].itertuples(index=False)], dtype='Int64')
+    return df
+
+
+def trait_key(token_id, trait_type, df):
+    """
+    This function returns the key of a token's trait as a SQL literal, NULL when the token's collection
+    is unknown.  The trait is added to the trait table or has its rarity statistics updated
+
+    Args: token_id - a token thats part of a contract i.e. Collection
+          trait_type - part of a token's trait
+          df - data collection of the token attribute
+    Returns: String
+    """
+    attribute = {column: df[column] for column in token_attribute_columns if column in df}
+    attribute.update({'token_id': token_id, 'trait_type': trait_type})
+    keys = encode_traits(prepare_token_attribute_frame(pd.DataFrame([attribute])))['trait_key']
+    return str(keys.iloc[0]) if len(keys) and pd.notna(keys.iloc[0]) else 'NULL'
+
+
+def encode_frame(table, df, create=True):
+    """
+    This function replaces the id columns of a DataFrame by the key columns the table stores
+
+    Args: table - name of the table
+          df - DataFrame with the table's columns
+          create - add ids missing from the dictionaries, for writes
+    Returns: DataFrame
+    """
+    # Token attributes store the key of their trait, see encode_traits()
+    if table == 'token_attribute' and 'trait_type' in df.columns:
+        df = encode_traits(df)
+    columns = [column for column in keyed_tables.get(table, ()) if column in df.columns]
+    if not columns:
+        return df
+    df = df.copy()
+    for column in columns:
+        df[column] = pd.array(key_dictionaries[column].to_keys(df[column], create), dtype='Int64')
+    return df.rename(columns={column: key_dictionaries[column].key_column for column in columns})
+
+
+def decode_frame(df):
+    """
+    This function replaces the contract_key and token_key columns of a query result by the ids
+
+    Args: df - DataFrame read from a keyed table
+    Returns: DataFrame
+    """
+    if df is None:
+        return df
+    for column, dictionary in key_dictionaries.items():
+        if dictionary.key_column in df.columns:
+            df[dictionary.key_column] = dictionary.to_ids(df[dictionary.key_column])
+            df = df.rename(columns={dictionary.key_column: column})
+    return df
+
+
+
+"""
+
+    Batch CRUD operations for every table
+
+"""
+network_columns = ['network_id', 'short_name']
+api_columns = ['api_id', 'name', 'endpoint_url']
+whale_columns = ['wallet_id', 'contract_id']
+contract_map_columns = ['contract_id', 'new_contract_id']
+social_media_columns = ['contract_id', 'name', 'handle', 'handle_url', 'latest_post', 'hash_tag']
+token_rarity_columns = ['token_id', 'contract_id', 'model', 'score', 'ranking']
+
+# Key columns and conflict handling per table, matching what the save_* functions do row by row.
+# 'nothing' skips rows that already exist, 'update' overwrites them and 'replace' deletes the
+# rows for the keys before inserting, for the tables without a unique constraint on the key
+table_specs = {
+    'network':         {'columns': network_columns, 'key': ['network_id'], 'on_conflict': 'update'},
+    'api':             {'columns': api_columns, 'key': ['api_id'], 'on_conflict': 'update'},
+    'collection':      {'columns': collection_columns, 'key': ['contract_id'], 'on_conflict': 'update'},
+    'contract_map':    {'columns': contract_map_columns, 'key': ['contract_id'], 'on_conflict': 'replace'},
+    'whale':           {'columns': whale_columns, 'key': ['wallet_id'], 'on_conflict': 'replace'},
+    'social_media':    {'columns': social_media_columns, 'key': ['contract_id'], 'on_conflict': 'replace'},
+    'token':           {'columns': token_columns, 'key': ['token_id', 'contract_id'], 'on_conflict': 'nothing'},
+    'token_attribute': {'columns': token_attribute_columns, 'key': ['token_id', 'trait_type'], 'on_conflict': 'update', 'stored_key': ['token_key', 'trait_type']},
+    'trade':           {'columns': trade_columns, 'key': ['contract_id', 'timestamp'], 'on_conflict': 'nothing'},
+    'data_analysis':   {'columns': data_analysis_columns, 'key': ['contract_id', 'timestamp'], 'on_conflict': 'update'},
+    'token_rarity':    {'columns': token_rarity_columns, 'key': ['token_id', 'contract_id', 'model'], 'on_conflict': 'update'},
+}
+
+# Tables that are read through a view, because they store the key of a dictionary table in place
+# of some of their columns.  Their rows are matched on the view and written by their stored_key
+table_views = {'token_attribute': 'token_trait'}
+
+# Postgres type of the key columns that aren't VARCHAR
+key_column_types = {'timestamp': 'timestamp', 'contract_key': 'int', 'token_key': 'bigint'}
+
+
+def conflict_clause(table, columns, on_conflict=None):
+    """
+    This function builds the ON CONFLICT clause of a bulk insert
+
+    Args: table - name of the target table
+          columns - columns being inserted, as stored i.e. contract_key instead of contract_id
+          on_conflict - 'nothing' or 'update', defaults to the table's setting
+    Returns: string
+    """
+    spec = table_specs[table]
+    key = spec.get('stored_key') or [storage_column(table, column) for column in spec['key']]
+    key_list = ", ".join(key)
+    update_columns = [column for column in columns if column not in key]
+    update_list = ", ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    if (on_conflict or spec['on_conflict']) == 'update' and update_list:
+        # Rows whose values are unchanged aren't rewritten, nor returned by a RETURNING clause
+        changed = (f"({', '.join(f'{table}.{column}' for column in update_columns)}) IS DISTINCT FROM "
+                   f"({', '.join(f'EXCLUDED.{column}' for column in update_columns)})")
+        return f"ON CONFLICT ({key_list}) DO UPDATE SET {update_list} WHERE {changed}"
+    return f"ON CONFLICT ({key_list}) DO NOTHING"
+
+
+def key_params(table, keys, key_columns=None):
+    """
+    This function turns a set of keys into one array parameter per key column and the
+    matching unnest() join condition, so any number of keys is handled by one statement
+
+    Args: table - name of the table
+          keys - list of key values, list of key tuples or a DataFrame holding the key columns
+          key_columns - key columns, defaults to the table's key
+    Returns: (unnest expression, join condition, parameters) tuple
+    """
+    key_columns = key_columns or table_specs[table]['key']
+    if isinstance(keys, pd.DataFrame):
+        key_values = [keys[column].tolist() for column in key_columns]
+    elif len(key_columns) == 1:
+        key_values = [[key[0] if isinstance(key, tuple) else key for key in keys]]
+    else:
+        key_values = [list(column_values) for column_values in zip(*keys)] or [[] for column in key_columns]
+    # Contract and token ids are matched by their integer key in the keyed tables
+    key_values = [key_dictionaries[column].to_keys(values) if column in keyed_tables.get(table, ()) else values
+                  for column, values in zip(key_columns, key_values)]
+    key_columns = [storage_column(table, column) for column in key_columns]
+    params = {f"key_{i}": [None if pd.isna(value) else value for value in values] for i, values in enumerate(key_values)}
+    unnest = ", ".join(f"%(key_{i})s::{key_column_types.get(column, 'varchar')}[]" for i, column in enumerate(key_columns))
+    unnest = f"unnest({unnest}) AS k({', '.join(f'key_{i}' for i in range(len(key_columns)))})"
+    condition = " AND ".join(f"t.{column} = k.key_{i}" for i, column in enumerate(key_columns))
+    return unnest, condition, params
+
+
+def keyset_delete_query(table, unnest, condition):
+    """
+    This function builds the DELETE statement for the keys of key_params().  The rows of the tables
+    read through a view are matched on the view and deleted by their stored key
+
+    Args: table - name of the table
+          unnest - unnest expression from key_params()
+          condition - join condition from key_params()
+    Returns: string
+    """
+    if table not in table_views:
+        return f"""
+        DELETE FROM {database_schema}.{table} t
+        USING {unnest}
+        WHERE {condition}
+        """
+    stored_key = table_specs[table]['stored_key']
+    return f"""
+    DELETE FROM {database_schema}.{table}
+    WHERE ({", ".join(stored_key)}) IN (SELECT {", ".join(f"t.{column}" for column in stored_key)}
+                                        FROM {database_schema}.{table_views[table]} t
+                                        INNER JOIN {unnest} ON {condition})
+    """
+
+
+def get_many(table, keys, key_columns=None, columns=None):
+    """
+    This function retrieves the rows for a set of keys in one round trip
+
+    Args: table - name of the table
+          keys - list of key values, list of key tuples or a DataFrame holding the key columns
+          key_columns - key columns, defaults to the table's key
+          columns - optional list of columns to return, default all
+    Returns: DataFrame
+    """
+    unnest, condition, params = key_params(table, keys, key_columns)
+    sql_query = f"""
+    SELECT {select_list(table, columns, alias='t')}
+    FROM {database_schema}.{table_views.get(table, table)} t
+    INNER JOIN {unnest} ON {condition}
+    """
+    try:
+        df = pd.read_sql_query(sql_query, con = read_engine(), params = params)
+        return decode_frame(df)
+    except Exception as ex:
+        logger.debug(sql_query)
+        logger.error(ex)
+
+
+def delete_many(table, keys=None, key_columns=None, contract_ids=None, start=None, end=None):
+    """
+    This function deletes a set of keys (keyset delete) or, for the tables keyed by contract_id
+    and timestamp, a time range for a list of contracts (range delete) in one statement
+
+    Args: table - name of the table
+          keys - list of key values, list of key tuples or a DataFrame holding the key columns
+          key_columns - key columns, defaults to the table's key
+          contract_ids - list of contract ids for a range delete, required when keys is None
+          start - lower bound (inclusive) of the range delete
+          end - upper bound (exclusive) of the range delete
+    Returns: number of deleted rows
+    """
+    if keys is None and contract_ids is None:
+        raise ValueError(f"delete_many() on {table} needs keys or contract_ids")
+    if keys is not None:
+        unnest, condition, params = key_params(table, keys, key_columns)
+        delete_query = keyset_delete_query(table, unnest, condition)
+    else:
+        keyed = 'contract_id' in keyed_tables.get(table, ())
+        filters = [f"t.{storage_column(table, 'contract_id')} = ANY(%(contract_ids)s)"]
+        if start is not None:
+            filters.append("t.timestamp >= %(start)s")
+        if end is not None:
+            filters.append("t.timestamp < %(end)s")
+        delete_query = f"""
+        DELETE FROM {database_schema}.{table} t
+        WHERE {" AND ".join(filters)}
+        """
+        params = {'contract_ids': contract_keys(contract_ids) if keyed else list(contract_ids), 'start': start, 'end': end}
+    try:
+        with engine.connect() as conn:
+            result = conn.execute(delete_query, params)
+        if table in reference_tables:
+            reference_cache.invalidate(table)
+        if table == 'trade' and keys is not None:
+            mark_trade_days_dirty(decode_frame(pd.DataFrame({'contract_key': params['key_0'], 'timestamp': params['key_1']})))
+        elif table == 'trade':
+            refresh_collection_daily(contract_ids, start, end)
+        logger.info(f"delete_many() deleted {result.rowcount} rows from {table}")
+        return result.rowcount
+    except Exception as ex:
+        logger.debug(delete_query)
+        logger.error(ex)
+
+
+def write_many(table, df, on_conflict=None, page_size=1000):
+    """
+    This function writes a prepared DataFrame into a table with multi-row INSERT ... ON CONFLICT
+    statements in a single transaction.  Unlike save_many it raises on failure so callers can retry
+
+    Args: table - name of the target table
+          df - prepared DataFrame whose columns match the table columns
+          on_conflict - 'nothing', 'update' or 'replace', defaults to the table's setting
+          page_size - number of rows sent per INSERT statement
+    """
+    if df is None or df.empty:
+        return
+    spec = table_specs[table]
+    on_conflict = on_conflict or spec['on_conflict']
+    columns = [column for column in spec['columns'] if column in df.columns]
+    # A batch may carry the same key more than once; the last row wins
+    df = df[columns].drop_duplicates(spec['key'], keep='last')
+    # Contract and token ids are stored as their integer key
+    stored_df = encode_frame(table, df)
+    stored_columns = list(stored_df.columns)
+    # The token tables return the tokens of the rows actually inserted or updated, only those mark scores dirty
+    returning = table in ('token', 'token_attribute')
+    insert_query = f"""
+    INSERT INTO {database_schema}.{table} ({", ".join(stored_columns)})
+    VALUES %s
+    {conflict_clause(table, stored_columns, on_conflict) if on_conflict != 'replace' else ""}
+    {f"RETURNING {storage_column(table, 'token_id')}" if returning else ""}
+    """
+    rows = stored_df.astype(object).where(stored_df.notna(), None).values.tolist()
+    if table == 'trade':
+        ensure_trade_partitions(df['timestamp'])
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if on_conflict == 'replace':
+                unnest, condition, params = key_params(table, df)
+                query_stats.timed_execute(engine, cursor, keyset_delete_query(table, unnest, condition), params)
+            written = query_stats.timed_execute(engine, cursor, insert_query, rows, execute=execute_values, page_size=page_size, fetch=returning)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        logger.debug(insert_query)
+        raise
+    finally:
+        conn.close()
+    if table in reference_tables:
+        for key in df[spec['key'][0]]:
+            reference_cache.invalidate(table, key)
+    if table == 'collection':
+        refresh_collection_lists(df['contract_id'].tolist())
+    elif table == 'trade':
+        mark_trade_days_dirty(df)
+    elif returning:
+        changed_df = df[df['token_id'].isin(token_dictionary.to_ids([row[0] for row in written]))]
+        if table == 'token':
+            mark_token_scores_dirty(contract_ids=changed_df['contract_id'])
+        else:
+            # The collections whose trait statistics changed are marked by encode_traits()
+            mark_token_scores_dirty(token_ids=changed_df['token_id'])
+    logger.info(f"write_many() wrote {len(rows)} rows into {table}")
+
+
+def save_many(table, df, on_conflict=None):
+    """
+    This function saves a prepared DataFrame into a table with bulk INSERT ... ON CONFLICT statements
+
+    Args: table - name of the target table
+          df - prepared DataFrame whose columns match the table columns
+          on_conflict - 'nothing', 'update' or 'replace', defaults to the table's setting
+    """
+    try:
+        write_many(table, df, on_conflict)
+    except Exception as ex:
+        logger.error(ex)
+
+
+
+class BufferedWriter(object):
+    '''
+    Write-behind buffer for the ETL.  Rows handed to the save_* methods are gathered per
+    table and written with write_many once a table holds max_rows rows or max_bytes bytes,
+    once its oldest row has waited max_seconds, or when the writer is closed.  Failed
+    batches are retried with an exponential backoff, the batches still failing are kept
+    in failed and closing the writer raises a RuntimeError listing them.
+    '''
+    def __init__(self, max_rows=5000, max_bytes=16 * 1024 * 1024, max_seconds=30, retries=3, retry_delay=1.0):
+        '''
+        Class constructor or initialization method
+        '''
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pending = {}
+        self.failed = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_on_failure=exc_type is None)
+
+    def close(self, raise_on_failure=True):
+        """
+        Flushes every table.  Rows that couldn't be written are logged per table and, with
+        raise_on_failure, raised as a RuntimeError so the caller knows they were lost
+        """
+        self.flush()
+        if self.failed:
+            failed_rows = {table: sum(len(df.index) for df in frames) for table, frames in self.failed.items()}
+            logger.error(f"BufferedWriter couldn't write {sum(failed_rows.values())} rows: {failed_rows}")
+            if raise_on_failure:
+                raise RuntimeError(f"BufferedWriter couldn't write {sum(failed_rows.values())} rows: {failed_rows}")
+
+    def add(self, table, df):
+        """
+        Buffers a prepared DataFrame for the table and flushes any table over its limits
+        """
+        if df is None or df.empty:
+            return
+        buffer = self.pending.setdefault(table, {'frames': [], 'rows': 0, 'bytes': 0, 'since': time.monotonic()})
+        buffer['frames'].append(df)
+        buffer['rows'] += len(df.index)
+        buffer['bytes'] += int(df.memory_usage(deep=True).sum())
+        now = time.monotonic()
+        for pending_table, pending_buffer in list(self.pending.items()):
+            if (pending_buffer['rows'] >= self.max_rows or pending_buffer['bytes'] >= self.max_bytes
+                    or now - pending_buffer['since'] >= self.max_seconds):
+                self.flush(pending_table)
+
+    def flush(self, table=None):
+        """
+        Writes the buffered rows of one table, or of every table when table is None
+        """
+        tables = [table] if table is not None else list(self.pending)
+        for pending_table in tables:
+            buffer = self.pending.pop(pending_table, None)
+            if buffer is None:
+                continue
+            df = pd.concat(buffer['frames'], ignore_index=True)
+            for attempt in range(self.retries + 1):
+                try:
+                    write_many(pending_table, df)
+                    break
+                except Exception as ex:
+                    logger.error(f"BufferedWriter flush of {len(df.index)} rows into {pending_table} failed (attempt {attempt + 1}): {ex}")
+                    if attempt < self.retries:
+                        time.sleep(self.retry_delay * 2 ** attempt)
+            else:
+                self.failed.setdefault(pending_table, []).append(df)
+
+    def save_trade(self, df):
+        self.add('trade', prepare_trade_frame(df))
+
+    def save_collection(self, contract_df):
+        self.add('collection', prepare_collection_frame(contract_df))
+
+    def save_token(self, token_df):
+        self.add('token', prepare_token_frame(token_df))
+
+    def save_token_attributes(self, token_attributes_df):
+        self.add('token_attribute', prepare_token_attribute_frame(token_attributes_df))
+
+
+
+"""
+
+    Trade partitions
+
+"""
+# Months known to have a trade partition and whether the trade table is partitioned (None until checked)
+trade_partition_months = set()
+trade_partitioning = {'enabled': None}
+
+
+def ensure_trade_partitions(timestamps):
+    """
+    This function creates the monthly trade partitions for the timestamps ahead of an insert, so new
+    trades never land in the default partition.  Months already known to have a partition are skipped,
+    and nothing is done when the trade table isn't partitioned
+
+    Args: timestamps - Series or list of trade timestamps
+    """
+    months = set(pd.to_datetime(pd.Series(timestamps)).dt.to_period('M').dropna()) - trade_partition_months
+    if not months or trade_partitioning['enabled'] is False:
+        return
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if trade_partitioning['enabled'] is None:
+                query_stats.timed_execute(engine, cursor, "SELECT relkind FROM pg_class WHERE oid = TO_REGCLASS(%(table)s)", {'table': f"{database_schema}.trade"})
+                row = cursor.fetchone()
+                trade_partitioning['enabled'] = row is not None and row[0] == 'p'
+                if not trade_partitioning['enabled']:
+                    return
+            query_stats.timed_execute(engine, cursor, "SELECT create_trade_partitions(%(start)s, %(end)s)",
+                                      {'start': min(months).to_timestamp(), 'end': max(months).to_timestamp()})
+            created = cursor.fetchone()[0]
+        conn.commit()
+        trade_partition_months.update(pd.period_range(min(months), max(months), freq='M'))
+        if created:
+            logger.info(f"ensure_trade_partitions() created {created} trade partitions")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def drop_old_trade_partitions(retention_months=None):
+    """
+    This function drops the monthly trade partitions older than the retention period.  Dropping a
+    partition removes its trades without scanning or vacuuming the rest of the trade table
+
+    Args: retention_months - number of months of trades to keep, defaults to TRADE_RETENTION_MONTHS
+                             from the .env file.  Nothing is dropped when neither is set
+    Returns: number of dropped partitions
+    """
+    retention_months = retention_months or trade_retention_months
+    if not retention_months:
+        return 0
+    drop_query = f"""
+    SELECT drop_trade_partitions((DATE_TRUNC('month', NOW()) - INTERVAL '{int(retention_months)} months')::TIMESTAMP)
+    """
+    try:
+        with engine.begin() as conn:
+            dropped = conn.execute(drop_query).scalar()
+        trade_partition_months.clear()
+        logger.info(f"drop_old_trade_partitions() dropped {dropped} trade partitions")
+        return dropped
+    except Exception as ex:
+        logger.debug(drop_query)
+        logger.error(ex)
+
+
+"""
+
+    Daily collection rollup
+
+"""
+# (contract_id, day) pairs whose trades changed since the rollup was last refreshed
+dirty_trade_days = set()
+
+# Aggregates kept per contract and day, everything the dashboard and analytics derive from trades
+collection_daily_aggregates = """
+    SUM(t.volume) AS total_volume,
+    SUM(t.num_trades) AS total_num_trades,
+    SUM(t.unique_buyers) AS total_unique_buyers,
+    COUNT(t.avg_price) AS num_avg_prices,
+    SUM(t.avg_price) AS sum_avg_price,
+    MIN(t.avg_price) AS min_avg_price,
+    MAX(t.avg_price) AS max_avg_price,
+    MIN(t.min_price) AS min_min_price,
+    MAX(t.min_price) AS max_min_price,
+    MAX(t.max_price) AS max_max_price
+"""
+collection_daily_columns = ['contract_id', 'day', 'total_volume', 'total_num_trades', 'total_unique_buyers', 'num_avg_prices', 'sum_avg_price',
+                            'min_avg_price', 'max_avg_price', 'min_min_price', 'max_min_price', 'max_max_price']
+
+
+def mark_trade_days_dirty(df):
+    """
+    This function records the contract days whose trades changed so refresh_collection_daily() recalculates them.
+    Token trades, stored with the token id as contract_id, aren't part of the rollup
+
+    Args: df - DataFrame with contract_id and timestamp columns, and optionally the trade type
+    """
+    if 'type' in df.columns:
+        df = df[df['type'] == 'collection']
+    days = pd.to_datetime(df['timestamp']).dt.floor('D')
+    dirty_trade_days.update(zip(df['contract_id'], days))
+
+
+def refresh_collection_daily(contract_ids=None, start=None, end=None, full_refresh=False):
+    """
+    This function brings the collection_daily rollup up to date.  By default only the contract days whose
+    trades changed since the last refresh are recalculated, a contract list and/or time range recalculates
+    every day in it and full_refresh rebuilds the whole rollup.  Only the collection trades are rolled up
+
+    Args: contract_ids - optional list of contract ids to recalculate
+          start - optional lower bound (inclusive) of the days to recalculate
+          end - optional upper bound (exclusive) of the days to recalculate
+          full_refresh - rebuild the rollup from the whole trade table
+    Returns: number of recalculated contract days
+    """
+    column_list = ", ".join(collection_daily_columns)
+    update_list = ", ".join(f"{column} = EXCLUDED.{column}" for column in collection_daily_columns[2:])
+    if full_refresh or contract_ids is not None or start is not None or end is not None:
+        # Range refresh: partial days at the edges of the range are widened to whole days
+        filters, day_filters = ["t.type = 'collection'"], []
+        if contract_ids is not None:
+            filters.append("t.contract_key = ANY(%(contract_keys)s)")
+            day_filters.append("d.contract_id = ANY(%(contract_ids)s)")
+        if start is not None:
+            filters.append("t.timestamp >= DATE_TRUNC('day', %(start)s::TIMESTAMP)")
+            day_filters.append("d.day >= DATE_TRUNC('day', %(start)s::TIMESTAMP)")
+        if end is not None:
+            filters.append("t.timestamp < DATE_TRUNC('day', %(end)s::TIMESTAMP - INTERVAL '1 microsecond') + INTERVAL '1 day'")
+            day_filters.append("d.day < %(end)s::TIMESTAMP")
+        queries = [f"""
+        DELETE FROM {database_schema}.collection_daily d
+        {"WHERE " + " AND ".join(day_filters) if day_filters else ""}
+        """, f"""
+        INSERT INTO {database_schema}.collection_daily ({column_list})
+        SELECT k.contract_id, DATE_TRUNC('day', t.timestamp), {collection_daily_aggregates}
+        FROM {database_schema}.trade t
+        INNER JOIN {database_schema}.contract_dictionary k ON k.contract_key = t.contract_key
+        WHERE {" AND ".join(filters)}
+        GROUP BY k.contract_id, DATE_TRUNC('day', t.timestamp)
+        """]
+        params = {'contract_ids': list(contract_ids) if contract_ids is not None else None,
+                  'contract_keys': contract_keys(contract_ids) if contract_ids is not None else None, 'start': start, 'end': end}
+        days = None
+        if full_refresh and contract_ids is None and start is None and end is None:
+            dirty_trade_days.clear()
+    else:
+        days = set(dirty_trade_days)
+        dirty_trade_days.difference_update(days)
+        if not days:
+            return 0
+        # Days whose trades were all deleted are removed, the others are recalculated and upserted
+        queries = [f"""
+        DELETE FROM {database_schema}.collection_daily d
+        USING unnest(%(contract_ids)s::varchar[], %(contract_keys)s::int[], %(days)s::timestamp[]) AS k(contract_id, contract_key, day)
+        WHERE d.contract_id = k.contract_id AND d.day = k.day
+        AND NOT EXISTS (SELECT 1 FROM {database_schema}.trade t
+                        WHERE t.contract_key = k.contract_key AND t.timestamp >= k.day AND t.timestamp < k.day + INTERVAL '1 day'
+                        AND t.type = 'collection')
+        """, f"""
+        INSERT INTO {database_schema}.collection_daily ({column_list})
+        SELECT k.contract_id, k.day, {collection_daily_aggregates}
+        FROM {database_schema}.trade t
+        INNER JOIN unnest(%(contract_ids)s::varchar[], %(contract_keys)s::int[], %(days)s::timestamp[]) AS k(contract_id, contract_key, day)
+        ON t.contract_key = k.contract_key AND t.timestamp >= k.day AND t.timestamp < k.day + INTERVAL '1 day'
+        WHERE t.type = 'collection'
+        GROUP BY k.contract_id, k.day
+        ON CONFLICT (contract_id, day) DO UPDATE SET {update_list}
+        """]
+        params = {'contract_ids': [contract_id for contract_id, day in days],
+                  'contract_keys': contract_dictionary.to_keys(contract_id for contract_id, day in days),
+                  'days': [day.to_pydatetime() for contract_id, day in days]}
+    try:
+        with engine.begin() as conn:
+            for sql_query in queries:
+                result = conn.execute(sql_query, params)
+        logger.info(f"refresh_collection_daily() recalculated {result.rowcount} contract days")
+        return result.rowcount
+    except Exception as ex:
+        logger.debug(queries)
+        logger.error(ex)
+        if days:
+            # Keep the days so the next refresh retries them
+            dirty_trade_days.update(days)
+
+
+"""
+
+    Streaming readers
+
+"""
+table_columns_cache = {}
+
+
+def get_table_columns(table):
+    """
+    This function returns the column names of a table, used to validate column projections
+
+    Args: table - name of the table
+    Returns: List
+    """
+    if table not in table_columns_cache:
+        inspector = inspect(engine)
+        table_columns_cache[table] = [column['name'] for column in inspector.get_columns(table, database_schema)]
+    return table_columns_cache[table]
+
+
+def select_list(table, columns=None, alias=None):
+    """
+    This function builds the SELECT list for a column projection after checking every
+    column exists in the table.  Id columns of the keyed tables select the key column
+
+    Args: table - name of the table
+          columns - list of column names, None selects every column
+          alias - optional table alias to prefix the columns with
+    Returns: string
+    """
+    prefix = f"{alias}." if alias else ""
+    if not columns:
+        return f"{prefix}*"
+    columns = [storage_column(table, column) for column in columns]
+    unknown = [column for column in columns if column not in get_table_columns(table_views.get(table, table))]
+    if unknown:
+        raise ValueError(f"Unknown columns for {table}: {unknown}")
+    return ", ".join(f"{prefix}{column}" for column in columns)
+
+
+def stream_query(sql_query, params=None, chunk_size=50000):
+    """
+    This function runs a query on a server-side cursor and yields the result in DataFrame
+    chunks, so results larger than memory can be processed one chunk at a time
+
+    Args: sql_query - the SELECT statement, with :name bind parameters
+          params - dictionary of bind parameter values
+          chunk_size - number of rows per DataFrame chunk
+    Returns: generator of DataFrames
+    """
+    try:
+        with read_engine().connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as conn:
+            for chunk in pd.read_sql_query(text(sql_query), con = conn, params = params, chunksize = chunk_size):
+                yield decode_frame(chunk)
+    except Exception as ex:
+        logger.debug(sql_query)
+        logger.error(ex)
+        raise
+
+
+def stream_trades(contract_ids=None, start=None, end=None, columns=None, chunk_size=50000):
+    """
+    This function streams the trade table in DataFrame chunks
+
+    Args: contract_ids - optional list of contract or token ids to filter on
+          start - optional lower bound (inclusive) of the trade timestamp
+          end - optional upper bound (exclusive) of the trade timestamp
+          columns - optional list of columns to return, default all
+          chunk_size - number of rows per DataFrame chunk
+    Returns: generator of DataFrames
+    """
+    filters = []
+    if contract_ids is not None:
+        filters.append("contract_key = ANY(:contract_keys)")
+    if start is not None:
+        filters.append("timestamp >= :start")
+    if end is not None:
+        filters.append("timestamp < :end")
+    sql_query = f"""
+    SELECT {select_list('trade', columns)}
+    FROM {database_schema}.trade
+    {"WHERE " + " AND ".join(filters) if filters else ""}
+    """
+    params = {'contract_keys': contract_keys(contract_ids) if contract_ids is not None else None, 'start': start, 'end': end}
+    return stream_query(sql_query, params, chunk_size)
+
+
+def stream_collections(contract_ids=None, network_id=None, columns=None, chunk_size=50000):
+    """
+    This function streams the collection table in DataFrame chunks
+
+    Args: contract_ids - optional list of contract ids to filter on
+          network_id - optional network to filter on
+          columns - optional list of columns to return, default all
+          chunk_size - number of rows per DataFrame chunk
+    Returns: generator of DataFrames
+    """
+    filters = []
+    if contract_ids is not None:
+        filters.append("contract_id = ANY(:contract_ids)")
+    if network_id is not None:
+        filters.append("network_id = :network_id")
+    sql_query = f"""
+    SELECT {select_list('collection', columns)}
+    FROM {database_schema}.collection
+    {"WHERE " + " AND ".join(filters) if filters else ""}
+    """
+    params = {'contract_ids': list(contract_ids) if contract_ids is not None else None, 'network_id': network_id}
+    return stream_query(sql_query, params, chunk_size)
+
+
+def stream_tokens(contract_ids=None, columns=None, chunk_size=50000):
+    """
+    This function streams the token table in DataFrame chunks
+
+    Args: contract_ids - optional list of contract ids whose tokens are returned
+          columns - optional list of columns to return, default all
+          chunk_size - number of rows per DataFrame chunk
+    Returns: generator of DataFrames
+    """
+    sql_query = f"""
+    SELECT {select_list('token', columns)}
+    FROM {database_schema}.token
+    {"WHERE contract_key = ANY(:contract_keys)" if contract_ids is not None else ""}
+    """
+    params = {'contract_keys': contract_keys(contract_ids) if contract_ids is not None else None}
+    return stream_query(sql_query, params, chunk_size)
+
+
+def stream_token_attributes(contract_ids=None, token_ids=None, columns=None, chunk_size=50000):
+    """
+    This function streams the token attributes with their trait in DataFrame chunks
+
+    Args: contract_ids - optional list of contract ids whose token attributes are returned
+          token_ids - optional list of token ids to filter on
+          columns - optional list of columns to return, default all
+          chunk_size - number of rows per DataFrame chunk
+    Returns: generator of DataFrames
+    """
+    filters = []
+    if contract_ids is not None:
+        filters.append(f"ta.token_key IN (SELECT token_key FROM {database_schema}.token WHERE contract_key = ANY(:contract_keys))")
+    if token_ids is not None:
+        filters.append("ta.token_key = ANY(:token_keys)")
+    sql_query = f"""
+    SELECT {select_list('token_attribute', columns, alias='ta')}
+    FROM {database_schema}.token_trait ta
+    {"WHERE " + " AND ".join(filters) if filters else ""}
+    """
+    params = {'contract_keys': contract_keys(contract_ids) if contract_ids is not None else None,
+              'token_keys': token_keys(token_ids) if token_ids is not None else None}
+    return stream_query(sql_query, params, chunk_size)
+
+
+"""
+
+    Contract migrations
+
+"""
+class ContractGraph(object):
+    '''
+    The contract_map migration graph with its transitive closure precomputed: the contract
+    every contract was finally migrated to (canonical) and the lineage of every canonical
+    contract, i.e. all the contract ids its history is spread across, newest first
+    '''
+    def __init__(self, df):
+        '''
+        Class constructor or initialization method
+        '''
+        new_contract_ids = {}
+        for contract_id, new_contract_id in sorted(zip(df['contract_id'], df['new_contract_id'])):
+            if new_contract_id is not None and new_contract_id != contract_id:
+                new_contract_ids.setdefault(contract_id, new_contract_id)
+        self.canonical = {}
+        self.lineages = {}
+        depths = {}
+        for contract_id in new_contract_ids:
+            # Follow the migrations to the last contract, stopping on a cycle
+            current, depth, seen = contract_id, 0, {contract_id}
+            while current in new_contract_ids and new_contract_ids[current] not in seen:
+                current = new_contract_ids[current]
+                seen.add(current)
+                depth += 1
+            self.canonical[contract_id] = current
+            depths[contract_id] = depth
+            self.lineages.setdefault(current, [current])
+        for contract_id in sorted(depths, key=lambda contract_id: (depths[contract_id], contract_id)):
+            if contract_id != self.canonical[contract_id]:
+                self.lineages[self.canonical[contract_id]].append(contract_id)
+
+    def resolve(self, contract_id):
+        """
+        Returns the contract the contract id was finally migrated to, or itself
+        """
+        return self.canonical.get(contract_id, contract_id)
+
+    def lineage(self, contract_id):
+        """
+        Returns every contract id of the contract's history, the canonical one first
+        """
+        return list(self.lineages.get(self.resolve(contract_id), [contract_id]))
+
+
+def get_contract_graph():
+    """
+    This function returns the contract migration graph.  It's loaded from the primary with one query
+    and kept in the reference cache until contract_map changes or the cache ttl expires, a lagging
+    replica could cache a graph without the contracts mapped a moment ago
+
+    Returns: ContractGraph
+    """
+    hit, graph = reference_cache.get('contract_map', None)
+    if not hit:
+        sql_query = f"""
+        SELECT contract_id, new_contract_id
+        FROM {database_schema}.contract_map
+        """
+        graph = ContractGraph(pd.read_sql_query(sql_query, con = engine))
+        reference_cache.set('contract_map', None, graph)
+    return graph
+
+
+def resolve_contract_ids(contract_ids):
+    """
+    This function maps contract ids to the contract they were finally migrated to
+
+    Args: contract_ids - a contract id, list of contract ids or Series
+    Returns: contract id, list or Series matching the input
+    """
+    graph = get_contract_graph()
+    if isinstance(contract_ids, pd.Series):
+        return contract_ids.map(lambda contract_id: graph.canonical.get(contract_id, contract_id))
+    if isinstance(contract_ids, str):
+        return graph.resolve(contract_ids)
+    return [graph.resolve(contract_id) for contract_id in contract_ids]
+
+
+def get_contract_lineage(contract_id):
+    """
+    This function returns every contract id a collection's history is spread across
+
+    Args: contract_id - any contract id of the collection
+    Returns: List, the canonical contract id first
+    """
+    return get_contract_graph().lineage(contract_id)
+
+
+def get_merged_trades(contract_ids, start=None, end=None, columns=None):
+    """
+    This function retrieves the trade history of collections stitched across their migrations.
+    Trades of every contract of a collection's lineage are returned under the canonical contract
+    id in one series; when old and new contracts both have a trade for the same timestamp the
+    newest contract's trade is kept
+
+    Args: contract_ids - contract id or list of contract ids, old or new
+          start - optional lower bound (inclusive) of the trade timestamp
+          end - optional upper bound (exclusive) of the trade timestamp
+          columns - optional list of trade columns to return, default all
+    Returns: DataFrame with contract_id (canonical), timestamp, the columns and source_contract_id
+    """
+    if isinstance(contract_ids, str):
+        contract_ids = [contract_ids]
+    graph = get_contract_graph()
+    member_ids, canonical_ids, priorities = [], [], []
+    for canonical_id in dict.fromkeys(graph.resolve(contract_id) for contract_id in contract_ids):
+        for priority, member_id in enumerate(graph.lineage(canonical_id)):
+            member_ids.append(member_id)
+            canonical_ids.append(canonical_id)
+            priorities.append(priority)
+    columns = [column for column in (columns or get_table_columns('trade')) if column not in ('contract_id', 'contract_key', 'timestamp')]
+    filters = []
+    if start is not None:
+        filters.append("t.timestamp >= %(start)s")
+    if end is not None:
+        filters.append("t.timestamp < %(end)s")
+    sql_query = f"""
+    SELECT DISTINCT ON (k.canonical_id, t.timestamp)
+           k.canonical_id AS contract_id,
+           t.timestamp,
+           {select_list('trade', columns, alias='t') + "," if columns else ""}
+           k.member_id AS source_contract_id
+    FROM {database_schema}.trade t
+    INNER JOIN unnest(%(member_keys)s::int[], %(member_ids)s::varchar[], %(canonical_ids)s::varchar[], %(priorities)s::int[])
+         AS k(member_key, member_id, canonical_id, priority)
+    ON t.contract_key = k.member_key
+    {"WHERE " + " AND ".join(filters) if filters else ""}
+    ORDER BY k.canonical_id, t.timestamp, k.priority
+    """
+    params = {'member_keys': contract_dictionary.to_keys(member_ids), 'member_ids': member_ids, 'canonical_ids': canonical_ids,
+              'priorities': priorities, 'start': start, 'end': end}
+    try:
+        df = pd.read_sql_query(sql_query, con = read_engine(), params = params)
+        return df
+    except Exception as ex:
+        logger.debug(sql_query)
+        logger.error(ex)
+
+
+
 """
 
     CRUD Operations for the Trades table
@@ -92,11 +1491,11 @@ def get_all_trades(contract_id):
     sql_query = f"""
     SELECT * 
     FROM {database_schema}.trade   
-    WHERE contract_id = '{contract_id}'
+    WHERE contract_key = {contract_key(contract_id)}
     """    
     try:
-        df = pd.read_sql_query(sql_query, con = engine)    
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())    
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex)      
@@ -114,17 +1513,85 @@ def get_trade(contract_id, time):
     sql_query = f"""
     SELECT * 
     FROM {database_schema}.trade   
-    WHERE contract_id = '{contract_id}'
+    WHERE contract_key = {contract_key(contract_id)}
     AND timestamp = '{time}'
     """
     try:        
-        df = pd.read_sql_query(sql_query, con = engine)                
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())                
+        return decode_frame(df)
     except Exception as ex: 
         logger.debug(sql_query)   
         logger.error(ex)  
 
 
+# Granularities query_trades() can resample to, the date_trunc field of each
+trade_granularities = ['minute', 'hour', 'day', 'week', 'month', 'quarter', 'year']
+
+# How each trade column is aggregated when trades are resampled.  The average price is weighted by
+# the number of trades and falls back to the plain average for periods without a trade count
+trade_aggregates = {
+    'avg_price':     "COALESCE(SUM(avg_price * num_trades) / NULLIF(SUM(num_trades), 0), AVG(avg_price))",
+    'max_price':     "MAX(max_price)",
+    'min_price':     "MIN(min_price)",
+    'num_trades':    "SUM(num_trades)",
+    'unique_buyers': "SUM(unique_buyers)",
+    'volume':        "SUM(volume)",
+}
+
+
+def query_trades(contract_ids=None, start=None, end=None, trade_type=None, columns=None, granularity=None):
+    """
+    This function retrieves trades with the filtering, projection and resampling done by the database,
+    so only the rows and columns the caller needs are returned
+
+    Args: contract_ids - optional list of contract or token ids to filter on
+          start - optional lower bound (inclusive) of the trade timestamp
+          end - optional upper bound (exclusive) of the trade timestamp
+          trade_type - optional trade type i.e. 'collection' or 'token'
+          columns - optional list of columns to return besides contract_id and timestamp, default all
+          granularity - optional period to resample the trades to i.e. 'hour', 'day', 'week' or 'month'
+    Returns: DataFrame ordered by contract and timestamp
+    """
+    columns = [column for column in (columns or get_table_columns('trade')) if column not in ('contract_id', 'contract_key', 'timestamp')]
+    select_list('trade', columns)
+    filters = []
+    if contract_ids is not None:
+        filters.append("contract_key = ANY(%(contract_keys)s)")
+    if start is not None:
+        filters.append("timestamp >= %(start)s")
+    if end is not None:
+        filters.append("timestamp < %(end)s")
+    if trade_type is not None:
+        filters.append("type = %(trade_type)s")
+    where = "WHERE " + " AND ".join(filters) if filters else ""
+    if granularity is None:
+        sql_query = f"""
+        SELECT {", ".join(['contract_key', 'timestamp'] + columns)}
+        FROM {database_schema}.trade
+        {where}
+        ORDER BY contract_key, timestamp
+        """
+    else:
+        if granularity not in trade_granularities:
+            raise ValueError(f"Unknown granularity {granularity}, expected one of {trade_granularities}")
+        # Text columns i.e. period, type and api_id keep one value of the period
+        aggregates = [f"{trade_aggregates.get(column, f'MIN({column})')} AS {column}" for column in columns]
+        sql_query = f"""
+        SELECT {", ".join(['contract_key', f"DATE_TRUNC('{granularity}', timestamp) AS timestamp"] + aggregates)}
+        FROM {database_schema}.trade
+        {where}
+        GROUP BY contract_key, DATE_TRUNC('{granularity}', timestamp)
+        ORDER BY contract_key, DATE_TRUNC('{granularity}', timestamp)
+        """
+    params = {'contract_keys': contract_keys(contract_ids) if contract_ids is not None else None, 'start': start, 'end': end, 'trade_type': trade_type}
+    try:
+        df = pd.read_sql_query(sql_query, con = read_engine(), params = params)
+        return decode_frame(df)
+    except Exception as ex:
+        logger.debug(sql_query)
+        logger.error(ex)
+
+
 def delete_trade(contract_id, time):
     """
     This function deletes a specific trade  
@@ -135,13 +1602,14 @@ def delete_trade(contract_id, time):
     """       
     delete_query = f"""
     DELETE FROM {database_schema}.trade   
-    WHERE contract_id = '{contract_id}'
+    WHERE contract_key = {contract_key(contract_id)}
     AND timestamp = '{time}'
     """  
     try:  
         with engine.connect() as conn:
             conn.execute(delete_query)
             print(f"The trade for {contract_id} at {time} was successfully deleted!")
+        mark_trade_days_dirty(pd.DataFrame({'contract_id': [contract_id], 'timestamp': [time]}))
     except Exception as ex:   
         logger.debug(delete_query) 
         logger.error(ex)  
@@ -181,12 +1649,13 @@ def update_trade(df):
         period = '{df['period']}',
         type = '{df['type']}',
         api_id = '{df['api_id']}'
-    WHERE contract_id = '{df['contract_id']}'
+    WHERE contract_key = {contract_key(df['contract_id'])}
     AND timestamp = '{df['time']}'
     """
     try:    
         with engine.connect() as conn:
             conn.execute(update_query)
+        mark_trade_days_dirty(pd.DataFrame({'contract_id': [df['contract_id']], 'timestamp': [df['time']]}))
     except Exception as ex: 
         logger.debug(update_query)   
         logger.error(ex)              
@@ -199,12 +1668,13 @@ def insert_trade(df):
     Args: df - data collection of trades
     """    
     insert_query = f"""
-    INSERT INTO {database_schema}.trade (contract_id, timestamp, avg_price, max_price, min_price, num_trades, unique_buyers, volume, period, type, api_id)
-    VALUES ('{df['contract_id']}', '{df['time']}', {round(df['avg_price'], 2)}, {round(df['max_price'], 2)}, {round(df['min_price'], 2)}, {df['trades']}, {df['unique_buyers']}, {round(df['volume'], 2)}, '{df['period']}', '{df['type']}', '{df['api_id']}')
+    INSERT INTO {database_schema}.trade (contract_key, timestamp, avg_price, max_price, min_price, num_trades, unique_buyers, volume, period, type, api_id)
+    VALUES ({contract_key(df['contract_id'], create=True)}, '{df['time']}', {round(df['avg_price'], 2)}, {round(df['max_price'], 2)}, {round(df['min_price'], 2)}, {df['trades']}, {df['unique_buyers']}, {round(df['volume'], 2)}, '{df['period']}', '{df['type']}', '{df['api_id']}')
     """  
     try:  
         with engine.connect() as conn:
             conn.execute(insert_query)
+        mark_trade_days_dirty(pd.DataFrame({'contract_id': [df['contract_id']], 'timestamp': [df['time']]}))
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex)      
@@ -215,20 +1685,12 @@ def save_trade(df):
     This function saves the collection data into a postgres database residing in AWS
     
     Args: df - data collection of trades
-    """    
-    for row_index in df.index:      
-        # Write contract_id to log file
-        logger.info(f"save_trade() function called for contract_id: {df.iloc[row_index]['contract_id']} and timestamp: {df.iloc[row_index]['time']}")               
-
-        # First check if the trade exists
-        trade_exists = check_if_trade_exists(df.iloc[row_index]['contract_id'], df.iloc[row_index]['time'])
-        
-        # If the trade exists then we update the information.  Otherwise, we add a new trade
-        if trade_exists:
-            #update_trade(df.iloc[row_index])
-            pass
-        else:
-            insert_trade(df.iloc[row_index])                    
+    """
+    # Write contract_ids to log file
+    logger.info(f"save_trade() function called for contract_id: {df['contract_id'].unique().tolist()}")
+
+    # Trades that already exist are skipped, new trades are added in bulk
+    save_many('trade', prepare_trade_frame(df))
 
 
 
@@ -248,13 +1710,14 @@ def get_all_collections():
     FROM {database_schema}.collection  
     """  
     try:  
-        df = pd.read_sql_query(sql_query, con = engine)    
+        df = pd.read_sql_query(sql_query, con = read_engine())    
         return df
     except Exception as ex: 
         logger.debug(sql_query)   
         logger.error(ex)  
 
 
+@cached_lookup('collection')
 def get_collection(contract_id):
     """
     This function returns information for a specific collection   
@@ -288,6 +1751,7 @@ def delete_collection(contract_id):
     try:  
         with engine.connect() as conn:
             conn.execute(delete_query)
+            reference_cache.invalidate('collection', contract_id)
             print(f"{contract_id} was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -337,6 +1801,8 @@ def update_collection(contract_id, df):
     try:
         with engine.connect() as conn:
             conn.execute(update_query)
+            reference_cache.invalidate('collection', contract_id)
+        refresh_collection_lists([contract_id])
     except Exception as ex:
         logger.debug(update_query)            
         logger.error(ex)   
@@ -361,6 +1827,8 @@ def insert_collection(contract_id, df):
     try:
         with engine.connect() as conn:
             conn.execute(insert_query)
+            reference_cache.invalidate('collection', contract_id)
+        refresh_collection_lists([contract_id])
     except Exception as ex:
         logger.debug(insert_query)        
         logger.error(ex)  
@@ -371,20 +1839,126 @@ def save_collection(contract_df):
     This function saves the collection data into a postgres database residing in AWS
     
     Args: df - data collection of collections
-    """    
-    for row_index in contract_df.index: 
-        contract_id = contract_df['contract_id'][row_index]
-        # Write contract_id to log file
-        logger.info(f"save_collection() function called for contract_id: {contract_id}")    
+    """
+    # Write contract_ids to log file
+    logger.info(f"save_collection() function called for contract_id: {contract_df['contract_id'].tolist()}")
 
-        # First check if the collection exists
-        collection_exists = check_if_collection_exists(contract_id)
+    # Collections that already exist are updated, new collections are added in bulk
+    save_many('collection', prepare_collection_frame(contract_df))
 
-        # If the collection exists then we update the information.  Otherwise, we add a new collection
-        if collection_exists:
-            update_collection(contract_id, contract_df.iloc[row_index])
-        else:
-            insert_collection(contract_id, contract_df.iloc[row_index])                                
+
+
+"""
+
+    Collection exclusions and watchlists
+
+"""
+# Collections left out of the dashboard and the analytics, by name.  A collection without a name is excluded too
+excluded_collection_names = ['', 'New 0x495f947276749Ce646f68AC8c248420045cb7b5eLock', 'pieceofshit', 'Uniswap V3 Positions NFT-V1', 'More Loot',
+                             'NFTfi Promissory Note', 'dementorstownwtf', 'ShitBeast', 'mcgoblintownwtf', 'LonelyPop', 'Pablos', 'For the Culture',
+                             'Hype Pass', 'Moonbirds Oddities', 'AIMoonbirds', 'Bound NFT CloneX']
+
+# Collections left out whose name matches this regular expression: unidentified contracts, spam and names made of an address
+excluded_collection_pattern = "Unidentified contract|[Ss]hit|0x"
+
+# Watchlists and the names of their collections
+watchlists = {
+    'top_ten': ['CryptoPunks', 'BoredApeYachtClub', 'MutantApeYachtClub', 'Otherdeed', 'Azuki', 'CloneX', 'Moonbirds', 'Doodles',
+                'Meebits', 'Cool Cats', 'BoredApeKennelClub'],
+    'opensea_top_ten': ['CryptoPunks', 'BoredApeYachtClub', 'MutantApeYachtClub', 'Otherdeed', 'Azuki', 'CloneX', 'Moonbirds', 'Doodles',
+                        'Cool Cats', 'BoredApeKennelClub'],
+}
+
+
+def refresh_collection_lists(contract_ids=None):
+    """
+    This function applies the exclusion and watchlist rules above to the collections and stores the result
+    in the collection_exclusion and watchlist_collection tables, which the dashboard and the analytics join
+    on instead of filtering by name.  Rows added by hand (manual) are left alone
+
+    Args: contract_ids - optional list of collections to refresh, default all
+    """
+    contract_filter = "AND {alias}.contract_id = ANY(%(contract_ids)s)" if contract_ids is not None else ""
+    queries = [f"""
+    DELETE FROM {database_schema}.collection_exclusion e
+    WHERE NOT e.manual
+    {contract_filter.format(alias='e')}
+    """, f"""
+    INSERT INTO {database_schema}.collection_exclusion (contract_id, reason)
+    SELECT c.contract_id, CASE WHEN COALESCE(c.name, '') = ANY(%(names)s) THEN 'name' ELSE 'pattern' END
+    FROM {database_schema}.collection c
+    WHERE (COALESCE(c.name, '') = ANY(%(names)s) OR c.name ~ %(pattern)s)
+    {contract_filter.format(alias='c')}
+    ON CONFLICT (contract_id) DO NOTHING
+    """, f"""
+    DELETE FROM {database_schema}.watchlist_collection w
+    WHERE NOT w.manual
+    AND w.watchlist = ANY(%(watchlists)s)
+    {contract_filter.format(alias='w')}
+    """, f"""
+    INSERT INTO {database_schema}.watchlist_collection (watchlist, contract_id)
+    SELECT l.watchlist, c.contract_id
+    FROM {database_schema}.collection c
+    INNER JOIN unnest(%(list_watchlists)s::varchar[], %(list_names)s::varchar[]) AS l(watchlist, name)
+    ON l.name = c.name {contract_filter.format(alias='c')}
+    ON CONFLICT (watchlist, contract_id) DO NOTHING
+    """]
+    members = [(watchlist, name) for watchlist, names in watchlists.items() for name in names]
+    params = {'contract_ids': list(contract_ids) if contract_ids is not None else None,
+              'names': excluded_collection_names, 'pattern': excluded_collection_pattern, 'watchlists': list(watchlists),
+              'list_watchlists': [watchlist for watchlist, name in members], 'list_names': [name for watchlist, name in members]}
+    try:
+        with engine.begin() as conn:
+            for query in queries:
+                conn.execute(query, params)
+        logger.info(f"refresh_collection_lists() refreshed {'all' if contract_ids is None else len(contract_ids)} collections")
+    except Exception as ex:
+        logger.debug(queries)
+        logger.error(ex)
+
+
+
+"""
+
+    ETL runs
+
+"""
+def start_etl_run():
+    """
+    This function records the start of an ETL run
+
+    Returns: the run id, or None if the run couldn't be recorded
+    """
+    insert_query = f"INSERT INTO {database_schema}.etl_run DEFAULT VALUES RETURNING run_id"
+    try:
+        with engine.begin() as conn:
+            run_id = conn.execute(insert_query).scalar()
+        logger.info(f"start_etl_run() started run {run_id}")
+        return run_id
+    except Exception as ex:
+        logger.debug(insert_query)
+        logger.error(ex)
+        return None
+
+
+def finish_etl_run(run_id, failed=False):
+    """
+    This function records the end of an ETL run.  The latest finished run is the version of the data,
+    the dashboard reloads its cached data once a newer run has finished
+
+    Args: run_id - the run id returned by start_etl_run()
+          failed - the run lost data, e.g. rows the BufferedWriter couldn't write
+    """
+    if run_id is None:
+        return
+    update_query = f"UPDATE {database_schema}.etl_run SET finished_at = now(), failed = %(failed)s WHERE run_id = %(run_id)s"
+    try:
+        with engine.begin() as conn:
+            conn.execute(update_query, {'run_id': run_id, 'failed': failed})
+        logger.info(f"finish_etl_run() finished run {run_id}{' as failed' if failed else ''}")
+    except Exception as ex:
+        logger.debug(update_query)
+        logger.error(ex)
 
 
 
@@ -404,13 +1978,14 @@ def get_all_networks():
     FROM {database_schema}.network   
     """  
     try:  
-        df = pd.read_sql_query(sql_query, con = engine)    
+        df = pd.read_sql_query(sql_query, con = read_engine())    
         return df
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
 
 
+@cached_lookup('network')
 def get_network(network_id):
     """
     This function returns information for a specific network 
@@ -444,6 +2019,7 @@ def delete_network(network_id):
     try:   
         with engine.connect() as conn:
             conn.execute(delete_query)
+            reference_cache.invalidate('network', network_id)
             print(f"{network_id} was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -479,6 +2055,8 @@ def update_network(network_id, df):
     try:
         with engine.connect() as conn:
             conn.execute(update_query)
+            reference_cache.invalidate('network', network_id)
+            reference_cache.invalidate('network', df['network_id'])
     except Exception as ex:  
         logger.debug(update_query)  
         logger.error(ex) 
@@ -498,6 +2076,7 @@ def insert_network(network_id, df):
     try:  
         with engine.connect() as conn:
             conn.execute(insert_query)
+            reference_cache.invalidate('network', network_id)
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex) 
@@ -509,16 +2088,9 @@ def save_network(network_id, df):
     
     Args: network_id - the id of a specific blockchain
           df - data collection of networks
-    """    
-    for row_index in df.index: 
-        # First check if the network exists
-        network_exists = check_if_network_exists(network_id)
-        
-        # If the network exists then we update the information.  Otherwise, we add a new network
-        if network_exists:
-            update_network(network_id, df.iloc[row_index])
-        else:
-            insert_network(network_id, df.iloc[row_index])                                
+    """
+    # Networks that already exist are updated, new networks are added in bulk
+    save_many('network', df.assign(network_id = network_id))
 
 
 
@@ -538,13 +2110,14 @@ def get_all_api_requests():
     FROM {database_schema}.api   
     """   
     try: 
-        df = pd.read_sql_query(sql_query, con = engine)    
+        df = pd.read_sql_query(sql_query, con = read_engine())    
         return df
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
 
 
+@cached_lookup('api')
 def get_api_request(api_id):
     """
     This function returns information for a specific api
@@ -578,6 +2151,7 @@ def delete_api_request(api_id):
     try:  
         with engine.connect() as conn:
             conn.execute(delete_query)
+            reference_cache.invalidate('api', api_id)
             print(f"{api_id} was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -616,6 +2190,7 @@ def update_api_request(api_id, df):
     try:
         with engine.connect() as conn:
             conn.execute(update_query)
+            reference_cache.invalidate('api', api_id)
     except Exception as ex:  
         logger.debug(update_query)  
         logger.error(ex) 
@@ -635,6 +2210,7 @@ def insert_api_request(api_id, df):
     try:  
         with engine.connect() as conn:
             conn.execute(insert_query)
+            reference_cache.invalidate('api', api_id)
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex)     
@@ -646,16 +2222,9 @@ def save_api_request(api_id, df):
     
     Args: api_id - the id of a specific api
           df - data collection of networks
-    """    
-    for row_index in df.index: 
-        # First check if the api exists
-        api_exists = check_if_api_exists(api_id)
-        
-        # If the api request exists then we update the information.  Otherwise, we add a new api request
-        if api_exists:
-            update_api_request(api_id, df.iloc[row_index])
-        else:
-            insert_api_request(api_id, df.iloc[row_index])                                
+    """
+    # Api requests that already exist are updated, new api requests are added in bulk
+    save_many('api', df.assign(api_id = api_id))
 
 
 
@@ -675,13 +2244,14 @@ def get_all_whales():
     FROM {database_schema}.whale  
     """    
     try:
-        df = pd.read_sql_query(sql_query, con = engine)    
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())    
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
 
 
+@cached_lookup('whale')
 def get_whale(wallet_id):
     """
     This function returns information for a specific whale
@@ -696,7 +2266,7 @@ def get_whale(wallet_id):
     """  
     try:      
         df = pd.read_sql_query(sql_query, con = engine)                
-        return df
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
@@ -715,6 +2285,7 @@ def delete_whale(wallet_id):
     try:   
         with engine.connect() as conn:
             conn.execute(delete_query)
+            reference_cache.invalidate('whale', wallet_id)
             print(f"{wallet_id} was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -746,12 +2317,13 @@ def update_whale(wallet_id, df):
     """
     update_query = f"""
     UPDATE {database_schema}.whale
-    SET contract_id  = '{df['contract_id']}',
+    SET contract_key  = {contract_key(df['contract_id'], create=True)},
     WHERE wallet_id = '{wallet_id}'
     """    
     try:
         with engine.connect() as conn:
             conn.execute(update_query)
+            reference_cache.invalidate('whale', wallet_id)
     except Exception as ex:  
         logger.debug(update_query)  
         logger.error(ex) 
@@ -765,12 +2337,13 @@ def insert_whale(wallet_id, df):
           df - data collection of networks
     """    
     insert_query = f"""
-    INSERT INTO {database_schema}.whale (wallet_id, contract_id)
-    VALUES ('{wallet_id}', '{df['contract_id']}')
+    INSERT INTO {database_schema}.whale (wallet_id, contract_key)
+    VALUES ('{wallet_id}', {contract_key(df['contract_id'], create=True)})
     """ 
     try:   
         with engine.connect() as conn:
             conn.execute(insert_query)
+            reference_cache.invalidate('whale', wallet_id)
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex)     
@@ -782,16 +2355,9 @@ def save_the_whales(wallet_id, df):
     
     Args: wallet_id - a whale's wallet address
           df - data collection of the whale's information
-    """    
-    for row_index in df.index: 
-        # First check if the whale exists
-        whale_exists = check_if_whale_exists(wallet_id)
-        
-        # If the whale exists then we update the information.  Otherwise, we add a new whale
-        if whale_exists:
-            update_whale(wallet_id, df.iloc[row_index])
-        else:
-            insert_whale(wallet_id, df.iloc[row_index])                                
+    """
+    # The whale's information is replaced in bulk
+    save_many('whale', df.assign(wallet_id = wallet_id))
 
 
 
@@ -811,13 +2377,14 @@ def get_all_contract_maps():
     FROM {database_schema}.contract_map  
     """    
     try:
-        df = pd.read_sql_query(sql_query, con = engine)    
+        df = pd.read_sql_query(sql_query, con = read_engine())    
         return df
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
 
 
+@cached_lookup('contract_map')
 def get_contract_maps(contract_id):
     """
     This function returns information for a specific contract mapping  
@@ -851,6 +2418,7 @@ def delete_contract_maps(contract_id):
     try:
         with engine.connect() as conn:
             conn.execute(delete_query)
+            reference_cache.invalidate('contract_map', contract_id)
             print(f"{contract_id} was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -888,6 +2456,7 @@ def update_contract_map(contract_id, df):
     try:  
         with engine.connect() as conn:
             conn.execute(update_query)
+            reference_cache.invalidate('contract_map', contract_id)
     except Exception as ex:  
         logger.debug(update_query)  
         logger.error(ex) 
@@ -907,6 +2476,7 @@ def insert_contract_map(contract_id, df):
     try: 
         with engine.connect() as conn:
             conn.execute(insert_query)
+            reference_cache.invalidate('contract_map', contract_id)
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex)     
@@ -918,16 +2488,9 @@ def save_contract_maps(contract_id, df):
     
     Args: contract_id - a collection's contract id
           df - data collection of trades
-    """    
-    for row_index in df.index: 
-        # First check if the contract mapping exists
-        contract_map_exists = check_if_contract_map_exists(contract_id)
-        
-        # If the contract mapping exists then we update the information.  Otherwise, we add a new contract mapping
-        if contract_map_exists:
-            update_contract_map(contract_id, df.iloc[row_index])
-        else:
-            insert_contract_map(contract_id, df.iloc[row_index])                                
+    """
+    # The contract mapping is replaced in bulk
+    save_many('contract_map', df.assign(contract_id = contract_id))
 
 
 
@@ -947,8 +2510,8 @@ def get_all_tokens():
     FROM {database_schema}.token  
     """    
     try:
-        df = pd.read_sql_query(sql_query, con = engine)    
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())    
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
@@ -964,11 +2527,11 @@ def get_token(token_id):
     sql_query = f"""
     SELECT * 
     FROM {database_schema}.token  
-    WHERE token_id = '{token_id}'
+    WHERE token_key = {token_key(token_id)}
     """        
     try:
         df = pd.read_sql_query(sql_query, con = engine)                
-        return df
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
@@ -982,11 +2545,12 @@ def delete_token(token_id):
     """       
     delete_query = f"""
     DELETE FROM {database_schema}.token  
-    WHERE token_id = '{token_id}'
+    WHERE token_key = {token_key(token_id)}
     """ 
     try:   
         with engine.connect() as conn:
             conn.execute(delete_query)
+            mark_token_scores_dirty(token_ids=[token_id])
             logger.info(f"{token_id} was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -1024,12 +2588,13 @@ def update_token(token_id, df):
     SET id_num = '{df['id_num']}',
         name  = '{name}',
         description = '{descr}',
-        contract_id = '{df['contract_id']}'
-    WHERE token_id = '{token_id}'
+        contract_key = {contract_key(df['contract_id'], create=True)}
+    WHERE token_key = {token_key(token_id)}
     """ 
     try:   
         with engine.connect() as conn:
             conn.execute(update_query)
+            mark_token_scores_dirty(contract_ids=[df['contract_id']])
     except Exception as ex:  
         logger.debug(update_query)  
         logger.error(ex) 
@@ -1046,12 +2611,13 @@ def insert_token(token_id, df):
     descr = scrub_str(df['description'])
            
     insert_query = f"""
-    INSERT INTO {database_schema}.token (token_id, id_num, name, description, contract_id)
-    VALUES ('{token_id}', '{df['id_num']}', '{name}', '{descr}', '{df['contract_id']}')
+    INSERT INTO {database_schema}.token (token_key, id_num, name, description, contract_key)
+    VALUES ({token_key(token_id, create=True)}, '{df['id_num']}', '{name}', '{descr}', {contract_key(df['contract_id'], create=True)})
     """    
     try:
         with engine.connect() as conn:
             conn.execute(insert_query)
+            mark_token_scores_dirty(contract_ids=[df['contract_id']])
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex)     
@@ -1062,22 +2628,12 @@ def save_token(token_df):
     This function saves the token data into a postgres database residing in AWS
     
     Args: df - data collection of tokens thats part of a specific contract i.e. Collection
-    """    
-    for row_index in token_df.index: 
-        token_id = token_df['token_id'][row_index]
-
-        # Write token_id to log file
-        logger.info(f"save_token() function called for token_id: {token_id}")               
-
-        # First check if the token exists
-        token_exists = check_if_token_exists(token_id)
-        
-        # If the token exists then we update the information.  Otherwise, we add a new token
-        if token_exists:
-            #update_token(token_id, token_df.iloc[row_index])
-            pass
-        else:
-            insert_token(token_id, token_df.iloc[row_index])                                
+    """
+    # Write token_ids to log file
+    logger.info(f"save_token() function called for token_id: {token_df['token_id'].tolist()}")
+
+    # Tokens that already exist are skipped, new tokens are added in bulk
+    save_many('token', prepare_token_frame(token_df))
 
 
 
@@ -1094,11 +2650,11 @@ def get_all_token_attributes():
     """       
     sql_query = f"""
     SELECT * 
-    FROM {database_schema}.token_attribute  
+    FROM {database_schema}.token_trait  
     """    
     try:
-        df = pd.read_sql_query(sql_query, con = engine)    
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())    
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
@@ -1114,13 +2670,13 @@ def get_token_attribute(token_id, trait_type):
     """       
     sql_query = f"""
     SELECT * 
-    FROM {database_schema}.token_attribute 
-    WHERE token_id = '{token_id}'
+    FROM {database_schema}.token_trait 
+    WHERE token_key = {token_key(token_id)}
     AND trait_type = '{trait_type}'
     """        
     try:
-        df = pd.read_sql_query(sql_query, con = engine)                
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())                
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex) 
@@ -1134,13 +2690,14 @@ def delete_token_attribute(token_id, trait_type):
           trait_type - part of a token's trait
     """       
     delete_query = f"""
-    DELETE FROM {database_schema}.token_attribute 
-    WHERE token_id = '{token_id}'
-    AND trait_type = '{trait_type}'
+    DELETE FROM {database_schema}.token_attribute ta
+    WHERE ta.token_key = {token_key(token_id)}
+    AND ta.trait_type = '{trait_type}'
     """ 
     try:   
         with engine.connect() as conn:
             conn.execute(delete_query)
+            mark_token_scores_dirty(token_ids=[token_id])
             logger.info(f"{token_id} attributes was successfully deleted!")
     except Exception as ex:  
         logger.debug(delete_query)  
@@ -1171,19 +2728,16 @@ def update_token_attribute(token_id, trait_type, df):
     Args: token_id - a token thats part of a contract i.e. Collection
           df - data collection of token data
     """    
-    value = scrub_str(df['value'])
-
     update_query = f"""
-    UPDATE {database_schema}.token_attribute
-    SET overall_with_trait_value = {df['overall_with_trait_value']},
-        rarity_percentage  = {df['rarity_percentage']},
-        value = '{value}'      
-    WHERE token_id = '{token_id}'
-    AND trait_type = '{trait_type}'
+    UPDATE {database_schema}.token_attribute ta
+    SET trait_key = {trait_key(token_id, trait_type, df)}
+    WHERE ta.token_key = {token_key(token_id)}
+    AND ta.trait_type = '{trait_type}'
     """   
     try:
         with engine.connect() as conn:
             conn.execute(update_query)
+            mark_token_scores_dirty(token_ids=[token_id])
     except Exception as ex:  
         logger.debug(update_query)  
         logger.error(ex) 
@@ -1197,15 +2751,14 @@ def insert_token_attribute(token_id, trait_type, df):
           trait_type - part of a token's trait
           df - data collection of token attributes
     """ 
-    value = scrub_str(df['value'])
-            
     insert_query = f"""
-    INSERT INTO {database_schema}.token_attribute (token_id, overall_with_trait_value, rarity_percentage, trait_type, value)
-    VALUES ('{token_id}', {df['overall_with_trait_value']}, {df['rarity_percentage']}, '{trait_type}', '{value}')
+    INSERT INTO {database_schema}.token_attribute (token_key, trait_type, trait_key)
+    VALUES ({token_key(token_id, create=True)}, '{scrub_str(trait_type)}', {trait_key(token_id, trait_type, df)})
     """  
     try:          
         with engine.connect() as conn:
             conn.execute(insert_query)
+            mark_token_scores_dirty(token_ids=[token_id])
     except Exception as ex:  
         logger.debug(insert_query)  
         logger.error(ex)   
@@ -1216,24 +2769,12 @@ def save_token_attributes(token_attributes_df):
     This function saves the token attributes data into a postgres database residing in AWS
     
     Args: df - data collection of tokens thats part of a specific contract i.e. Collection
-    """    
-    for row_index in token_attributes_df.index: 
-        token_id = token_attributes_df['token_id'][row_index]
-        trait_type = token_attributes_df['trait_type'][row_index]
-        trait_type = scrub_str(trait_type)    
-
-        # Write token_id and trait_type to log file
-        logger.info(f"save_token_attributes() function called for token_id: {token_id} and trait_type: {trait_type}") 
-
-        # First check if the token attribute exists
-        token_attribute_exists = check_if_token_attribute_exists(token_id, trait_type)
-        
-        # If the token attribute exists then we update the information.  Otherwise, we add a new token attribute
-        if token_attribute_exists:
-            #update_token_attribute(token_id, trait_type, token_attributes_df.iloc[row_index])
-            pass
-        else:
-            insert_token_attribute(token_id, trait_type, token_attributes_df.iloc[row_index])                                
+    """
+    # Write token_ids to log file
+    logger.info(f"save_token_attributes() function called for token_id: {token_attributes_df['token_id'].unique().tolist()}")
+
+    # Token attributes that already exist are skipped, new token attributes are added in bulk
+    save_many('token_attribute', prepare_token_attribute_frame(token_attributes_df))
 
 
 
@@ -1253,7 +2794,7 @@ def get_all_social_media():
     FROM {database_schema}.social_media 
     """   
     try: 
-        df = pd.read_sql_query(sql_query, con = engine)    
+        df = pd.read_sql_query(sql_query, con = read_engine())    
         return df
     except Exception as ex:  
         logger.debug(sql_query)  
@@ -1273,7 +2814,7 @@ def get_social_media(contract_id):
     WHERE contract_id = '{contract_id}'
     """  
     try:      
-        df = pd.read_sql_query(sql_query, con = engine)                
+        df = pd.read_sql_query(sql_query, con = read_engine())                
         return df
     except Exception as ex:  
         logger.debug(sql_query)  
@@ -1364,17 +2905,9 @@ def save_social_media(contract_id, df):
     
     Args: contract_id - the contract id of the collection
           df - data collection of social media accounts
-    """    
-    for row_index in df.index: 
-        # First check if the social media account exists
-        social_media_exists = check_if_social_media_exists(contract_id)
-        
-        # If the social media account exists then we update the information.  Otherwise, we add a new social media account
-        if social_media_exists:
-            update_social_media(contract_id, df.iloc[row_index])
-        else:
-            insert_social_media(contract_id, df.iloc[row_index])                                
-
+    """
+    # The social media accounts are replaced in bulk
+    save_many('social_media', df.assign(contract_id = contract_id))
 
 
 
@@ -1393,11 +2926,11 @@ def get_all_data_analysis(contract_id):
     sql_query = f"""
     SELECT * 
     FROM {database_schema}.data_analysis  
-    WHERE contract_id = '{contract_id}'
+    WHERE contract_key = {contract_key(contract_id)}
     """    
     try:
-        df = pd.read_sql_query(sql_query, con = engine)    
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())    
+        return decode_frame(df)
     except Exception as ex:  
         logger.debug(sql_query)  
         logger.error(ex)      
@@ -1415,12 +2948,12 @@ def get_data_analysis(contract_id, time):
     sql_query = f"""
     SELECT * 
     FROM {database_schema}.data_analysis  
-    WHERE contract_id = '{contract_id}'
+    WHERE contract_key = {contract_key(contract_id)}
     AND timestamp = '{time}'
     """
     try:        
-        df = pd.read_sql_query(sql_query, con = engine)                
-        return df
+        df = pd.read_sql_query(sql_query, con = read_engine())                
+        return decode_frame(df)
     except Exception as ex: 
         logger.debug(sql_query)   
         logger.error(ex)  
@@ -1436,7 +2969,7 @@ def delete_data_analysis(contract_id, time):
     """       
     delete_query = f"""
     DELETE FROM {database_schema}.data_analysis  
-    WHERE contract_id = '{contract_id}'
+    WHERE contract_key = {contract_key(contract_id)}
     AND timestamp = '{time}'
     """  
     try:  
@@ -1481,7 +3014,7 @@ def update_data_analysis(df):
         co_variance = {round(df['co_variance'], 2)},
         beta = {round(df['beta'], 2)},
         whale_ratio = {round(df['whale_ratio'], 2)}
-    WHERE contract_id = '{df['contract_id']}'
+    WHERE contract_key = {contract_key(df['contract_id'])}
     AND timestamp = '{df['time']}'
     """
     try:    
@@ -1499,8 +3032,8 @@ def insert_data_analysis(df):
     Args: df - data collection of data analysis information
     """    
     insert_query = f"""
-    INSERT INTO {database_schema}.data_analysis (contract_id, timestamp, percent_chg, avg_percent_chg, standard_dev, avg_standard_dev, variance, co_variance, beta, whale_ratio)
-    VALUES ('{df['contract_id']}', '{df['time']}', {round(df['percent_chg'], 2)}, {round(df['avg_percent_chg'], 2)}, {round(df['standard_dev'], 2)}, {round(df['avg_standard_dev'], 2)}, {round(df['variance'], 2)}, {round(df['co_variance'], 2)}, {round(df['beta'], 2)}, {round(df['whale_ratio'], 2)})
+    INSERT INTO {database_schema}.data_analysis (contract_key, timestamp, percent_chg, avg_percent_chg, standard_dev, avg_standard_dev, variance, co_variance, beta, whale_ratio)
+    VALUES ({contract_key(df['contract_id'], create=True)}, '{df['time']}', {round(df['percent_chg'], 2)}, {round(df['avg_percent_chg'], 2)}, {round(df['standard_dev'], 2)}, {round(df['avg_standard_dev'], 2)}, {round(df['variance'], 2)}, {round(df['co_variance'], 2)}, {round(df['beta'], 2)}, {round(df['whale_ratio'], 2)})
     """  
     try:  
         with engine.connect() as conn:
@@ -1514,66 +3047,112 @@ def save_data_analysis(df):
     """
     This function saves the data analysis information into a postgres database residing in AWS
     
-    Args: df - data collection of data analysis information
-    """    
-    for row_index in df.index: 
-        # First check if the data analysis information exists
-        data_analysis_exists = check_if_data_analysis_exists(df.iloc[row_index]['contract_id'], df.iloc[row_index]['time'])
-        
-        # If the data analysis information exists then we update the information.  Otherwise, we add a new data analysis record
-        if data_analysis_exists:
-            update_data_analysis(df.iloc[row_index])
-        else:
-            insert_data_analysis(df.iloc[row_index])                    
+    Args: df - data collection of data analysis information, one row per contract_id and time
+    """
+    # Upsert every row in one transaction instead of a lookup and an insert/update per row
+    save_many('data_analysis', prepare_data_analysis_frame(df))
 
 
-def calculate_token_score_and_ranking():
+"""
+
+    Token rarity score and ranking
+
+"""
+# Contracts and tokens whose tokens or token attributes changed since the last scoring run
+dirty_contracts = set()
+dirty_tokens = set()
+
+
+def mark_token_scores_dirty(contract_ids=(), token_ids=()):
+    """
+    This function records the contracts, or the tokens of contracts, whose rarity scores and
+    rankings need to be recalculated by calculate_token_score_and_ranking()
+
+    Args: contract_ids - contract ids whose tokens changed
+          token_ids - token ids whose attributes changed
+    """
+    dirty_contracts.update(contract_ids)
+    dirty_tokens.update(token_ids)
+
+
+def calculate_token_score_and_ranking(contract_ids=None, full_refresh=False, batch_size=100):
     """
     This function calculates a token's rarity score based on the total sum of it's traits' rarity percentage.
     It then ranks the token's position within the collection based on it's rarity score.
 
+    Only the contracts whose tokens or token attributes changed since the last run are recalculated,
+    one statement per batch of contracts, and tokens whose score and ranking are unchanged are not rewritten.
+
+    Args: contract_ids - optional list of contracts to recalculate instead of the changed ones
+          full_refresh - recalculate every contract
+          batch_size - number of contracts recalculated per statement
+    Returns: list of the recalculated contract ids
     """
 
     # Write updating information to log file
     logger.info(f"calculate_token_score_and_ranking() function called...") 
-        
-    update_rarity_score = f"""
-    UPDATE {database_schema}.token SET rarity_score = b.rarity_score
-    FROM
-    (SELECT token_id, SUM(rarity_percentage) as rarity_score
-    FROM {database_schema}.token_attribute 
-    GROUP BY token_id) b
-    WHERE token.token_id = b.token_id    
-    """
 
-    #
-    # If rarity_score is zero then set the value to zero because the token has no traits defined.
-    #
-    update_no_rarity_score = f"""
-    UPDATE {database_schema}.token SET rarity_score = 0
-    WHERE rarity_score IS NULL 
-    """
+    # Work out which contracts need to be recalculated
+    try:
+        if full_refresh:
+            df = decode_frame(pd.read_sql_query(f"SELECT DISTINCT contract_key FROM {database_schema}.token", con = engine))
+            contract_ids = df['contract_id'].tolist()
+        elif contract_ids is None:
+            contract_ids = set(dirty_contracts)
+            if dirty_tokens:
+                df = pd.read_sql_query(f"SELECT DISTINCT contract_key FROM {database_schema}.token WHERE token_key = ANY(%(token_keys)s)",
+                                       con = engine, params = {'token_keys': token_keys(dirty_tokens)})
+                contract_ids.update(decode_frame(df)['contract_id'])
+        contract_ids = sorted(contract_ids)
+        dirty_contracts.clear()
+        dirty_tokens.clear()
+    except Exception as ex:
+        logger.error(ex)
+        return []
 
     #
-    # Rank the token's position within the collection based on it's rarity score
+    # Score every token of the contracts (tokens without traits score zero), rank the tokens
+    # within their collection and only update the tokens whose score or ranking changed
     #
-    update_token_ranking = f"""
+    update_token_score_and_ranking = f"""
+    WITH scores AS (
+        SELECT t.token_key, t.contract_key, COALESCE(SUM(tr.rarity_percentage), 0) AS rarity_score
+        FROM {database_schema}.token t
+        LEFT JOIN {database_schema}.token_attribute ta ON ta.token_key = t.token_key
+        LEFT JOIN {database_schema}.trait tr ON tr.trait_key = ta.trait_key
+        WHERE t.contract_key = ANY(%(contract_keys)s)
+        GROUP BY t.token_key, t.contract_key
+    ),
+    ranked AS (
+        SELECT s.token_key, s.contract_key, s.rarity_score,
+               CASE WHEN c.contract_id IS NOT NULL
+                    THEN RANK() OVER (PARTITION BY s.contract_key ORDER BY s.rarity_score DESC)
+               END AS rnk
+        FROM scores s
+        INNER JOIN {database_schema}.contract_dictionary k ON k.contract_key = s.contract_key
+        LEFT JOIN {database_schema}.collection c ON c.contract_id = k.contract_id
+    )
     UPDATE {database_schema}.token
-    SET ranking = tn.rnk
-    FROM (SELECT t.token_id,
-          RANK() OVER (PARTITION BY c.contract_id ORDER BY t.rarity_score DESC) rnk
-          FROM {database_schema}.token t
-          INNER JOIN {database_schema}.collection c ON t.contract_id = c.contract_id) tn
-    WHERE token.token_id = tn.token_id        
-    """
-
-    try:    
-        with engine.connect() as conn:
-            conn.execute(update_rarity_score)
-            conn.execute(update_no_rarity_score)
-            conn.execute(update_token_ranking)
-    except Exception as ex: 
-        logger.debug(update_rarity_score)   
-        logger.debug(update_no_rarity_score)
-        logger.debug(update_token_ranking)
-        logger.error(ex)       
\ No newline at end of file
+    SET rarity_score = r.rarity_score,
+        ranking = COALESCE(r.rnk, token.ranking)
+    FROM ranked r
+    WHERE token.token_key = r.token_key
+    AND token.contract_key = r.contract_key
+    AND (token.rarity_score IS DISTINCT FROM r.rarity_score
+         OR token.ranking IS DISTINCT FROM COALESCE(r.rnk, token.ranking))
+    """
+
+    for i in range(0, len(contract_ids), batch_size):
+        batch = list(contract_ids[i:i + batch_size])
+        try:    
+            # The statement starts with WITH so it is run in an explicit transaction
+            with engine.begin() as conn:
+                result = conn.execute(update_token_score_and_ranking, {'contract_keys': contract_keys(batch)})
+                logger.info(f"calculate_token_score_and_ranking() updated {result.rowcount} tokens for {len(batch)} contracts")
+        except Exception as ex: 
+            logger.debug(update_token_score_and_ranking)
+            logger.error(ex)
+            # Keep the batch so the next run retries it
+            mark_token_scores_dirty(contract_ids=batch)
+
+    return contract_ids
@@ -9,6 +9,8 @@ from sqlalchemy import BigInteger, create_engine
 from sqlalchemy import inspect
 import requests
 import db_utils as db
+import rarity
+import dashboard_data
 import json
 import logging
 
@@ -203,8 +205,22 @@ def get_trades(obj_json):
     return trades_df
 
 
+def publish_snapshot(run_id):
+    # Compute every dataset the dashboard needs and publish them as a snapshot the dashboard reads instead of
+    # querying the database.  The dashboard falls back to live queries without a snapshot, so a failure is only logged
+    try:
+        version = dashboard_data.publish_snapshot(run_id)
+        logger.info(f"Published dashboard snapshot {version}")
+    except Exception as ex:
+        logger.error(ex)
+
+
 def main():
 
+    # Make call to db.start_etl_run() to record the start of this run
+    run_id = db.start_etl_run()
+    write_error = None
+
     # Get list of top 100 contracts by highest volume
     contracts_url = f"https://api.rarify.tech/data/contracts/?filter[network]=ethereum&page[limit]={num_contracts}&sort=-insights.volume"
 
@@ -223,79 +239,109 @@ def main():
         # an NFT's floor price within the collection would sell for in the open market.
         contracts_df['smart_floor_price'] = [get_smart_floor_price(api_request(smart_floor_url.replace('contract_id', i), rarify_api_key)) for i in contracts_df['contract_id']]
 
-        # Make call to db.save_collection() passing in a list of contracts 
-        # and store the data in the database
-        db.save_collection(contracts_df)
-
-        # Loop through contracts and get trade information and store data for each contract id
-        for contract_id in contracts_list:    
-            # Get the trade data for a specific contract from the past period
-            trades_url = f"https://api.rarify.tech/data/contracts/{contract_id}/insights/{period}"
-            # Make API request call to Rarify to get trades data
-            trades_df = get_trades(api_request(trades_url, rarify_api_key))
-
-            if not trades_df.empty:
-                trades_df["contract_id"] = contract_id
-                trades_df["period"] = period
-                trades_df["type"] = "collection"
-                trades_df["api_id"] = 'rarify'
-                # Make call db.save_trade() passing in a list of trades history data per contract
-                trades_df.set_index("time")
-                db.save_trade(trades_df)
-
-        tokens_list = []
+        # Gather the writes in a buffered writer so the many small DataFrames below are written
+        # to the database in a few large batches.  Anything still buffered is flushed on exit
+        # Rows the writer couldn't write are raised when it closes, the run is finished as failed
+        # once the later stages have run on the rows that were written
+        try:
+            with db.BufferedWriter() as writer:
+                # Make call to writer.save_collection() passing in a list of contracts 
+                # and store the data in the database
+                writer.save_collection(contracts_df)
+
+                # Loop through contracts and get trade information and store data for each contract id
+                for contract_id in contracts_list:    
+                    # Get the trade data for a specific contract from the past period
+                    trades_url = f"https://api.rarify.tech/data/contracts/{contract_id}/insights/{period}"
+                    # Make API request call to Rarify to get trades data
+                    trades_df = get_trades(api_request(trades_url, rarify_api_key))
+
+                    if not trades_df.empty:
+                        trades_df["contract_id"] = contract_id
+                        trades_df["period"] = period
+                        trades_df["type"] = "collection"
+                        trades_df["api_id"] = 'rarify'
+                        # Make call writer.save_trade() passing in a list of trades history data per contract
+                        trades_df.set_index("time")
+                        writer.save_trade(trades_df)
+
+                tokens_list = []
         
-        # Loop through contracts and get tokens associated with the collection.  Then store
-        # the data for each token.
-        for contract_id in contracts_list:
-            # Get list of tokens
-            tokens_url = f"https://api.rarify.tech/data/tokens/?page[limit]={num_tokens}&filter[contract]={contract_id}&sort=-relevancy"
-
-            # Make API request call to Rarify
-            tokens_df = get_tokens_by_contract_id(api_request(tokens_url, rarify_api_key))
-
-            if not tokens_df.empty:
-                # Set contract_id for list of tokens retrieved
-                tokens_df["contract_id"] = contract_id
-                # Make call to db.save_token(df) passing in a dataframe of tokens per contract
-                db.save_token(tokens_df)
-
-                # Get a list of token_ids from the list of tokens
-                tokens_list.append(tokens_df.token_id.values.tolist())
-
-
-        for token in tokens_list:
-            for token_id in token:
-                logger.info(f"TokenAttributes for token_id is {token_id}")
-                # Make API request call to Rarify to get token attributes i.e. the rarity percentage, the overall trait value, trait_type, etc. per coin
-                token_url = f"https://api.rarify.tech/data/tokens/{token_id}/?include=attributes_stats"
-                token_attributes_df = get_token_attributes(api_request(token_url, rarify_api_key))
-
-                if not token_attributes_df.empty:     
-                    token_attributes_df["token_id"] = token_id  
-                    # Make call to db.save_token_attributes() passing in a dataframe of token attributes per token
-                    db.save_token_attributes(token_attributes_df)
-
-
-        for token in tokens_list:
-            for token_id in token:
-                logger.info(f"TokenTrades for token_id is {token_id}")
-                # Make API request call to Rarify to get trades per token
-                trade_url = f"https://api.rarify.tech/data/tokens/{token_id}/insights/{period}"
-                trades_df = get_trades(api_request(trade_url, rarify_api_key))
+                # Loop through contracts and get tokens associated with the collection.  Then store
+                # the data for each token.
+                for contract_id in contracts_list:
+                    # Get list of tokens
+                    tokens_url = f"https://api.rarify.tech/data/tokens/?page[limit]={num_tokens}&filter[contract]={contract_id}&sort=-relevancy"
+
+                    # Make API request call to Rarify
+                    tokens_df = get_tokens_by_contract_id(api_request(tokens_url, rarify_api_key))
+
+                    if not tokens_df.empty:
+                        # Set contract_id for list of tokens retrieved
+                        tokens_df["contract_id"] = contract_id
+                        # Make call to writer.save_token(df) passing in a dataframe of tokens per contract
+                        writer.save_token(tokens_df)
+
+                        # Get a list of token_ids from the list of tokens, with the contract_id they belong to
+                        tokens_list.append((contract_id, tokens_df.token_id.values.tolist()))
+
+
+                for contract_id, token in tokens_list:
+                    for token_id in token:
+                        logger.info(f"TokenAttributes for token_id is {token_id}")
+                        # Make API request call to Rarify to get token attributes i.e. the rarity percentage, the overall trait value, trait_type, etc. per coin
+                        token_url = f"https://api.rarify.tech/data/tokens/{token_id}/?include=attributes_stats"
+                        token_attributes_df = get_token_attributes(api_request(token_url, rarify_api_key))
+
+                        if not token_attributes_df.empty:     
+                            token_attributes_df["token_id"] = token_id  
+                            token_attributes_df["contract_id"] = contract_id
+                            # Make call to writer.save_token_attributes() passing in a dataframe of token attributes per token
+                            writer.save_token_attributes(token_attributes_df)
+
+
+                for contract_id, token in tokens_list:
+                    for token_id in token:
+                        logger.info(f"TokenTrades for token_id is {token_id}")
+                        # Make API request call to Rarify to get trades per token
+                        trade_url = f"https://api.rarify.tech/data/tokens/{token_id}/insights/{period}"
+                        trades_df = get_trades(api_request(trade_url, rarify_api_key))
                     
-                if not trades_df.empty:
-                    trades_df["contract_id"] = token_id
-                    trades_df["period"] = period
-                    trades_df["type"] = "token"
-                    trades_df["api_id"] = 'rarify'
-                    trades_df.set_index("time")
-                    # Make call db.save_trade() passing in a list of trades history data per token                    
-                    db.save_trade(trades_df)        
+                        if not trades_df.empty:
+                            trades_df["contract_id"] = token_id
+                            trades_df["period"] = period
+                            trades_df["type"] = "token"
+                            trades_df["api_id"] = 'rarify'
+                            trades_df.set_index("time")
+                            # Make call writer.save_trade() passing in a list of trades history data per token                    
+                            writer.save_trade(trades_df)        
+        except RuntimeError as ex:
+            write_error = ex
+
+
+    # Make call db.refresh_collection_daily() to recalculate the daily rollup for the days whose trades changed
+    db.refresh_collection_daily()
+
+    # Make call db.refresh_collection_lists() to apply the exclusion and watchlist rules to every collection
+    db.refresh_collection_lists()
 
 
     # Make call db.calculate_token_score_and_ranking() to update rarity scores and token ranking
-    db.calculate_token_score_and_ranking()
+    contract_ids = db.calculate_token_score_and_ranking()
+
+    # Make call rarity.score_collections() to update the other rarity models of the changed collections
+    rarity.score_collections(contract_ids)
+
+    # Make call db.drop_old_trade_partitions() to drop the trades older than TRADE_RETENTION_MONTHS, if set
+    db.drop_old_trade_partitions()
+
+    # Make call to publish_snapshot() to publish the dashboard datasets of this run
+    publish_snapshot(run_id)
+
+    # Make call to db.finish_etl_run() so the dashboard reloads the data of this run, a run that lost rows is failed
+    db.finish_etl_run(run_id, failed=write_error is not None)
+    if write_error is not None:
+        raise write_error
 
 
     # Get list of whales that own the specified contract
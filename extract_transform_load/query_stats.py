@@ -0,0 +1,280 @@
+# Import Libraries
+import os
+import re
+import sys
+import time
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime
+from dotenv import load_dotenv
+import pandas as pd
+from sqlalchemy import event
+import logging
+
+
+# Get Logger
+logger = logging.getLogger()
+
+# Load .env environment variables
+load_dotenv()
+
+# Statements slower than this many seconds are added to the slow-query log
+slow_query_threshold = float(os.getenv("SLOW_QUERY_THRESHOLD", 1.0))
+
+# Number of slow statements the rolling slow-query log keeps
+slow_query_log_size = int(os.getenv("SLOW_QUERY_LOG_SIZE", 100))
+
+# Statements EXPLAIN (ANALYZE, BUFFERS) can be run on
+explainable = ('select', 'with', 'insert', 'update', 'delete', 'values')
+
+# How long EXPLAIN (ANALYZE, BUFFERS) waits for a lock before giving up, plans of writes take the locks of the write
+explain_lock_timeout = os.getenv("EXPLAIN_LOCK_TIMEOUT", "2s")
+
+# Modules whose frames are skipped when looking for the caller of a statement
+library_paths = ('sqlalchemy', 'pandas', 'psycopg2', os.path.basename(__file__).replace('.py', ''))
+
+
+"""
+
+    Statement statistics
+
+"""
+lock = threading.Lock()
+local = threading.local()
+statement_stats = {}
+slow_queries = deque(maxlen=slow_query_log_size)
+flagged = set()
+
+
+def fingerprint(statement):
+    """
+    This function normalizes a statement so executions that only differ in their literal values
+    share one fingerprint
+
+    Args: statement - SQL text
+    Returns: (fingerprint id, normalized statement) tuple
+    """
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    normalized = re.sub(r"%\(\w+\)s|%s|(?<!:):\w+\b", "?", normalized)
+    normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    normalized = re.sub(r"\((?:\?, )+\?\)", "(?)", normalized)
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()[:12], normalized
+
+
+def find_caller():
+    """
+    This function returns the first frame outside SQLAlchemy, pandas and psycopg2, i.e. the
+    application code that issued the statement
+
+    Returns: "file:line function" string
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        # Skip library frames and the functions SQLAlchemy generates at runtime (<string>)
+        if not filename.startswith('<') and not any(f"{os.sep}{path}" in filename for path in library_paths):
+            return f"{os.path.basename(filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    record_statement(conn.engine, cursor, statement, parameters, duration, executemany)
+
+
+def handle_error(context):
+    # A statement that raises never reaches after_cursor_execute, drop its start time
+    conn = context.connection
+    if conn is not None and context.execution_context is not None and conn.info.get('query_start_time'):
+        conn.info['query_start_time'].pop()
+
+
+def record_statement(engine, cursor, statement, parameters, duration, executemany=False, rows=None):
+    """
+    This function counts an executed statement under its fingerprint and adds it to the slow-query
+    log when it's slow or its fingerprint is flagged
+
+    Args: engine - SQLAlchemy engine the statement ran on
+          cursor - DBAPI cursor that ran the statement
+          statement - SQL text
+          parameters - its parameters
+          duration - seconds the statement took
+          executemany - whether parameters hold many rows
+          rows - rows affected or returned, defaults to the cursor's rowcount
+    """
+    if getattr(local, 'explaining', False):
+        return
+    fingerprint_id, normalized = fingerprint(statement)
+    if rows is None:
+        rows = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None
+    caller = find_caller()
+    with lock:
+        stats = statement_stats.setdefault(fingerprint_id, {'fingerprint': fingerprint_id, 'statement': normalized, 'calls': 0,
+                                                            'total_time': 0.0, 'max_time': 0.0, 'rows': 0, 'callers': set()})
+        stats['calls'] += 1
+        stats['total_time'] += duration
+        stats['max_time'] = max(stats['max_time'], duration)
+        stats['rows'] += rows or 0
+        stats['callers'].add(caller)
+        log_statement = fingerprint_id in flagged
+        if log_statement:
+            flagged.discard(fingerprint_id)
+    if duration < slow_query_threshold and not log_statement:
+        return
+    # Keep the statement with its parameters bound so explain_query() can capture its plan later.  The plan
+    # isn't captured here, the transaction of the statement is still open and may hold locks the plan needs
+    try:
+        sql = cursor.mogrify(statement, parameters).decode('utf-8') if parameters and not executemany else statement
+    except Exception:
+        sql = statement
+    entry = {'time': datetime.now(), 'fingerprint': fingerprint_id, 'duration': round(duration, 4), 'rows': rows,
+             'caller': caller, 'statement': sql, 'engine': engine, 'explain': None}
+    if duration >= slow_query_threshold:
+        logger.warning(f"slow query {fingerprint_id} took {duration:.3f}s, {rows} rows, called from {caller}")
+    with lock:
+        slow_queries.append(entry)
+
+
+def timed_execute(engine, cursor, statement, parameters=None, execute=None, **kwargs):
+    """
+    This function runs a statement on the DBAPI cursor of a raw connection, which bypasses the engine's
+    events, and records it like the statements executed through an instrumented engine
+
+    Args: engine - SQLAlchemy engine the raw connection belongs to
+          cursor - DBAPI cursor
+          statement - SQL text
+          parameters - its parameters, or the rows of an execute_values() call
+          execute - function run as execute(cursor, statement, parameters, **kwargs) i.e. psycopg2's
+                    execute_values, defaults to cursor.execute
+    Returns: the result of execute
+    """
+    if not event.contains(engine, 'after_cursor_execute', after_cursor_execute):
+        return execute(cursor, statement, parameters, **kwargs) if execute else cursor.execute(statement, parameters)
+    start = time.perf_counter()
+    result = execute(cursor, statement, parameters, **kwargs) if execute else cursor.execute(statement, parameters)
+    # A paged execute_values() leaves the rowcount of its last page, count the rows it returned instead
+    record_statement(engine, cursor, statement, parameters, time.perf_counter() - start, executemany=execute is not None,
+                     rows=len(result) if isinstance(result, list) else None)
+    return result
+
+
+def instrument(engine):
+    """
+    This function attaches the timing hooks to an engine.  Every statement executed through it
+    is then counted under its fingerprint and slow statements are added to the slow-query log.
+    Statements run on its raw connections are recorded through timed_execute()
+
+    Args: engine - SQLAlchemy engine
+    Returns: the engine
+    """
+    if engine is not None and not event.contains(engine, 'after_cursor_execute', after_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'handle_error', handle_error)
+    return engine
+
+
+"""
+
+    EXPLAIN (ANALYZE, BUFFERS) on demand
+
+"""
+def explain_statement(engine, sql):
+    """
+    This function captures the EXPLAIN (ANALYZE, BUFFERS) plan of a statement.  The statement runs
+    inside a transaction that is rolled back, so plans of writes don't change any data, and gives up
+    after EXPLAIN_LOCK_TIMEOUT when a lock it needs is held
+
+    Args: engine - SQLAlchemy engine to run the statement on
+          sql - statement with its parameters bound
+    Returns: plan text, or None when the statement can't be explained
+    """
+    if not sql.lstrip().lower().startswith(explainable):
+        return None
+    local.explaining = True
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = %s", (explain_lock_timeout,))
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")
+            return "\n".join(row[0] for row in cursor.fetchall())
+    except Exception as ex:
+        logger.error(ex)
+    finally:
+        conn.rollback()
+        conn.close()
+        local.explaining = False
+
+
+def flag_query(fingerprint_id):
+    """
+    This function flags a fingerprint so its next execution is added to the slow-query log, fast
+    or not, for explain_query() to capture its plan
+
+    Args: fingerprint_id - fingerprint from get_query_stats() or get_slow_queries()
+    """
+    with lock:
+        flagged.add(fingerprint_id)
+
+
+def explain_query(fingerprint_id):
+    """
+    This function captures the plan of the most recent logged execution of a fingerprint now.  Call
+    it outside of any open transaction, the plans of writes wait for the locks of the write
+
+    Args: fingerprint_id - fingerprint from get_slow_queries()
+    Returns: plan text, or None when no execution of the fingerprint is logged
+    """
+    with lock:
+        entries = [entry for entry in slow_queries if entry['fingerprint'] == fingerprint_id]
+    if not entries:
+        return None
+    entry = entries[-1]
+    entry['explain'] = explain_statement(entry['engine'], entry['statement'])
+    return entry['explain']
+
+
+"""
+
+    Reports
+
+"""
+def get_query_stats():
+    """
+    This function returns the statistics of every statement fingerprint, slowest in total first
+
+    Returns: DataFrame
+    """
+    with lock:
+        rows = [dict(stats, callers=sorted(caller for caller in stats['callers'] if caller)) for stats in statement_stats.values()]
+    df = pd.DataFrame(rows, columns=['fingerprint', 'calls', 'total_time', 'max_time', 'rows', 'callers', 'statement'])
+    df['avg_time'] = df['total_time'] / df['calls']
+    return df.sort_values('total_time', ascending=False).reset_index(drop=True)
+
+
+def get_slow_queries():
+    """
+    This function returns the rolling slow-query log, most recent first
+
+    Returns: DataFrame
+    """
+    with lock:
+        rows = [{key: value for key, value in entry.items() if key != 'engine'} for entry in reversed(slow_queries)]
+    return pd.DataFrame(rows, columns=['time', 'fingerprint', 'duration', 'rows', 'caller', 'statement', 'explain'])
+
+
+def reset_query_stats():
+    """
+    This function clears the statement statistics and the slow-query log
+    """
+    with lock:
+        statement_stats.clear()
+        slow_queries.clear()
+        flagged.clear()
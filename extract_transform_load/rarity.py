@@ -0,0 +1,265 @@
+# Import Libraries
+import os
+import time
+from dotenv import load_dotenv
+import pandas as pd
+import numpy as np
+import logging
+import db_utils as db
+
+
+# Get Logger
+logger = logging.getLogger()
+
+# Load .env environment variables
+load_dotenv()
+
+# Retrieve the database schema from .env file
+database_schema = os.getenv("DATABASE_SCHEMA")
+
+
+"""
+
+    Collection arrays
+
+"""
+class CollectionArrays(object):
+    """
+    The token attributes of one collection held as compact integer coded arrays, one entry per
+    (token, trait_type) row.  Tokens without any attributes are kept in token_ids so they are scored too
+    """
+
+    def __init__(self, contract_id, token_ids, token_index, type_index, pair_index, pair_type, rarity_percentage):
+        self.contract_id = contract_id
+        self.token_ids = token_ids                  # token id of every token in the collection
+        self.token_index = token_index              # position of the row's token in token_ids
+        self.type_index = type_index                # code of the row's trait_type
+        self.pair_index = pair_index                # code of the row's (trait_type, value) pair
+        self.pair_type = pair_type                  # trait_type code of every (trait_type, value) pair
+        self.rarity_percentage = rarity_percentage  # rarity percentage reported by the api
+        self.num_tokens = len(token_ids)
+        self.num_types = int(pair_type.max()) + 1 if len(pair_type) else 0
+        self.num_pairs = len(pair_type)
+
+    def pair_frequency(self):
+        """ share of the collection's tokens having each (trait_type, value) pair """
+        return np.bincount(self.pair_index, minlength=self.num_pairs) / self.num_tokens
+
+    def missing_frequency(self):
+        """ share of the collection's tokens without each trait_type """
+        return 1 - np.bincount(self.type_index, minlength=self.num_types) / self.num_tokens
+
+    def per_token(self, weights):
+        """ sum the per row weights for every token """
+        return np.bincount(self.token_index, weights=weights, minlength=self.num_tokens)
+
+    def per_missing_trait(self, weights):
+        """ sum, for every token, the per trait_type weights of the trait types the token doesn't have """
+        return weights.sum() - self.per_token(weights[self.type_index])
+
+    def trait_counts(self):
+        """ number of traits of every token """
+        return np.bincount(self.token_index, minlength=self.num_tokens)
+
+
+def load_collection_arrays(contract_id):
+    """
+    This function loads the tokens and token attributes of a collection as CollectionArrays
+
+    Args: contract_id - contract id of the collection
+    Returns: CollectionArrays
+    """
+    sql_query = f"""
+    SELECT td.token_id, tr.trait_type, tr.value, tr.rarity_percentage
+    FROM {database_schema}.token t
+    INNER JOIN {database_schema}.token_dictionary td ON td.token_key = t.token_key
+    LEFT JOIN {database_schema}.token_attribute ta ON ta.token_key = t.token_key
+    LEFT JOIN {database_schema}.trait tr ON tr.trait_key = ta.trait_key
+    WHERE t.contract_key = %(contract_key)s
+    """
+    df = pd.read_sql_query(sql_query, con = db.engine, params = {'contract_key': db.contract_dictionary.to_keys([contract_id])[0]})
+    return collection_arrays(contract_id, df)
+
+
+def collection_arrays(contract_id, df):
+    """
+    This function encodes the token attributes of a collection as CollectionArrays
+
+    Args: contract_id - contract id of the collection
+          df - DataFrame with token_id, trait_type, value and rarity_percentage, with a row with
+               an empty trait_type for the tokens without attributes
+    Returns: CollectionArrays
+    """
+    token_codes, token_ids = pd.factorize(df['token_id'])
+    has_trait = df['trait_type'].notna().to_numpy()
+    token_index = token_codes[has_trait]
+    df = df[has_trait]
+    type_index, trait_types = pd.factorize(df['trait_type'])
+    value_codes, values = pd.factorize(df['value'].fillna(''))
+    pair_codes, pair_index = np.unique(type_index.astype(np.int64) * max(len(values), 1) + value_codes, return_inverse=True)
+    pair_type = (pair_codes // max(len(values), 1)).astype(np.int32)
+    return CollectionArrays(contract_id,
+                            np.asarray(token_ids, dtype=object),
+                            token_index.astype(np.int32),
+                            type_index.astype(np.int32),
+                            pair_index.astype(np.int32),
+                            pair_type,
+                            pd.to_numeric(df['rarity_percentage'], errors='coerce').fillna(0).to_numpy(dtype=np.float64))
+
+
+"""
+
+    Scoring models
+
+"""
+# Registered scoring models: name -> (function, ascending).  ascending models rank the lowest score first
+rarity_models = {}
+
+
+def rarity_model(name, ascending=False):
+    """
+    This decorator registers a scoring model.  The function receives CollectionArrays and returns
+    one score per token in token_ids order
+
+    Args: name - name of the model, stored in token_rarity.model
+          ascending - True when a lower score means a rarer token
+    """
+    def register(func):
+        rarity_models[name] = (func, ascending)
+        return func
+    return register
+
+
+@rarity_model('sum_of_percentages')
+def sum_of_percentages(arrays):
+    """ sum of the traits' rarity percentage, the score calculate_token_score_and_ranking() writes to token.rarity_score """
+    return arrays.per_token(arrays.rarity_percentage)
+
+
+@rarity_model('statistical', ascending=True)
+def statistical_rarity(arrays):
+    """ product of the frequencies of the token's traits, a missing trait counting as its own value """
+    missing = arrays.missing_frequency()
+    log_missing = np.log(np.where(missing > 0, missing, 1))
+    log_frequency = arrays.per_token(np.log(arrays.pair_frequency()[arrays.pair_index])) + arrays.per_missing_trait(log_missing)
+    return np.exp(log_frequency)
+
+
+@rarity_model('information_content')
+def information_content(arrays):
+    """ information content, in bits, of the token's traits, a missing trait counting as its own value """
+    missing = arrays.missing_frequency()
+    bits_missing = -np.log2(np.where(missing > 0, missing, 1))
+    return arrays.per_token(-np.log2(arrays.pair_frequency()[arrays.pair_index])) + arrays.per_missing_trait(bits_missing)
+
+
+@rarity_model('trait_count_normalized')
+def trait_count_normalized(arrays):
+    """
+    sum of 1 / frequency of the token's traits, each trait type divided by its number of values so trait
+    types with many values don't dominate, plus the rarity of the token's trait count
+    """
+    frequency = arrays.pair_frequency()
+    missing = arrays.missing_frequency()
+    num_values = np.bincount(arrays.pair_type, minlength=arrays.num_types) + (missing > 0)
+    score = arrays.per_token(1 / frequency[arrays.pair_index] / num_values[arrays.type_index])
+    score += arrays.per_missing_trait(np.where(missing > 0, 1 / np.where(missing > 0, missing, 1) / np.maximum(num_values, 1), 0))
+    trait_counts = arrays.trait_counts()
+    count_frequency = np.bincount(trait_counts) / arrays.num_tokens
+    score += 1 / count_frequency[trait_counts] / np.count_nonzero(count_frequency)
+    return score
+
+
+def rank_scores(scores, ascending=False, digits=10):
+    """
+    This function ranks scores like SQL RANK(), ties share the lowest rank
+
+    Args: scores - array of scores
+          ascending - rank the lowest score first
+          digits - scores are rounded to this many significant digits so float noise doesn't break ties
+    Returns: array of ranks starting at 1
+    """
+    magnitude = 10.0 ** np.floor(np.log10(np.abs(scores), out=np.zeros_like(scores), where=scores != 0))
+    scores = np.round(scores / magnitude, digits - 1) * magnitude
+    order = np.argsort(scores if ascending else -scores, kind='stable')
+    ordered = scores[order]
+    positions = np.arange(len(scores))
+    first = np.r_[True, ordered[1:] != ordered[:-1]] if len(scores) else np.zeros(0, dtype=bool)
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[order] = np.maximum.accumulate(np.where(first, positions, 0)) + 1
+    return ranks
+
+
+"""
+
+    Score collections
+
+"""
+def score_arrays(arrays, models=None):
+    """
+    This function scores and ranks the tokens of a collection with every requested model
+
+    Args: arrays - CollectionArrays of the collection
+          models - list of model names, default all registered models
+    Returns: DataFrame with token_id and a <model>_score and <model>_rank column per model
+    """
+    df = pd.DataFrame({'token_id': arrays.token_ids})
+    if arrays.num_tokens == 0:
+        return df
+    for name in models or rarity_models:
+        func, ascending = rarity_models[name]
+        scores = np.asarray(func(arrays), dtype=np.float64)
+        df[f"{name}_score"] = scores
+        df[f"{name}_rank"] = rank_scores(scores, ascending)
+    return df
+
+
+def save_scores(contract_id, scores_df, models=None):
+    """
+    This function writes the scores of a collection into the token_rarity table in bulk
+
+    Args: contract_id - contract id of the collection
+          scores_df - DataFrame returned by score_arrays()
+          models - list of model names, default all registered models
+    """
+    frames = []
+    for name in models or rarity_models:
+        frames.append(pd.DataFrame({'token_id': scores_df['token_id'],
+                                    'contract_id': contract_id,
+                                    'model': name,
+                                    'score': scores_df[f"{name}_score"],
+                                    'ranking': scores_df[f"{name}_rank"]}))
+    if frames:
+        db.save_many('token_rarity', pd.concat(frames, ignore_index=True))
+
+
+def score_collection(contract_id, models=None, save=True):
+    """
+    This function re-scores a collection on demand i.e. during underwriting
+
+    Args: contract_id - contract id of the collection
+          models - list of model names, default all registered models
+          save - write the scores into the token_rarity table
+    Returns: DataFrame with token_id and a <model>_score and <model>_rank column per model
+    """
+    start_time = time.perf_counter()
+    try:
+        arrays = load_collection_arrays(contract_id)
+        scores_df = score_arrays(arrays, models)
+        if save and arrays.num_tokens:
+            save_scores(contract_id, scores_df, models)
+        logger.info(f"score_collection() scored {arrays.num_tokens} tokens of {contract_id} in {time.perf_counter() - start_time:.3f}s")
+        return scores_df
+    except Exception as ex:
+        logger.error(ex)
+
+
+def score_collections(contract_ids, models=None):
+    """
+    This function re-scores a list of collections and saves the scores
+
+    Args: contract_ids - list of contract ids
+          models - list of model names, default all registered models
+    """
+    for contract_id in contract_ids:
+        score_collection(contract_id, models)
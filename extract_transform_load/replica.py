@@ -0,0 +1,72 @@
+# Import Libraries
+import os
+import time
+import threading
+import logging
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+
+# Get Logger
+logger = logging.getLogger()
+
+# Load .env environment variables
+load_dotenv()
+
+# The lag check returns how many seconds the replica is behind the primary.  A replica that has replayed
+# everything it received, or a server that isn't a replica, has no lag
+lag_query = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END AS replica_lag
+"""
+
+
+class ReplicaRouter(object):
+    '''
+    Routes the read queries of the ETL, the dashboard and the analytics to the optional read
+    replica (DATABASE_REPLICA_URL) while it's within DATABASE_REPLICA_MAX_LAG seconds of the
+    primary, and to the primary otherwise.  The lag is checked at most once every
+    DATABASE_REPLICA_CHECK_INTERVAL seconds.  Writes always use the primary.
+    '''
+    def __init__(self, primary=None, replica_url=None, max_lag=None, check_interval=None):
+        '''
+        Class constructor or initialization method
+        '''
+        replica_url = replica_url or os.getenv("DATABASE_REPLICA_URL")
+        self.primary = primary
+        self.replica = create_engine(replica_url, echo = False) if replica_url else None
+        self.max_lag = float(max_lag if max_lag is not None else os.getenv("DATABASE_REPLICA_MAX_LAG", 30))
+        self.check_interval = float(check_interval if check_interval is not None else os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", 10))
+        # Result of the last lag check: monotonic time of the check and whether the replica is usable
+        self.status = {'checked_at': 0.0, 'usable': False}
+        self.lock = threading.Lock()
+
+    def lag(self):
+        """
+        Returns how many seconds the replica is behind the primary
+        """
+        with self.replica.connect() as conn:
+            return float(conn.execute(lag_query).scalar())
+
+    def read_engine(self, primary=None):
+        """
+        Returns the replica engine when it's usable, otherwise the primary engine, or the engine passed in
+        """
+        primary = primary if primary is not None else self.primary
+        if self.replica is None:
+            return primary
+        with self.lock:
+            if time.monotonic() - self.status['checked_at'] > self.check_interval:
+                try:
+                    lag = self.lag()
+                    self.status['usable'] = lag <= self.max_lag
+                    if not self.status['usable']:
+                        logger.warning(f"read_engine() replica is {lag:.1f}s behind, reading from the primary")
+                except Exception as ex:
+                    self.status['usable'] = False
+                    logger.error(ex)
+                self.status['checked_at'] = time.monotonic()
+            return self.replica if self.status['usable'] else primary
@@ -0,0 +1,97 @@
+# Import Libraries
+import os
+import json
+import shutil
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from dotenv import load_dotenv
+
+# pyarrow is only needed when dashboard snapshots are published or read
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = None
+
+
+# Get Logger
+logger = logging.getLogger()
+
+# Load .env environment variables
+load_dotenv()
+
+# Directory holding the snapshots, one subdirectory per version, and the number of versions kept
+snapshot_dir = Path(os.getenv("DASHBOARD_SNAPSHOT_DIR", Path(__file__).resolve().parent.parent / 'snapshots'))
+snapshot_keep = max(int(os.getenv("DASHBOARD_SNAPSHOT_KEEP", 3)), 1)
+
+# The LATEST file holds the version of the current snapshot, the manifest lists the datasets of a snapshot
+latest_file = 'LATEST'
+manifest_file = 'manifest.json'
+
+
+def write_snapshot(datasets, run_id=None):
+    """
+    This function writes the datasets as a new snapshot, one uncompressed Arrow IPC (Feather) file per dataset so they
+    can be memory-mapped, and a manifest with the version and as-of time.  The snapshot is written to a directory of
+    its own and only becomes the latest once complete, so readers never see a partial snapshot.  The oldest snapshots
+    beyond DASHBOARD_SNAPSHOT_KEEP are removed
+
+    Args: datasets - dict of dataset name to DataFrame
+          run_id - optional id of the ETL run the datasets were computed from
+    Returns: the snapshot version, or None if pyarrow isn't installed
+    """
+    if pa is None:
+        logger.warning("write_snapshot() skipped, pyarrow isn't installed")
+        return None
+    as_of = datetime.now(timezone.utc)
+    version = f"{as_of:%Y%m%dT%H%M%S%f}" + (f"_run{run_id}" if run_id is not None else "")
+    tmp_path = snapshot_dir / f".{version}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    for name, df in datasets.items():
+        feather.write_feather(pa.Table.from_pandas(df), tmp_path / f"{name}.arrow", compression='uncompressed')
+    manifest = {'version': version, 'run_id': run_id, 'as_of': as_of.isoformat(), 'datasets': sorted(datasets)}
+    (tmp_path / manifest_file).write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, snapshot_dir / version)
+
+    # Point LATEST at the new version, replacing the file is atomic
+    tmp_latest = snapshot_dir / f".{latest_file}.tmp"
+    tmp_latest.write_text(version)
+    os.replace(tmp_latest, snapshot_dir / latest_file)
+
+    # Versions start with their timestamp so they sort oldest first
+    versions = sorted(path for path in snapshot_dir.iterdir() if path.is_dir() and not path.name.startswith('.'))
+    for path in versions[:-snapshot_keep]:
+        shutil.rmtree(path, ignore_errors=True)
+    logger.info(f"write_snapshot() published snapshot {version} with {len(datasets)} datasets")
+    return version
+
+
+def latest_manifest():
+    """
+    This function returns the manifest of the latest snapshot
+
+    Returns: dict with the version, run_id, as_of time and datasets, or None if there's no snapshot or pyarrow isn't installed
+    """
+    if pa is None:
+        return None
+    try:
+        version = (snapshot_dir / latest_file).read_text().strip()
+        return json.loads((snapshot_dir / version / manifest_file).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def read_dataset(manifest, name):
+    """
+    This function reads a dataset of a snapshot, memory-mapping its file
+
+    Args: manifest - the snapshot's manifest, see latest_manifest()
+          name - the dataset name
+    Returns: DataFrame, or None if there's no snapshot or it doesn't have the dataset
+    """
+    if manifest is None or name not in manifest['datasets']:
+        return None
+    table = feather.read_table(snapshot_dir / manifest['version'] / f"{name}.arrow", memory_map=True)
+    return table.to_pandas()